@@ -9,6 +9,7 @@ from .blueprints import home, fetch, job, data, cache
 from .commands import registry, worker, datafile
 from .data.cache import get_cache
 from .data.utils import CustomJSONEncoder
+from tsg_insights_dash.data.builders import register_dataset_builders
 
 def create_app(test_config=None):
     # create and configure the app
@@ -21,7 +22,12 @@ def create_app(test_config=None):
         ),
         JSON_SORT_KEYS=False,
         REQUESTS_CACHE_ON=True,
-        FILE_CACHE=os.environ.get("FILE_CACHE", 'filesystem'), # use 'redis' or 'filesystem'
+        FILE_CACHE=os.environ.get("FILE_CACHE", 'filesystem'), # use 'redis', 'filesystem' or 'arrow'
+        DATAFRAME_CACHE_SIZE=int(os.environ.get("DATAFRAME_CACHE_SIZE", 500000000)), # bytes of dataframes each process keeps in memory
+        RESULTS_CACHE_SIZE=int(os.environ.get("RESULTS_CACHE_SIZE", 50000000)), # bytes of chart results each process keeps in memory
+        RESULTS_CACHE_TIMEOUT=int(os.environ.get("RESULTS_CACHE_TIMEOUT", 60*60*24)), # seconds chart results are kept in redis
+        DOWNLOADS_CACHE_SIZE=int(os.environ.get("DOWNLOADS_CACHE_SIZE", 1000000000)), # bytes of download files kept in the uploads folder
+        DOWNLOADS_PREBUILD=[f for f in os.environ.get("DOWNLOADS_PREBUILD", "").split(",") if f], # download formats created when a file is loaded
 
         # Newsletter
         NEWSLETTER_FORM_ACTION=os.environ.get("NEWSLETTER_FORM_ACTION"),
@@ -36,6 +42,9 @@ def create_app(test_config=None):
         MAPBOX_ACCESS_TOKEN=os.environ.get("MAPBOX_ACCESS_TOKEN"),
         MAPBOX_STYLE=os.environ.get("MAPBOX_STYLE"),
 
+        # folder containing rgn.geojson, laua.geojson and pcon.geojson boundary files
+        BOUNDARIES_FOLDER=os.environ.get("BOUNDARIES_FOLDER"),
+
         # limit of file size for the tool
         FILE_SIZE_LIMIT=os.environ.get("FILE_SIZE_LIMIT", 50000000),
 
@@ -78,6 +87,9 @@ def create_app(test_config=None):
     app.register_blueprint(cache.bp, url_prefix='/cache')
     app.add_url_rule('/', endpoint='index')
 
+    # indexes and files made for the dashboard when a dataset is loaded
+    register_dataset_builders()
+
     # register command line interface
     app.cli.add_command(registry.cli)
     app.cli.add_command(worker.cli)
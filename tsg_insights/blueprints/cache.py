@@ -1,9 +1,10 @@
 import json
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response
 
-from ..data.cache import get_cache
+from ..data.cache import get_cache, LOCAL_CACHE
 from ..data.process import fetch_geocodes
+from ..data.utils import json_dumps
 
 bp = Blueprint('cache', __name__)
 
@@ -19,7 +20,7 @@ def check_redis_cache():
             k.decode('utf8'): json.loads(v.decode('utf8')) for k, v in r.hgetall("files").items()
         }
     }
-    return json.dumps(cache_contents)
+    return Response(json_dumps(cache_contents), mimetype="application/json")
 
 @bp.route('/geocodes')
 def view_geocodes():
@@ -28,3 +29,7 @@ def view_geocodes():
         k.decode("utf8"): c.decode("utf8")
         for k, c in cache.hscan_iter("geocodes")
     })
+
+@bp.route('/local_cache')
+def view_local_cache():
+    return jsonify(LOCAL_CACHE.stats())
@@ -1,130 +1,265 @@
-import io
+import os
+import hashlib
+import tempfile
 
-from flask import Blueprint, jsonify, request, Response, abort
-import pandas as pd
+from flask import Blueprint, jsonify, request, Response, abort, stream_with_context, send_file
+import numpy as np
 
-from tsg_insights_dash.data.filters import get_filtered_df
-from tsg_insights_dash.data.results import get_statistics, CHARTS
+from tsg_insights.data.cache import get_from_cache, dataset_available, get_dataset_version, get_filters_hash, \
+    get_downloads_cache_size, get_download_key, get_download_from_cache
+from tsg_insights.data.utils import json_dumps
+from tsg_insights_dash.data.downloads import get_download_df, generate_and_save, build_download, remove_file, \
+    download_format_available, DOWNLOAD_FORMATS, DOWNLOAD_CHUNK_SIZE
+from tsg_insights_dash.data.filters import get_filtered_results, get_filter_index, \
+    get_filtered_rows, check_filter, FILTERS
+from tsg_insights_dash.data.results import get_statistics, get_cube_statistics, get_location_data, CHARTS
+from tsg_insights_dash.data.query import check_query, get_query_results
+from tsg_insights_dash.data.table import get_table_page, TABLE_PAGE_SIZE
+from tsg_insights_dash.data.geo import get_geo_index, get_geo_clusters, get_rows_in_bbox, \
+    get_geojson_features, get_zoom_level, POINTS_ZOOM
 
 bp = Blueprint('data', __name__)
 
+# seconds that clients can use results from `/data/<fileid>` before checking them again
+DATA_MAX_AGE = 60 * 5
+
+def get_filters_from_request():
+    # filters are given in the query string, eg `?funders=A&funders=B&award_dates=2015&award_dates=2017`
+    filters = {}
+    for filter_id, filter_def in FILTERS.items():
+        values = request.args.getlist(filter_id)
+        if not values:
+            continue
+        if filter_def.get("type") == 'rangeslider':
+            try:
+                values = [int(v) for v in values]
+            except ValueError:
+                abort(400)
+        elif filter_def.get("type") == 'text':
+            values = values[0]
+        try:
+            check_filter(filter_id, values)
+        except ValueError:
+            abort(400)
+        filters[filter_id] = values
+    return filters
+
 
 @bp.route('/<fileid>.geojson')
 def fetch_file_geojson(fileid):
+    # optional parameters:
+    # - `bbox`: min longitude, min latitude, max longitude, max latitude
+    # - `zoom`: map zoom level, below which grants are grouped into grid cells
+    filters = get_filters_from_request()
+    zoom = request.args.get("zoom", type=float)
+    bbox = request.args.get("bbox")
+
+    if not dataset_available(fileid):
+        abort(404)
+    index = get_geo_index(fileid)
+    if index is None:
+        abort(404)
+
+    rows = get_filtered_rows(get_filter_index(fileid), **filters)
+    if bbox:
+        try:
+            bbox = [float(b) for b in bbox.split(",")]
+        except ValueError:
+            abort(400)
+        if len(bbox) != 4:
+            abort(400)
+        bbox_rows = get_rows_in_bbox(index, bbox)
+        rows = bbox_rows if rows is None else np.intersect1d(rows, bbox_rows)
 
-    # @TODO: fetch filters
-    df = get_filtered_df(fileid, **request.form.get("filters", {}))
-
-    popup_col = 'Recipient Org:0:Name'
-    if popup_col not in df.columns and 'Recipient Org:0:Identifier' in df.columns:
-        popup_col = 'Recipient Org:0:Identifier'
-
-    geo = df[["__geo_lat", "__geo_long", popup_col]].dropna()
-    geo = geo.groupby(["__geo_lat", "__geo_long", popup_col]
-                      ).size().rename("grants").reset_index()
-
-    return jsonify({
-        "FeatureCollection": {
-            "features": [
-                {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [g["__geo_lat"], g["__geo_long"]]
-                    },
-                    "properties": {
-                        "name": g[popup_col],
-                        "grants": g['grants'],
-                    }
-                }
-                for k, g in geo.iterrows()
-            ]
-        }
-    })
-
-            
+    if zoom is not None and get_zoom_level(zoom) < POINTS_ZOOM:
+        geo = get_geo_clusters(index, rows, get_zoom_level(zoom))["geo"]
+        features = get_geojson_features(
+            geo["__geo_lat"].values,
+            geo["__geo_long"].values,
+            {"grants": geo["grants"].values},
+        )
+    else:
+        df = get_from_cache(fileid)
+        if rows is not None:
+            df = df.take(rows)
+        location = get_location_data(df)
+        if location is None or "error" in location:
+            abort(404)
+        geo = location["geo"]
+        features = get_geojson_features(
+            geo["__geo_lat"].values,
+            geo["__geo_long"].values,
+            {
+                "name": geo[location["popup_col"]].values,
+                "grants": geo["grants"].values,
+            },
+        )
+
+    def generate_geojson():
+        yield '{"type": "FeatureCollection", "features": ['
+        for k, feature in enumerate(features):
+            yield (",\n" if k else "\n") + feature
+        yield "\n]}"
+
+    return Response(
+        stream_with_context(generate_geojson()),
+        mimetype="application/geo+json",
+    )
 
 
 @bp.route('/<fileid>')
 def fetch_file(fileid):
+    # optional parameters:
+    # - `charts`: comma separated results to include, eg `?charts=funders,org_type`
+    #   (all charts and the statistics are included by default)
+    # - filters, in the same way as the geojson
+    filters = get_filters_from_request()
 
-    # @TODO: fetch filters
-    df = get_filtered_df(fileid, **request.form.get("filters", {}))
-
-    results = {
-        chart_id: chart_def['get_results'](df)
-        for chart_id, chart_def in CHARTS.items()
+    results = dict(CHARTS)
+    results['statistics'] = {
+        "get_results": get_statistics,
+        "get_cube_results": get_cube_statistics,
     }
-    results['statistics'] = get_statistics(df)
-    return jsonify(results)
+    charts = [c for c in request.args.get("charts", "").split(",") if c]
+    if charts:
+        if any([c not in results for c in charts]):
+            abort(400)
+        results = {c: results[c] for c in charts}
+
+    if not dataset_available(fileid):
+        abort(404)
+
+    # results only change when the dataset does, so clients can check
+    # whether the results they have are still current
+    etag = hashlib.md5("{}:{}:{}:{}".format(
+        fileid,
+        get_dataset_version(fileid),
+        get_filters_hash(filters),
+        ",".join(sorted(results.keys())),
+    ).encode("utf8")).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        results = get_filtered_results(fileid, results, **filters)
+        if results is None:
+            abort(404)
+        response = Response(json_dumps(results), mimetype="application/json")
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = DATA_MAX_AGE
+    return response
+
+
+@bp.route('/<fileid>/grants')
+def fetch_file_grants(fileid):
+    # optional parameters:
+    # - `offset` and `limit`: which grants to return
+    # - `sort`: column to sort by, with `ascending=0` to reverse the order
+    # - filters, in the same way as the geojson
+    filters = get_filters_from_request()
+    page = get_table_page(
+        fileid,
+        sort=request.args.get("sort"),
+        ascending=request.args.get("ascending", "1") not in ("0", "false"),
+        offset=request.args.get("offset", 0, type=int),
+        limit=request.args.get("limit", TABLE_PAGE_SIZE, type=int),
+        **filters
+    )
+    if page is None:
+        abort(404)
+    return Response(json_dumps(page), mimetype="application/json")
+
+
+@bp.route('/<fileid>/query', methods=['POST'])
+def query_file(fileid):
+    # the query is posted as JSON - see `tsg_insights_dash/data/query.py`
+    try:
+        query = check_query(request.get_json(force=True, silent=True))
+        results = get_query_results(fileid, query)
+    except ValueError as error:
+        return jsonify(error=400, text=str(error)), 400
+    if results is None:
+        abort(404)
+    return Response(json_dumps(results), mimetype="application/json")
+
+
+def generate_file(filename, block_size=DOWNLOAD_CHUNK_SIZE * 100):
+    # stream a file in blocks
+    with open(filename, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            yield block
+            block = f.read(block_size)
+
+
+def send_download(filename, fileid, format, filters):
+    # supports If-None-Match, If-Modified-Since and Range requests
+    response = send_file(
+        filename,
+        mimetype=DOWNLOAD_FORMATS[format]["mimetype"],
+        as_attachment=True,
+        attachment_filename="{}.{}".format(fileid, format),
+        add_etags=False,
+        conditional=False,
+    )
+    response.set_etag(get_download_key(fileid, format, filters))
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=os.path.getsize(filename))
 
 
 @bp.route('/download/<fileid>.<format>')
 def download_file(fileid, format):
-    df = get_filtered_df(fileid)
-
-    fields_to_exclude = [
-        'Recipient Org:0:Identifier:Scheme',
-        'Recipient Org:0:Identifier:Clean',
-        '__org_orgid',
-        '__org_charity_number',
-        '__org_company_number',
-        # '__geo_ctry',
-        # '__geo_cty',
-        # '__geo_laua',
-        # '__geo_pcon',
-        # '__geo_rgn',
-        '__geo_imd',
-        '__geo_ru11ind',
-        '__geo_oac11',
-        # '__geo_lat',
-        # '__geo_long',
-    ]
-
-    column_renames = {
-        "__org_date_registered": "Insights:Recipient Org:Date Registered",
-        "__org_date_removed": "Insights:Recipient Org:Date Removed",
-        "__org_latest_income": "Insights:Recipient Org:Latest Income",
-        "__org_latest_income_bands": "Insights:Recipient Org:Latest Income:Bands",
-        "__org_org_type": "Insights:Recipient Org:Organisation Type",
-        "__org_postcode": "Insights:Recipient Org:Postcode",
-        "__org_age": "Insights:Recipient Org:Age",
-        "__org_age_bands": "Insights:Recipient Org:Age:Bands",
-        "__geo_ctry": "Insights:Geo:Country",
-        "__geo_cty": "Insights:Geo:County",
-        "__geo_laua": "Insights:Geo:Local Authority",
-        "__geo_pcon": "Insights:Geo:Parliamentary Constituency",
-        "__geo_rgn": "Insights:Geo:Region",
-        "__geo_lat": "Insights:Geo:Latitude",
-        "__geo_long": "Insights:Geo:Longitude",
-        "Award Date:Year": "Insights:Award Date:Year",
-        "Amount Awarded:Bands": "Insights:Amount Awarded:Bands",
-    }
-
-    if df is not None:
-
-        columns = [c for c in df.columns if c not in fields_to_exclude]
-        df = df[columns].rename(columns=column_renames)
-
-        if format == "csv":
-            csvdata = df.to_csv(index=False)
-            return Response(
-                csvdata,
-                mimetype="text/csv",
-                headers={"Content-disposition":
-                         "attachment; filename={}.csv".format(fileid)})
-        elif format == 'xlsx':
-            output = io.BytesIO()
-            writer = pd.ExcelWriter(output, engine='xlsxwriter')
-            csvdata = df.to_excel(
-                writer, sheet_name='grants', index=False)
-            writer.save()
-            return Response(
-                output.getvalue(),
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                headers={"Content-disposition":
-                         "attachment; filename={}.xlsx".format(fileid)})
-        elif format == "json":
-            pass
+    if not download_format_available(format):
         abort(400)
-    abort(404)
+    download_format = DOWNLOAD_FORMATS[format]
+    if not dataset_available(fileid):
+        abort(404)
+
+    # filters are given in the query string, in the same way as the geojson
+    filters = get_filters_from_request()
+    use_cache = get_downloads_cache_size() > 0
+
+    if use_cache:
+        filename = get_download_from_cache(fileid, format, filters)
+        if filename:
+            return send_download(filename, fileid, format, filters)
+
+    df = get_download_df(fileid, filters)
+    if df is None:
+        abort(404)
+
+    headers = {"Content-disposition":
+               "attachment; filename={}.{}".format(fileid, format)}
+
+    if "generate" in download_format:
+        chunks = download_format["generate"](df)
+        if use_cache:
+            chunks = generate_and_save(chunks, fileid, format, filters)
+        response = Response(
+            stream_with_context(chunks),
+            mimetype=download_format["mimetype"],
+            headers=headers)
+        if use_cache:
+            response.set_etag(get_download_key(fileid, format, filters))
+        return response
+
+    if use_cache:
+        filename = build_download(fileid, format, filters, df)
+        return send_download(filename, fileid, format, filters)
+
+    handle, filename = tempfile.mkstemp(suffix=".{}".format(format))
+    os.close(handle)
+    try:
+        download_format["write"](df, filename)
+    except BaseException:
+        remove_file(filename)
+        raise
+    headers["Content-Length"] = str(os.path.getsize(filename))
+    response = Response(
+        generate_file(filename),
+        mimetype=download_format["mimetype"],
+        headers=headers)
+    # removed once the response is closed, even if it was never sent
+    response.call_on_close(lambda: remove_file(filename))
+    return response
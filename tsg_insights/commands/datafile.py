@@ -1,14 +1,19 @@
 import logging
 import sys
+import csv
+import time
+import uuid
+from multiprocessing import Pool
 
 import click
 from flask import Flask, current_app
 from flask.cli import AppGroup, with_appcontext
 import pandas as pd
+from rq import Queue
 
 from ..data.registry import process_registry, get_reg_file
 from ..data.process import get_dataframe_from_url
-from ..data.cache import delete_from_cache, get_from_cache, get_cache, save_to_cache
+from ..data.cache import delete_from_cache, get_from_cache, get_cache, save_to_cache, get_metadata_from_cache
 
 cli = AppGroup('data')
 
@@ -41,52 +46,192 @@ def cli_fetch_file(url):
     click.echo('/file/{}'.format(fileid))
 
 
+FETCHALL_ORDER = {
+    "registry": None,
+    "largest": lambda f: -(f["file_size"] or 0),
+    "smallest": lambda f: (f["file_size"] or 0),
+    "grants": lambda f: -(f["grant_count"] or 0),
+}
+
+
+def fetch_registry_file(file_, refetch=False, check_etag=False):
+    # fetch a single registry file, returning the timings for each stage
+    start = time.time()
+    timings = []
+    if refetch:
+        delete_from_cache(file_["identifier"])
+    fileid, filename, headers = get_dataframe_from_url(
+        file_["download_url"], timings=timings, refresh=check_etag)
+    return fileid, headers, timings, time.time() - start
+
+
+def fetch_registry_file_result(args):
+    # errors are returned rather than raised so one file doesn't stop the rest
+    file_, refetch, check_etag = args
+    try:
+        return file_, fetch_registry_file(file_, refetch, check_etag), None
+    except Exception as e:
+        return file_, None, str(e)
+
+
+def init_fetch_worker(config):
+    # files are fetched in separate processes, as most of the work is done
+    # by pandas. Each process has its own app with the same config
+    from tsg_insights import create_app
+    create_app(config).app_context().push()
+
+
+def fetchall_result(file_, **kwargs):
+    return {
+        "publisher": file_.get("publisher"),
+        "fileid": None,
+        "headers": None,
+        "error": None,
+        "seconds": None,
+        "job": None,
+        **file_,
+        **kwargs
+    }
+
+
+class ResultsWriter(object):
+    # CSV results are written a row at a time as each file finishes,
+    # other formats are written once at the end
+
+    def __init__(self, output):
+        self.output = output
+        self.results = {}
+        self.fieldnames = None
+        if self.is_csv:
+            open(self.output, "w").close()
+
+    @property
+    def is_csv(self):
+        return not (self.output.endswith(".json") or self.output.endswith(".xlsx"))
+
+    def add(self, identifier, result):
+        self.results[identifier] = result
+        if not self.is_csv:
+            return
+        with open(self.output, "a", newline="") as output_file:
+            writer = csv.writer(output_file)
+            if self.fieldnames is None:
+                self.fieldnames = list(result.keys())
+                writer.writerow(["FileIdentifier"] + self.fieldnames)
+            writer.writerow([identifier] + [result.get(f) for f in self.fieldnames])
+
+    def close(self):
+        if self.is_csv or not self.results:
+            return
+        result_df = pd.DataFrame(self.results).T
+        result_df.index.rename("FileIdentifier", inplace=True)
+        if self.output.endswith(".json"):
+            result_df.to_json(self.output)
+        elif self.output.endswith(".xlsx"):
+            result_df.to_excel(self.output)
+
+
 @cli.command('fetchall')
 @click.argument('output', type=click.Path())
 @click.option('--file-limit', default=None, type=int, help='maximum file size to import')
+@click.option('--workers', default=1, type=int, help='number of processes fetching files at the same time')
+@click.option('--order', default='registry', type=click.Choice(list(FETCHALL_ORDER.keys())), help='order in which to fetch files')
+@click.option('--skip-cached/--refetch', default=True, help='skip files that are already in the cache')
+@click.option('--check-etag', is_flag=True, help='refetch cached files if the ETag or Last-Modified header shows they have changed')
+@click.option('--queue', 'use_queue', is_flag=True, help='add the files to the worker queue rather than fetching them here')
 @with_appcontext
-def cli_fetch_all_files(output, file_limit):
+def cli_fetch_all_files(output, file_limit, workers, order, skip_cached, check_etag, use_queue):
 
     if not file_limit:
         file_limit = current_app.config.get("FILE_SIZE_LIMIT")
     if file_limit:
         click.echo("Skipping files larger than {:,.0f} bytes".format(file_limit))
+    file_limit = int(file_limit) if file_limit else None
 
     reg = process_registry()
-    results = {}
-    for publisher, files in list(reg.items()):
-        cli_header(publisher)
-        for file_ in files:
-            click.echo("{} ({})".format(file_['title'], file_["file_size"]))
-            click.echo(file_['download_url'])
-            error = None
-            fileid = None
-            headers = None
-            if file_['file_size'] < file_limit:
-                try:
-                    fileid, filename, headers = get_dataframe_from_url(file_["download_url"])
-                except Exception as e:
-                    error = str(e)
-            else:
-                error = "Skipped due to file size ({})".format(file_['file_size'])
-
-            results[file_["identifier"]] = {
-                "publisher": publisher,
-                "fileid": fileid,
-                "headers": headers,
-                "error": error,
-                **file_
-            }
-    
-            result_df = pd.DataFrame(results).T
-            result_df.index.rename("FileIdentifier", inplace=True)
-            if output.endswith(".json"):
-                result_df.to_json(output)
-            elif output.endswith(".xlsx"):
-                result_df.to_excel(output)
-            else:
-                result_df.to_csv(output)
-            
+    files = [file_ for publisher, pub_files in reg.items() for file_ in pub_files]
+    if FETCHALL_ORDER.get(order):
+        files = sorted(files, key=FETCHALL_ORDER[order])
+
+    writer = ResultsWriter(output)
+    to_fetch = []
+    for file_ in files:
+        result = fetchall_result(file_)
+        if file_limit and (file_['file_size'] or 0) >= file_limit:
+            result["error"] = "Skipped due to file size ({})".format(file_['file_size'])
+        elif skip_cached and not check_etag and get_metadata_from_cache(file_["identifier"]):
+            result["fileid"] = file_["identifier"]
+            result["error"] = "Skipped as already in cache"
+        else:
+            to_fetch.append(file_)
+            continue
+        writer.add(file_["identifier"], result)
+
+    cli_header("Fetching {:,.0f} files ({:,.0f} skipped)".format(
+        len(to_fetch), len(files) - len(to_fetch)))
+
+    if use_queue:
+        q = Queue(connection=get_cache())
+        for file_ in to_fetch:
+            job = q.enqueue_call(func=get_dataframe_from_url,
+                                 args=(file_["download_url"], ),
+                                 timeout='15m',
+                                 job_id=str(uuid.uuid4()))
+            click.echo("{} [{}] queued as job {}".format(
+                file_['title'], file_["identifier"], job.id))
+            writer.add(file_["identifier"], fetchall_result(file_, job=job.id))
+        writer.close()
+        return
+
+    start = time.time()
+    file_timings = []
+    stage_timings = {}
+    args = [(file_, not skip_cached, check_etag) for file_ in to_fetch]
+    if workers > 1:
+        pool = Pool(workers, init_fetch_worker, (dict(current_app.config), ))
+        fetched = pool.imap_unordered(fetch_registry_file_result, args)
+    else:
+        pool = None
+        fetched = map(fetch_registry_file_result, args)
+
+    for file_, fetch_result, error in fetched:
+        result = fetchall_result(file_)
+        if error is None:
+            fileid, headers, timings, seconds = fetch_result
+            result.update(fileid=fileid, headers=headers, seconds=seconds)
+            file_timings.append((seconds, file_))
+            for stage, stage_seconds in timings:
+                stage_timings[stage] = stage_timings.get(stage, 0) + stage_seconds
+            click.echo("{} [{}] loaded in {:,.1f}s".format(
+                file_['title'], file_["identifier"], seconds))
+        else:
+            result["error"] = error
+            click.echo("{} [{}] failed: {}".format(
+                file_['title'], file_["identifier"], error))
+        writer.add(file_["identifier"], result)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
+
+    elapsed = time.time() - start
+    cli_header("Summary")
+    click.echo("{:,.0f} files fetched in {:,.1f}s ({:,.0f} failed)".format(
+        len(file_timings), elapsed, len(to_fetch) - len(file_timings)))
+    if elapsed and file_timings:
+        click.echo("{:,.2f} files per minute, {:,.0f} grants per minute".format(
+            len(file_timings) / (elapsed / 60),
+            sum([f["grant_count"] or 0 for s, f in file_timings]) / (elapsed / 60),
+        ))
+
+    cli_header("Slowest files")
+    for seconds, file_ in sorted(file_timings, key=lambda x: -x[0])[:10]:
+        click.echo("{:>8,.1f}s  {} ({:,.0f} grants)".format(
+            seconds, file_['title'], file_["grant_count"] or 0))
+
+    cli_header("Time spent in each stage")
+    for stage, seconds in sorted(stage_timings.items(), key=lambda x: -x[1]):
+        click.echo("{:>8,.1f}s  {}".format(seconds, stage))
 
 
 @cli.command('remove')
@@ -128,6 +273,17 @@ def cli_redistofile():
             save_to_cache(k, df, cache_type='redis')
 
 
+@cli.command('filetoarrow')
+@with_appcontext
+def cli_filetoarrow():
+    cache = get_cache()
+    for k, c in cache.hscan_iter("files"):
+        k = k.decode("utf8")
+        df = get_from_cache(k, cache_type='filesystem')
+        if df is not None:
+            save_to_cache(k, df, cache_type='arrow')
+
+
 @cli.command('preview')
 @click.argument('fileid')
 @click.option('--field')
@@ -1,15 +1,114 @@
 import os
+import sys
+import glob
 import pickle
 import logging
 import json
+import hashlib
 import datetime
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
 from flask import current_app
 from redis import StrictRedis, from_url
+import pandas as pd
+import numpy as np
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 from .utils import CustomJSONEncoder
 
 REDIS_DEFAULT_URL = 'redis://localhost:6379/0'
 REDIS_ENV_VAR = 'REDIS_URL'
+VERSION_KEY = 'file_versions'
+# change this when the format of the cached results or dashboard state
+# changes, so results saved by earlier code aren't used
+RESULTS_VERSION = 1
+
+
+def get_object_size(obj):
+    # approximate size in memory of an object held in the local cache
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        size = obj.memory_usage(deep=True)
+        return int(size.sum()) if isinstance(size, pd.Series) else int(size)
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([get_object_size(v) for v in obj.values()])
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum([get_object_size(v) for v in obj])
+    return sys.getsizeof(obj)
+
+
+class LocalCache(object):
+    # least recently used cache of objects loaded by this process
+    #
+    # Each item is stored with the version of the dataset it was loaded
+    # from, so items are reloaded once another process has saved or
+    # deleted the dataset.
+
+    def __init__(self, max_bytes=None):
+        self.items = OrderedDict()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, version):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, version, obj, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        max_bytes = self.max_bytes
+        if not max_bytes:
+            return
+        nbytes = get_object_size(obj)
+        if nbytes > max_bytes:
+            return
+        with self.lock:
+            self.delete(key)
+            self.items[key] = (version, obj, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > max_bytes:
+                oldest_key, oldest = self.items.popitem(last=False)
+                self.nbytes -= oldest[2]
+
+    def delete(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.nbytes -= item[2]
+
+    def delete_fileid(self, fileid):
+        with self.lock:
+            for key in list(self.items.keys()):
+                if key == fileid or (isinstance(key, tuple) and key[0] == fileid):
+                    self.delete(key)
+
+    def stats(self):
+        return {
+            "items": len(self.items),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+LOCAL_CACHE = LocalCache()
+RESULTS_CACHE = LocalCache()
 
 
 def get_cache(strict=False):
@@ -18,9 +117,143 @@ def get_cache(strict=False):
         return StrictRedis.from_url(redis_url)
     return from_url(redis_url)
 
-def get_filename(fileid):
+def get_dataset_version(fileid):
+    # version stamp for a dataset, changed whenever it is saved or deleted
+    version = get_cache().hget(VERSION_KEY, fileid)
+    return int(version) if version else 0
+
+
+def update_dataset_version(fileid):
+    LOCAL_CACHE.delete_fileid(fileid)
+    RESULTS_CACHE.delete_fileid(fileid)
+    return get_cache().hincrby(VERSION_KEY, fileid, 1)
+
+
+def get_local_cache_size():
+    return int(current_app.config.get("DATAFRAME_CACHE_SIZE") or 0)
+
+
+def get_results_cache_size():
+    return int(current_app.config.get("RESULTS_CACHE_SIZE") or 0)
+
+
+def get_downloads_cache_size():
+    return int(current_app.config.get("DOWNLOADS_CACHE_SIZE") or 0)
+
+
+def get_filters_hash(filters):
+    # unset filters are ignored and lists of options sorted, so that
+    # equivalent filter states share the same results
+    canonical = {}
+    for filter_id, value in (filters or {}).items():
+        if not value or value == ['__all']:
+            continue
+        if isinstance(value, (list, tuple)) and all([isinstance(v, str) for v in value]):
+            value = sorted(set(value))
+        canonical[filter_id] = value
+    canonical = json.dumps(canonical, sort_keys=True, default=str)
+    return hashlib.md5(canonical.encode("utf8")).hexdigest()
+
+
+def get_filename(fileid, extension="pkl"):
     uploads_folder = current_app.config.get("UPLOADS_FOLDER")
-    return os.path.join(uploads_folder, "{}.pkl".format(fileid))
+    return os.path.join(uploads_folder, "{}.{}".format(fileid, extension))
+
+
+def get_downloads_folder():
+    folder = os.path.join(current_app.config.get("UPLOADS_FOLDER"), "downloads")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_download_key(fileid, format, filters=None):
+    # changes with the dataset version, so old files are never served
+    key = "{}:{}:{}:{}".format(
+        fileid, get_dataset_version(fileid), format, get_filters_hash(filters))
+    return hashlib.md5(key.encode("utf8")).hexdigest()
+
+
+def get_download_filename(fileid, format, filters=None):
+    return os.path.join(
+        get_downloads_folder(),
+        "{}-{}.{}".format(fileid, get_download_key(fileid, format, filters), format)
+    )
+
+
+def get_download_temp_filename():
+    # temporary files are made in the same folder so they can be moved into place
+    handle, filename = tempfile.mkstemp(suffix=".tmp", dir=get_downloads_folder())
+    os.close(handle)
+    return filename
+
+
+def save_download_to_cache(fileid, format, filters, temp_filename):
+    filename = get_download_filename(fileid, format, filters)
+    os.replace(temp_filename, filename)
+    logging.info("Download [{}] for dataframe [{}] saved".format(format, fileid))
+    prune_downloads_cache()
+    return filename
+
+
+def get_download_from_cache(fileid, format, filters=None):
+    filename = get_download_filename(fileid, format, filters)
+    if not os.path.exists(filename):
+        return None
+    # the access time records when the file was last used
+    os.utime(filename, (time.time(), os.path.getmtime(filename)))
+    return filename
+
+
+def prune_downloads_cache():
+    # remove the least recently used files until the cache is under its size limit
+    files = []
+    for filename in glob.glob(os.path.join(get_downloads_folder(), "*")):
+        if filename.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_atime, stat.st_size, filename))
+
+    total_size = sum([f[1] for f in files])
+    for atime, size, filename in sorted(files):
+        if total_size <= get_downloads_cache_size():
+            break
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        logging.info("Download [{}] removed from cache".format(os.path.basename(filename)))
+
+
+def save_arrow_file(filename, df):
+    # save in the arrow IPC file format, which can be memory mapped by
+    # every process reading the file so the OS only holds one copy of it
+    table = pa.Table.from_pandas(df)
+    temp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with pa.OSFile(temp_filename, "wb") as sink:
+            writer = pa.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+        # replace the file rather than overwriting it so any processes with
+        # the old file mapped can carry on using it
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def get_arrow_table(filename):
+    source = pa.memory_map(filename, "r")
+    return pa.ipc.open_file(source).read_all()
+
+
+def load_arrow_file(filename):
+    # columns without nulls are used directly from the memory mapped file
+    return get_arrow_table(filename).to_pandas(split_blocks=True)
 
 
 def save_to_cache(fileid, df, metadata=None, cache_type=None):
@@ -28,9 +261,28 @@ def save_to_cache(fileid, df, metadata=None, cache_type=None):
     prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
     cache_type = cache_type or current_app.config.get("FILE_CACHE")
 
+    if cache_type == "arrow" and pa is None:
+        logging.info("pyarrow is not installed, saving to filesystem instead")
+        cache_type = "filesystem"
+
     if cache_type == "redis":
         r.set("{}{}".format(prefix, fileid), pickle.dumps(df))
         logging.info("Dataframe [{}] saved to redis".format(fileid))
+    elif cache_type == "arrow":
+        try:
+            save_arrow_file(get_filename(fileid, "arrow"), df)
+            logging.info("Dataframe [{}] saved to arrow file".format(fileid))
+            if os.path.exists(get_filename(fileid)):
+                os.remove(get_filename(fileid))
+        except (pa.ArrowException, TypeError, ValueError) as error:
+            # columns with mixed types can't be converted to arrow
+            logging.info("Dataframe [{}] could not be saved as arrow ({}), saving to filesystem instead".format(fileid, error))
+            # an arrow file from an earlier save would be loaded before the pickle
+            if os.path.exists(get_filename(fileid, "arrow")):
+                os.remove(get_filename(fileid, "arrow"))
+            with open(get_filename(fileid), "wb") as pkl_file:
+                pickle.dump(df, pkl_file)
+            logging.info("Dataframe [{}] saved to filesystem".format(fileid))
     else:
         with open(get_filename(fileid), "wb") as pkl_file:
             pickle.dump(df, pkl_file)
@@ -48,6 +300,7 @@ def save_to_cache(fileid, df, metadata=None, cache_type=None):
     }
     r.hset("files", fileid, json.dumps(metadata, default=CustomJSONEncoder().default))
     logging.info("Dataframe [{}] metadata saved to redis".format(fileid))
+    update_dataset_version(fileid)
 
 
 def delete_from_cache(fileid, cache_type=None):
@@ -57,15 +310,23 @@ def delete_from_cache(fileid, cache_type=None):
 
     if cache_type == "redis":
         r.delete("{}{}".format(prefix, fileid))
+        for k in r.scan_iter("{}{}_*".format(prefix, fileid)):
+            r.delete(k)
         logging.info("Dataframe [{}] removed from redis".format(fileid))
     else:
-        filename = get_filename(fileid)
-        if os.path.exists(filename):
-            os.remove(filename)
+        filenames = [get_filename(fileid), get_filename(fileid, "arrow")]
+        filenames += glob.glob(get_filename(fileid, "*.pkl"))
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
         logging.info("Dataframe [{}] removed from filesystem".format(fileid))
 
+    for filename in glob.glob(os.path.join(get_downloads_folder(), "{}-*".format(fileid))):
+        os.remove(filename)
+
     r.hdel("files", fileid)
     logging.info("Dataframe [{}] metadata removed from redis".format(fileid))
+    update_dataset_version(fileid)
 
 
 def get_from_cache(fileid, cache_type=None):
@@ -73,28 +334,36 @@ def get_from_cache(fileid, cache_type=None):
     prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
     cache_type = cache_type or current_app.config.get("FILE_CACHE")
 
-    metadata = get_metadata_from_cache(fileid)
-    if not metadata:
-        logging.info("Dataframe [{}] not found".format(fileid))
+    if not dataset_available(fileid):
         return None
-    if "expires" in metadata:
-        if datetime.datetime.strptime(metadata["expires"], "%Y-%m-%dT%H:%M:%S.%f") < datetime.datetime.now():
-            logging.info("Dataframe [{}] expired on {}".format(
-                fileid, metadata["expires"]))
-            return None
+
+    version = get_dataset_version(fileid)
+    df = LOCAL_CACHE.get(fileid, version)
+    if df is not None:
+        return df
 
     if cache_type == "redis":
         df = r.get("{}{}".format(prefix, fileid))
         if df:
             try:
+                df = pickle.loads(df)
                 logging.info("Retrieved dataframe [{}] from redis".format(fileid))
-                return pickle.loads(df)
+                LOCAL_CACHE.set(fileid, version, df, get_local_cache_size())
+                return df
             except ImportError as error:
                 logging.info(
                     "Dataframe [{}] could not be loaded".format(fileid))
                 return None
 
     else:
+        filename = get_filename(fileid, "arrow")
+        if cache_type == "arrow" and pa is not None and os.path.exists(filename):
+            df = load_arrow_file(filename)
+            logging.info(
+                "Retrieved dataframe [{}] from arrow file".format(fileid))
+            LOCAL_CACHE.set(fileid, version, df, get_local_cache_size())
+            return df
+
         filename = get_filename(fileid)
         if os.path.exists(filename):
             with open(filename, "rb") as pkl_file:
@@ -102,6 +371,7 @@ def get_from_cache(fileid, cache_type=None):
                     df = pickle.load(pkl_file)
                     logging.info(
                         "Retrieved dataframe [{}] from filesystem".format(fileid))
+                    LOCAL_CACHE.set(fileid, version, df, get_local_cache_size())
                     return df
                 except ImportError as error:
                     logging.info("Dataframe [{}] could not be loaded".format(fileid))
@@ -110,6 +380,157 @@ def get_from_cache(fileid, cache_type=None):
 
     return None
 
+def dataset_available(fileid):
+    metadata = get_metadata_from_cache(fileid)
+    if not metadata:
+        logging.info("Dataframe [{}] not found".format(fileid))
+        return False
+    if "expires" in metadata:
+        if datetime.datetime.strptime(metadata["expires"], "%Y-%m-%dT%H:%M:%S.%f") < datetime.datetime.now():
+            logging.info("Dataframe [{}] expired on {}".format(
+                fileid, metadata["expires"]))
+            return False
+    return True
+
+
+def save_derived_to_cache(fileid, name, obj, cache_type=None):
+    # save an object derived from a dataset (such as an index), tagged with
+    # the version of the dataset it was made from
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    cache_type = cache_type or current_app.config.get("FILE_CACHE")
+    version = get_dataset_version(fileid)
+    data = pickle.dumps({"version": version, "data": obj})
+
+    if cache_type == "redis":
+        r.set("{}{}_{}".format(prefix, fileid, name), data)
+    else:
+        with open(get_filename(fileid, "{}.pkl".format(name)), "wb") as pkl_file:
+            pkl_file.write(data)
+    logging.info("Derived data [{}] for dataframe [{}] saved".format(name, fileid))
+
+    LOCAL_CACHE.set((fileid, name), version, obj, get_local_cache_size())
+
+
+def get_derived_from_cache(fileid, name, cache_type=None):
+    # returns None if the object doesn't exist or was made from an earlier
+    # version of the dataset
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    cache_type = cache_type or current_app.config.get("FILE_CACHE")
+    version = get_dataset_version(fileid)
+
+    obj = LOCAL_CACHE.get((fileid, name), version)
+    if obj is not None:
+        return obj
+
+    data = None
+    if cache_type == "redis":
+        data = r.get("{}{}_{}".format(prefix, fileid, name))
+    else:
+        filename = get_filename(fileid, "{}.pkl".format(name))
+        if os.path.exists(filename):
+            with open(filename, "rb") as pkl_file:
+                data = pkl_file.read()
+    if not data:
+        return None
+
+    try:
+        data = pickle.loads(data)
+    except ImportError as error:
+        logging.info("Derived data [{}] for dataframe [{}] could not be loaded".format(name, fileid))
+        return None
+    if data.get("version") != version:
+        return None
+
+    LOCAL_CACHE.set((fileid, name), version, data["data"], get_local_cache_size())
+    return data["data"]
+
+
+def get_results_key(prefix, fileid, version, filters_hash, result_id):
+    return "{}{}_results_v{}_{}_{}_{}".format(prefix, fileid, RESULTS_VERSION, version, filters_hash, result_id)
+
+
+def save_results_to_cache(fileid, result_id, filters, results):
+    # results are stored pickled so each request gets its own copy
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    version = get_dataset_version(fileid)
+    filters_hash = get_filters_hash(filters)
+    data = pickle.dumps({"results": results})
+
+    r.set(
+        get_results_key(prefix, fileid, version, filters_hash, result_id),
+        data,
+        ex=int(current_app.config.get("RESULTS_CACHE_TIMEOUT") or 0) or None,
+    )
+    RESULTS_CACHE.set((fileid, result_id, filters_hash), version, data, get_results_cache_size())
+
+
+def get_results_from_cache(fileid, result_id, filters):
+    # returns a dict with the cached results under "results", or None if
+    # they haven't been computed for this version of the dataset
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    version = get_dataset_version(fileid)
+    filters_hash = get_filters_hash(filters)
+
+    data = RESULTS_CACHE.get((fileid, result_id, filters_hash), version)
+    if data is None:
+        data = r.get(get_results_key(prefix, fileid, version, filters_hash, result_id))
+        if not data:
+            return None
+        RESULTS_CACHE.set((fileid, result_id, filters_hash), version, data, get_results_cache_size())
+
+    try:
+        return pickle.loads(data)
+    except ImportError as error:
+        logging.info("Results [{}] for dataframe [{}] could not be loaded".format(result_id, fileid))
+        return None
+
+
+def get_state_token(fileid, filters=None):
+    # identifies the dashboard state for a version of a dataset and set of filters
+    key = "{}:{}:{}:{}".format(fileid, get_dataset_version(fileid), get_filters_hash(filters), RESULTS_VERSION)
+    return hashlib.md5(key.encode("utf8")).hexdigest()
+
+
+def save_state_to_cache(fileid, token, state):
+    # dashboard state is kept server-side so callbacks only pass the token around
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    data = pickle.dumps(state)
+
+    r.set(
+        "{}{}_state_{}".format(prefix, fileid, token),
+        data,
+        ex=int(current_app.config.get("RESULTS_CACHE_TIMEOUT") or 0) or None,
+    )
+    RESULTS_CACHE.set((fileid, "state", token), token, state, get_results_cache_size())
+
+
+def get_state_from_cache(fileid, token):
+    # returns None if the state has expired or was never saved
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+
+    # the state is kept decoded in this process, as every callback loads it
+    state = RESULTS_CACHE.get((fileid, "state", token), token)
+    if state is not None:
+        return state
+
+    data = r.get("{}{}_state_{}".format(prefix, fileid, token))
+    if not data:
+        return None
+    try:
+        state = pickle.loads(data)
+    except ImportError as error:
+        logging.info("Dashboard state [{}] for dataframe [{}] could not be loaded".format(token, fileid))
+        return None
+    RESULTS_CACHE.set((fileid, "state", token), token, state, get_results_cache_size())
+    return state
+
+
 def get_metadata_from_cache(fileid):
     r = get_cache()
 
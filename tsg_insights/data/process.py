@@ -4,16 +4,18 @@ import io
 import os
 import logging
 import datetime
+import time
 
 import pandas as pd
 import requests
+from flask import current_app
 from rq import get_current_job
 import tqdm
 from threesixty import ThreeSixtyGiving
 
-from .cache import get_cache, get_from_cache, save_to_cache
+from .cache import get_cache, get_from_cache, save_to_cache, get_metadata_from_cache, save_derived_to_cache
 from .utils import get_fileid, charity_number_to_org_id
-from .registry import fetch_reg_file, get_reg_file_from_url
+from .registry import fetch_reg_file, get_reg_file_from_url, download_reg_file
 
 FTC_URL = 'https://findthatcharity.uk/orgid/{}.json'
 CH_URL = 'http://data.companieshouse.gov.uk/doc/company/{}.json'
@@ -24,6 +26,12 @@ PC_URL = 'https://postcodes.findthatcharity.uk/postcodes/{}.json'
 FTC_SCHEMES = ["GB-CHC", "GB-NIC", "GB-SC", "GB-COH"]
 POSTCODE_FIELDS = ['ctry', 'cty', 'laua', 'pcon', 'rgn', 'imd', 'ru11ind',
                    'oac11', 'lat', 'long']  # fields to care about from the postcodes)
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/json": "json",
+    "application/vnd.ms-excel": "xls",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+}
 
 
 def get_dataframe_from_file(filename, contents, date=None, expire_days=(2 * (365/12))):
@@ -51,51 +59,122 @@ def get_dataframe_from_file(filename, contents, date=None, expire_days=(2 * (365
 
     # 5. save to cache
     save_to_cache(fileid, df, metadata=metadata)  # dataframe
+    save_dataset_indexes(fileid, df)
+    run_dataset_hooks(fileid)
 
     return (fileid, filename)
 
-def get_dataframe_from_url(url):
-    # 1. Work out the file id
-    headers = fetch_reg_file(url, 'HEAD')
-
-    # 2. Get the registry entry for the file (if available)
+def get_dataframe_from_url(url, timings=None, refresh=False):
+    # 1. Get the registry entry for the file (if available)
     registry = get_reg_file_from_url(url)
     if registry and registry.get("identifier"):
         fileid = registry.get("identifier")
+        headers = None
     else:
         # work out the version of the file
         # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Last-Modified
+        headers = fetch_reg_file(url, 'HEAD')
         last_modified = headers.get("ETag", headers.get("Last-Modified"))
 
         fileid = get_fileid(None, url, last_modified)
 
     # 2. Check cache for file
     df = get_from_cache(fileid)
-    if df is not None:
+    metadata = get_metadata_from_cache(fileid) if df is not None else None
+    if df is not None and not refresh:
         print("using cache")
-        return (fileid, url, headers)
-
-    # 3. Fetch and prepare the data
-    df = None
+        return (fileid, url, metadata.get("headers", headers))
+
+    # 3. Download the file, unless it hasn't changed since it was cached
+    filename, download_headers = download_reg_file(
+        url,
+        validators=metadata.get("headers") if metadata else None,
+        max_size=int(current_app.config.get("FILE_SIZE_LIMIT") or 0),
+    )
+    if filename is None:
+        print("file not modified, using cache")
+        return (fileid, url, metadata.get("headers", headers))
+
+    # 4. Prepare the data
     cache = prepare_lookup_cache()
     job = get_current_job()
 
-    data_preparation = DataPreparation(df, cache, job, url=url)
-    data_preparation.stages = [LoadDatasetFromURL] + data_preparation.stages
-    df = data_preparation.run()
-
-    # 4. Get metadata about the file
+    filetype = None
+    if registry:
+        filetype = registry.get("datagetter_metadata", {}).get("file_type")
+    if not get_filetype(filetype):
+        filetype = get_filetype(url, download_headers.get("Content-Type"))
+
+    try:
+        data_preparation = DataPreparation(
+            None, cache, job, url=url, path=filename, filetype=filetype)
+        data_preparation.stages = [LoadDatasetFromURL] + data_preparation.stages
+        df = data_preparation.run()
+    finally:
+        os.remove(filename)
+    if timings is not None:
+        timings.extend(data_preparation.timings)
+
+    # 5. Get metadata about the file
     metadata = {
-        "headers": headers,
+        "headers": download_headers,
         "url": url,
     }
     if registry:
         metadata["registry_entry"] = registry
 
-    # 5. save to cache
+    # 6. save to cache
     save_to_cache(fileid, df, metadata=metadata)  # dataframe
+    save_dataset_indexes(fileid, df)
+    run_dataset_hooks(fileid)
+
+    return (fileid, url, download_headers)
+
 
-    return (fileid, url, headers)
+# Builders run on a dataset once it's saved to the cache. The dashboard adds
+# its own when the app is created (see `tsg_insights_dash/data/builders.py`)
+# so this package doesn't need to import from it.
+#   - DATASET_INDEXES: functions of the dataframe, the result is saved alongside it
+#   - DATASET_HOOKS: functions of the fileid, eg the snapshot and downloads
+DATASET_INDEXES = {}
+DATASET_HOOKS = {}
+
+# The indexes, snapshot and downloads are all made again when they're first
+# needed, so if one fails the error is logged and the dataset is still saved
+
+def save_dataset_indexes(fileid, df):
+    for name, build_index in DATASET_INDEXES.items():
+        try:
+            save_derived_to_cache(fileid, name, build_index(df))
+        except Exception:
+            logging.exception("Index [{}] for dataframe [{}] failed".format(name, fileid))
+
+
+def run_dataset_hooks(fileid):
+    for name, hook in DATASET_HOOKS.items():
+        try:
+            hook(fileid)
+        except Exception:
+            logging.exception("Hook [{}] for dataframe [{}] failed".format(name, fileid))
+
+
+def get_filetype(filename, content_type=None):
+    # work out which type of file this is from the extension or content type
+    if filename:
+        filetype = str(filename).lower().split("?")[0].split(".")[-1]
+        if filetype in ["csv", "json", "xls", "xlsx"]:
+            return filetype
+    if content_type:
+        return CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+
+
+def load_dataset(fileobj, filetype):
+    if filetype == "csv":
+        return ThreeSixtyGiving.from_csv(fileobj).to_pandas()
+    elif filetype in ["xls", "xlsx"]:
+        return ThreeSixtyGiving.from_excel(fileobj).to_pandas()
+    elif filetype == "json":
+        return ThreeSixtyGiving.from_json(fileobj).to_pandas()
 
 
 def prepare_lookup_cache(cache=None):
@@ -138,6 +217,7 @@ class DataPreparation(object):
         self.cache = cache
         self.job = job
         self.attributes = kwargs
+        self.timings = []
 
     def _progress_job(self, stage_id, progress=None):
         if not self.job:
@@ -156,10 +236,13 @@ class DataPreparation(object):
     def run(self):
         df = None
         self._setup_job_meta()
+        self.timings = []
         for k, Stage in enumerate(self.stages):
             stage = Stage(df, self.cache, self.job, **self.attributes)
             logging.info(stage.name)
+            start = time.time()
             df = stage.run()
+            self.timings.append((stage.name, time.time() - start))
             self._progress_job(k)
         return df
 
@@ -193,7 +276,14 @@ class LoadDatasetFromURL(DataPreparationStage):
             return self.df
 
         url = self.attributes.get("url")
-        self.df = ThreeSixtyGiving.from_url(url).to_pandas()
+        path = self.attributes.get("path")
+        filetype = get_filetype(self.attributes.get("filetype"))
+        if not path or not filetype:
+            self.df = ThreeSixtyGiving.from_url(url).to_pandas()
+            return self.df
+
+        with open(path, "rb") as data_file:
+            self.df = load_dataset(data_file, filetype)
 
         return self.df
 
@@ -213,17 +303,10 @@ class LoadDatasetFromFile(DataPreparationStage):
             content_type, content_string = contents.split(',')
             contents = base64.b64decode(content_string)
 
-        if filename.endswith("csv"):
-            # Assume that the user uploaded a CSV file
-            self.df = ThreeSixtyGiving.from_csv(io.BytesIO(contents)).to_pandas()
-        elif filename.endswith("xls") or filename.endswith("xlsx"):
-            # Assume that the user uploaded an excel file
-            self.df = ThreeSixtyGiving.from_excel(
-                io.BytesIO(contents)).to_pandas()
-        elif filename.endswith("json"):
-            # Assume that the user uploaded a json file
-            self.df = ThreeSixtyGiving.from_json(
-                io.BytesIO(contents)).to_pandas()
+        # Assume that the file type of the upload matches its extension
+        filetype = get_filetype(filename)
+        if filetype:
+            self.df = load_dataset(io.BytesIO(contents), filetype)
 
         return self.df
 
@@ -283,6 +366,7 @@ class AddExtraColumns(DataPreparationStage):
 
     def run(self):
         self.df.loc[:, "Award Date:Year"] = self.df["Award Date"].dt.year
+        self.df.loc[:, "Award Date:Month"] = self.df["Award Date"].dt.strftime("%Y-%m")
         self.df.loc[:, "Recipient Org:0:Identifier:Scheme"] = self.df["Recipient Org:0:Identifier"].apply(
             lambda x: "360G" if x.startswith("360G-") else "-".join(x.split("-")[:2])
         )
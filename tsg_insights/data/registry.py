@@ -1,8 +1,20 @@
+import os
 import json
+import re
+import bisect
+import hashlib
+import datetime
+import tempfile
+from urllib.parse import urlparse
 
+import dateutil.parser
 import requests
+from requests.structures import CaseInsensitiveDict
 import pandas as pd
-import requests_cache
+try:
+    from requests_cache.core import OriginalSession
+except ImportError:
+    from requests_cache.patcher import OriginalSession
 
 from .cache import get_cache
 from .utils import format_currency, get_fileid
@@ -10,21 +22,56 @@ from .utils import format_currency, get_fileid
 THREESIXTY_STATUS_JSON = 'https://storage.googleapis.com/datagetter-360giving-output/branch/master/status.json'
 DEFAULT_CACHE = 60*60*24
 REG_KEY = "threesixty_status"
+REG_VERSION_KEY = "threesixty_status_version"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+USER_AGENTS = {
+    "findthatcharity": 'FindThatCharity.uk',
+    'spoof': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:63.0) Gecko/20100101 Firefox/63.0',
+}
+LAST_MODIFIED_DAYS = {
+    "lastmonth": 30,
+    "6month": 30*6,
+    "12month": 365,
+}
 
-def get_registry(reg_url=THREESIXTY_STATUS_JSON, cache_expire=DEFAULT_CACHE, skip_cache=False):
-    # fetch the 360Giving registry
+# facet index for the registry, rebuilt whenever the cached registry changes
+_REGISTRY_INDEX = {}
+
+def get_uncached_session():
+    # requests_cache replaces `requests.Session` for the whole process, so
+    # downloads that shouldn't be cached use the original session class
+    return OriginalSession()
+
+
+def get_registry_json(reg_url=THREESIXTY_STATUS_JSON, cache_expire=DEFAULT_CACHE, skip_cache=False):
+    # fetch the 360Giving registry as a JSON string
     r = get_cache()
     if not skip_cache:
         reg = r.get(REG_KEY)
-        if reg:
-            return json.loads(reg.decode('utf8'))
+        if reg and r.exists(REG_VERSION_KEY):
+            return reg.decode('utf8')
 
-    with requests_cache.disabled():
-        reg = requests.get(reg_url).json()
-    r.set(REG_KEY, json.dumps(reg), ex=cache_expire)
+    with get_uncached_session() as session:
+        response = session.get(reg_url)
+        reg = json.dumps(response.json())
+    # the version is saved with the registry so the index can be checked
+    # against it without loading the registry
+    version = response.headers.get("ETag") or hashlib.md5(reg.encode("utf8")).hexdigest()
+    r.set(REG_KEY, reg, ex=cache_expire)
+    r.set(REG_VERSION_KEY, version, ex=cache_expire)
     return reg
 
 
+def get_registry_version():
+    version = get_cache().get(REG_VERSION_KEY)
+    return version.decode('utf8') if version else None
+
+
+def get_registry(reg_url=THREESIXTY_STATUS_JSON, cache_expire=DEFAULT_CACHE, skip_cache=False):
+    # fetch the 360Giving registry
+    return json.loads(get_registry_json(reg_url, cache_expire, skip_cache))
+
+
 def process_registry(reg=None, reg_url=THREESIXTY_STATUS_JSON, cache_expire=DEFAULT_CACHE):
     if not reg:
         reg = get_registry(reg_url, cache_expire)
@@ -89,69 +136,191 @@ def get_reg_file_from_url(url):
 
 
 def fetch_reg_file(url, method='GET'):
-    user_agents = {
-        "findthatcharity": 'FindThatCharity.uk',
-        'spoof': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:63.0) Gecko/20100101 Firefox/63.0',
-    }
     if method not in ["GET", "HEAD"]:
         raise ValueError("Request method [{}] not recognised".format(method))
     reg_file = requests.request(
-        method, url, headers={'User-Agent': user_agents['findthatcharity']})
+        method, url, headers={'User-Agent': USER_AGENTS['findthatcharity']})
     try:
         reg_file.raise_for_status()
     except:
         reg_file = requests.request(
-            method, url, headers={'User-Agent': user_agents['spoof']})
+            method, url, headers={'User-Agent': USER_AGENTS['spoof']})
         reg_file.raise_for_status()
     if method=="HEAD":
         return reg_file.headers
     return reg_file.content
 
 
-def get_registry_by_publisher(filters={}, **kwargs):
-    reg = get_registry(**kwargs)
+def download_reg_file(url, validators=None, max_size=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # stream a file to a temporary file on disk, bypassing the http cache
+    #
+    # `validators` are the headers from a previous download of the file. If the
+    # file hasn't changed since then the server can respond with a 304 and
+    # `None` is returned instead of a filename.
+    headers = {}
+    validators = CaseInsensitiveDict(validators or {})
+    if validators.get("ETag"):
+        headers["If-None-Match"] = validators["ETag"]
+    if validators.get("Last-Modified"):
+        headers["If-Modified-Since"] = validators["Last-Modified"]
 
-    reg_ = {}
-    for r in reg:
+    with get_uncached_session() as session:
+        reg_file = session.get(url, stream=True, headers={
+            'User-Agent': USER_AGENTS['findthatcharity'], **headers})
+        try:
+            reg_file.raise_for_status()
+        except:
+            reg_file.close()
+            reg_file = session.get(url, stream=True, headers={
+                'User-Agent': USER_AGENTS['spoof'], **headers})
+            reg_file.raise_for_status()
 
-        p = r.get("publisher", {}).get("name")
+        if reg_file.status_code == 304:
+            reg_file.close()
+            return (None, reg_file.headers)
+
+        if max_size and int(reg_file.headers.get("Content-Length") or 0) > max_size:
+            reg_file.close()
+            raise ValueError("File is larger than the limit of {:,.0f} bytes".format(max_size))
+
+        suffix = os.path.splitext(urlparse(url).path)[1]
+        size = 0
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+            try:
+                for chunk in reg_file.iter_content(chunk_size=chunk_size):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise ValueError("File is larger than the limit of {:,.0f} bytes".format(max_size))
+                    temp_file.write(chunk)
+            except:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+            finally:
+                reg_file.close()
+
+    return (temp_file.name, reg_file.headers)
+
+
+def tokenize(value):
+    return [t for t in re.split(r"[^a-z0-9]+", str(value).lower()) if t]
+
+
+def build_registry_index(reg):
+    # inverted lists of registry positions for each facet value, plus a sorted
+    # array of modified dates and a token index of publisher names
+    index = {
+        "registry": reg,
+        "licence": {},
+        "licence_names": {},
+        "currency": {},
+        "filetype": {},
+        "tokens": {},
+    }
+    modified = []
+    for k, r in enumerate(reg):
+        index["licence"].setdefault(r.get("license", ""), set()).add(k)
+        if r.get("license") not in index["licence_names"]:
+            index["licence_names"][r.get("license")] = r.get("license_name")
 
-        # filter
-        if filters.get("licence"):
-            if r.get("license", "") not in filters["licence"]:
-                continue
-
-        if filters.get("search"):
-            if filters.get("search", "").lower() not in p.lower():
-                continue
-
-        if filters.get("last_modified"):
-            last_modified_poss = {
-                "lastmonth": datetime.datetime.now() - datetime.timedelta(days=30),
-                "6month": datetime.datetime.now() - datetime.timedelta(days=30*6),
-                "12month": datetime.datetime.now() - datetime.timedelta(days=365),
-            }
-            if last_modified_poss.get(filters.get("last_modified")):
-                last_modified = dateutil.parser.parse(
-                    r.get("modified"), ignoretz=True)
-                if last_modified < last_modified_poss.get(filters.get("last_modified")):
-                    continue
-
-        if filters.get("currency"):
-            choose_this = False
-            for c in filters.get("currency", []):
-                if c in r.get("datagetter_aggregates", {}).get("currencies", {}).keys():
-                    choose_this = True
-            if not choose_this:
-                continue
-
-        if filters.get("filetype"):
-            if r.get('datagetter_metadata', {}).get("file_type") not in filters["filetype"]:
-                continue
+        for c in r.get("datagetter_aggregates", {}).get("currencies", {}):
+            index["currency"].setdefault(c, set()).add(k)
 
+        filetype = r.get('datagetter_metadata', {}).get("file_type")
+        index["filetype"].setdefault(filetype, set()).add(k)
+
+        for t in tokenize(r.get("publisher", {}).get("name") or ""):
+            index["tokens"].setdefault(t, set()).add(k)
+
+        if r.get("modified"):
+            modified.append((dateutil.parser.parse(r.get("modified"), ignoretz=True), k))
+
+    modified.sort()
+    index["modified"] = [m[0] for m in modified]
+    index["modified_ids"] = [m[1] for m in modified]
+    index["token_list"] = sorted(index["tokens"].keys())
+    return index
+
+
+def get_registry_index(**kwargs):
+    # the index is replaced in one go, so a request never sees a partly built one
+    global _REGISTRY_INDEX
+    version = get_registry_version()
+    if version is None or kwargs.get("skip_cache") or _REGISTRY_INDEX.get("version") != version:
+        reg = get_registry_json(**kwargs)
+        index = build_registry_index(json.loads(reg))
+        index["version"] = get_registry_version()
+        _REGISTRY_INDEX = index
+    return _REGISTRY_INDEX
+
+
+def _search_tokens(index, search):
+    # every word in the search must be the start of a word in the publisher name
+    result = None
+    for word in tokenize(search):
+        matches = set()
+        pos = bisect.bisect_left(index["token_list"], word)
+        for t in index["token_list"][pos:]:
+            if not t.startswith(word):
+                break
+            matches |= index["tokens"][t]
+        result = matches if result is None else result & matches
+    return result
+
+
+def filter_registry_index(index, filters={}, now=None):
+    # returns the positions in the registry matching the filters and
+    # a count of each facet value. The counts for a facet use all the other
+    # filters but not its own, so they show what choosing each value would give
+    matches = {}
+    for facet in ["licence", "currency", "filetype"]:
+        if filters.get(facet):
+            matches[facet] = set()
+            for v in filters[facet]:
+                matches[facet] |= index[facet].get(v, set())
+
+    if filters.get("search"):
+        search_matches = _search_tokens(index, filters["search"])
+        if search_matches is not None:
+            matches["search"] = search_matches
+
+    if LAST_MODIFIED_DAYS.get(filters.get("last_modified")):
+        now = now or datetime.datetime.now()
+        since = now - datetime.timedelta(days=LAST_MODIFIED_DAYS[filters["last_modified"]])
+        pos = bisect.bisect_left(index["modified"], since)
+        matches["last_modified"] = set(index["modified_ids"][pos:])
+
+    def get_result(exclude=None):
+        result = set(range(len(index["registry"])))
+        for k, ids in matches.items():
+            if k != exclude:
+                result &= ids
+        return result
+
+    facets = {}
+    for facet in ["licence", "currency", "filetype"]:
+        facet_result = get_result(exclude=facet)
+        facets[facet] = {
+            v: len(ids & facet_result) for v, ids in index[facet].items()
+        }
+    return sorted(get_result()), facets
+
+
+def search_registry(filters={}, **kwargs):
+    index = get_registry_index(**kwargs)
+    result, facets = filter_registry_index(index, filters)
+
+    reg_ = {}
+    for k in result:
+        r = index["registry"][k]
+        p = r.get("publisher", {}).get("name")
         if p not in reg_:
             reg_[p] = []
-
         reg_[p].append(r)
 
+    return reg_, facets
+
+
+def get_registry_by_publisher(filters={}, **kwargs):
+    reg_, facets = search_registry(filters, **kwargs)
     return reg_
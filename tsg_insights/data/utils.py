@@ -1,10 +1,18 @@
+import json
+import math
+import datetime
 from flask.json import JSONEncoder
 import hashlib
 import inflect
 import humanize
 import babel.numbers
+import numpy as np
 import pandas as pd
 from requests.structures import CaseInsensitiveDict
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def list_to_string(l, oxford_comma='auto', separator=", ", as_list=False):
@@ -101,27 +109,97 @@ def charity_number_to_org_id(regno):
         return "GB-CHC-{}".format(regno)
 
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, obj):
-        # handling numpy numbers:
-        if isinstance(obj, pd.np.generic):
-            return pd.np.asscalar(obj)
+def array_to_list(values):
+    # convert straight from the numpy array, with missing values as None
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        result = np.datetime_as_string(values, unit='s').astype(object)
+        result[np.isnat(values)] = None
+        return result.tolist()
+    elif values.dtype.kind == 'f':
+        missing = ~np.isfinite(values)
+        if missing.any():
+            result = values.astype(object)
+            result[missing] = None
+            return result.tolist()
+    elif values.dtype.kind == 'O':
+        missing = pd.isnull(values)
+        if missing.any():
+            values = values.copy()
+            values[missing] = None
+    return values.tolist()
+
+
+def to_columns(obj):
+    # series and dataframes are stored as a list of index values and a list
+    # of values for each column. Multiindex values are lists.
+    if isinstance(obj, pd.Series):
+        return {
+            "index": array_to_list(obj.index.values),
+            "values": array_to_list(obj.values),
+        }
+    return {
+        "index": array_to_list(obj.index.values),
+        "columns": {
+            str(c): array_to_list(obj[c].values) for c in obj.columns
+        },
+    }
 
-        # handling pandas dataframes:
-        elif isinstance(obj, (pd.Series, pd.DataFrame)):
 
-            # handling dataframes with multiindex
-            if isinstance(obj.index, pd.core.index.MultiIndex):
-                obj.index = obj.index.map(" - ".join)
-            return obj.to_dict()
+def json_default(obj):
+    # handling numpy numbers and arrays:
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+        if isinstance(obj, float) and not math.isfinite(obj):
+            return None
+        return obj
+    elif isinstance(obj, np.ndarray):
+        return array_to_list(obj)
 
-        # handling request dicts
-        elif isinstance(obj, CaseInsensitiveDict):
-            return dict(obj)
+    # handling pandas series and dataframes:
+    elif isinstance(obj, (pd.Series, pd.DataFrame)):
+        return to_columns(obj)
 
-        else:
-            raise TypeError(
-                "Unserializable object {} of type {}".format(obj, type(obj))
-            )
-        # else let the base class do the work
-        return JSONEncoder.default(self, obj)
+    # handling dates, missing dates are a datetime subclass
+    elif obj is pd.NaT:
+        return None
+    elif isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+
+    # handling request dicts
+    elif isinstance(obj, CaseInsensitiveDict):
+        return dict(obj)
+
+    raise TypeError(
+        "Unserializable object {} of type {}".format(obj, type(obj))
+    )
+
+
+def to_json_types(obj):
+    # converts to types the json module can write, with NaN and infinity as
+    # None in the same way as orjson
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    elif isinstance(obj, (str, int, type(None))):
+        return obj
+    elif isinstance(obj, dict):
+        return {k: to_json_types(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [to_json_types(v) for v in obj]
+    return to_json_types(json_default(obj))
+
+
+def json_dumps(obj):
+    # uses orjson if it's installed. Both give the same output
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            default=json_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        ).decode("utf8")
+    return json.dumps(to_json_types(obj), allow_nan=False, separators=(",", ":"))
+
+
+class CustomJSONEncoder(JSONEncoder):
+    def default(self, obj):
+        return json_default(obj)
@@ -0,0 +1,152 @@
+import os
+import tempfile
+import importlib
+
+import pandas as pd
+import pytest
+
+from tsg_insights import create_app
+from tsg_insights.data.cache import LocalCache, get_object_size, save_arrow_file, load_arrow_file, get_filters_hash, \
+    get_downloads_folder, prune_downloads_cache, save_state_to_cache, get_state_from_cache, RESULTS_CACHE, \
+    save_results_to_cache, get_results_from_cache, get_state_token
+
+
+def test_local_cache():
+    df = pd.DataFrame({"a": range(100)})
+    size = get_object_size(df)
+    cache = LocalCache(max_bytes=size * 2)
+
+    assert cache.get("a", 1) is None
+    cache.set("a", 1, df)
+    assert cache.get("a", 1) is df
+    assert cache.get("a", 2) is None  # version has changed
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+    cache.set("b", 1, df)
+    cache.get("a", 1)
+    cache.set("c", 1, df)  # over budget, so least recently used is removed
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) is df
+    assert cache.get("c", 1) is df
+    assert cache.stats()["bytes"] <= size * 2
+
+    cache.set(("c", "index"), 1, [1, 2, 3])
+    cache.delete_fileid("c")
+    assert cache.get("c", 1) is None
+    assert cache.get(("c", "index"), 1) is None
+
+    # objects bigger than the budget aren't stored
+    cache.set("d", 1, pd.DataFrame({"a": range(1000)}))
+    assert cache.get("d", 1) is None
+
+
+def test_arrow_file():
+    df = pd.DataFrame({
+        "Funding Org:0:Name": ["Funder A", "Funder B", None],
+        "Award Date": pd.to_datetime(["2019-01-01", "2018-06-01", "2017-01-31"]),
+        "Amount Awarded": [100.0, 2000.0, 50.0],
+        "Amount Awarded:Bands": pd.Categorical(["Under £500", "£1k - £2k", "Under £500"]),
+    })
+    filename = os.path.join(tempfile.mkdtemp(), "test.arrow")
+    save_arrow_file(filename, df)
+    result_df = load_arrow_file(filename)
+    assert result_df.equals(df)
+    assert result_df["Amount Awarded:Bands"].dtype.name == "category"
+
+
+def test_arrow_file_failed(monkeypatch):
+    import pyarrow as pa
+
+    def failing_writer(sink, schema):
+        raise pa.ArrowException("failed")
+
+    df = pd.DataFrame({"a": [1, 2]})
+    folder = tempfile.mkdtemp()
+    filename = os.path.join(folder, "test.arrow")
+    save_arrow_file(filename, df)
+    monkeypatch.setattr(pa, "RecordBatchFileWriter", failing_writer)
+    with pytest.raises(pa.ArrowException):
+        save_arrow_file(filename, pd.DataFrame({"a": [3]}))
+    # the temporary file is removed and the earlier file left in place
+    assert os.listdir(folder) == ["test.arrow"]
+    assert load_arrow_file(filename).equals(df)
+
+
+def test_filters_hash():
+    assert get_filters_hash({}) == get_filters_hash(None)
+    assert get_filters_hash({"funders": ["__all"], "area": []}) == get_filters_hash({})
+    assert get_filters_hash({"funders": ["b", "a"]}) == get_filters_hash({"funders": ["a", "b"]})
+    assert get_filters_hash({"funders": ["a"], "award_dates": [2015, 2017]}) == \
+        get_filters_hash({"award_dates": [2015, 2017], "funders": ["a"]})
+    assert get_filters_hash({"funders": ["a"]}) != get_filters_hash({"funders": ["b"]})
+    assert get_filters_hash({"award_dates": [2015, 2017]}) != get_filters_hash({"award_dates": [2015, 2018]})
+
+
+def test_prune_downloads_cache():
+    app = create_app({
+        "UPLOADS_FOLDER": tempfile.mkdtemp(),
+        "DOWNLOADS_CACHE_SIZE": 250,
+        "REQUESTS_CACHE_ON": False,
+    })
+    with app.app_context():
+        folder = get_downloads_folder()
+        for k, name in enumerate(["a.csv", "b.csv", "c.csv", "d.tmp"]):
+            filename = os.path.join(folder, name)
+            with open(filename, "wb") as f:
+                f.write(b"x" * 100)
+            os.utime(filename, (1000 + k, 1000))
+
+        # least recently used are removed first, temporary files are left
+        prune_downloads_cache()
+        assert sorted(os.listdir(folder)) == ["b.csv", "c.csv", "d.tmp"]
+
+
+class DictCache(dict):
+    def set(self, key, value, ex=None):
+        self[key] = value
+
+    def hget(self, name, key):
+        return None
+
+
+def test_state_cache(monkeypatch):
+    cache_module = importlib.import_module("tsg_insights.data.cache")
+
+    redis = DictCache()
+    monkeypatch.setattr(cache_module, "get_cache", lambda: redis)
+    app = create_app({
+        "UPLOADS_FOLDER": tempfile.mkdtemp(),
+        "REQUESTS_CACHE_ON": False,
+    })
+    with app.app_context():
+        state = {"results": {"statistics": {"grants": 2}}}
+        save_state_to_cache("test", "abc", state)
+
+        # the decoded state is kept in the process for each token
+        assert get_state_from_cache("test", "abc") is state
+        RESULTS_CACHE.delete(("test", "state", "abc"))
+        loaded = get_state_from_cache("test", "abc")
+        assert loaded == state and loaded is not state
+        assert get_state_from_cache("test", "abc") is loaded
+        assert get_state_from_cache("test", "def") is None
+
+
+def test_results_version(monkeypatch):
+    cache_module = importlib.import_module("tsg_insights.data.cache")
+    redis = DictCache()
+    monkeypatch.setattr(cache_module, "get_cache", lambda: redis)
+    app = create_app({
+        "UPLOADS_FOLDER": tempfile.mkdtemp(),
+        "REQUESTS_CACHE_ON": False,
+        "RESULTS_CACHE_SIZE": 0,
+    })
+    with app.app_context():
+        save_results_to_cache("test", "funders", {}, {"a": 1})
+        token = get_state_token("test")
+        assert get_results_from_cache("test", "funders", {}) == {"results": {"a": 1}}
+
+        # results saved by an earlier version of the code aren't used
+        monkeypatch.setattr(cache_module, "RESULTS_VERSION", cache_module.RESULTS_VERSION + 1)
+        assert get_results_from_cache("test", "funders", {}) is None
+        assert get_state_token("test") != token
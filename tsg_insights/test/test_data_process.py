@@ -1,4 +1,5 @@
 import os
+import importlib
 import json
 
 import pytest
@@ -319,3 +320,39 @@ def test_add_extra_fields():
     assert result_df.loc[3, "__org_age_bands"] == "Over 25 years"
 
     assert len(result_df["Grant Programme:0:Title"].unique()) == 1
+
+
+def test_save_dataset_indexes_errors(monkeypatch):
+    process = importlib.import_module("tsg_insights.data.process")
+    saved = {}
+
+    def failing_index(df):
+        raise ValueError("failed")
+
+    monkeypatch.setattr(process, "DATASET_INDEXES", {
+        "filters": failing_index,
+        "sort": lambda df: len(df),
+    })
+    monkeypatch.setattr(process, "save_derived_to_cache",
+                        lambda fileid, name, obj: saved.update({name: obj}))
+
+    # an index that fails is skipped and the rest are still saved
+    save_dataset_indexes("test", pd.DataFrame({"a": [1, 2]}))
+    assert saved == {"sort": 2}
+
+
+def test_run_dataset_hooks_errors(monkeypatch):
+    process = importlib.import_module("tsg_insights.data.process")
+    called = []
+
+    def failing_hook(fileid):
+        raise ValueError("failed")
+
+    monkeypatch.setattr(process, "DATASET_HOOKS", {
+        "snapshot": failing_hook,
+        "downloads": called.append,
+    })
+
+    # a hook that fails doesn't stop the others
+    run_dataset_hooks("test")
+    assert called == ["test"]
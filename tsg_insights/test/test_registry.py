@@ -0,0 +1,112 @@
+import os
+import json
+import datetime
+import importlib
+
+import pytest
+import requests_mock
+
+from tsg_insights.data.registry import build_registry_index, filter_registry_index, download_reg_file, \
+    get_registry_index, THREESIXTY_STATUS_JSON, REG_VERSION_KEY
+
+
+@pytest.fixture
+def registry_index():
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(thisdir, "sample_external_apis", "registry.json")) as reg_file:
+        return build_registry_index(json.load(reg_file))
+
+
+def test_registry_index(registry_index):
+    reg = registry_index["registry"]
+    assert sum([len(v) for v in registry_index["filetype"].values()]) == len(reg)
+    assert registry_index["modified"] == sorted(registry_index["modified"])
+    assert "trust" in registry_index["tokens"]
+
+
+def test_filter_registry_index(registry_index):
+    reg = registry_index["registry"]
+
+    result, facets = filter_registry_index(registry_index)
+    assert result == list(range(len(reg)))
+    assert sum(facets["filetype"].values()) == len(reg)
+
+    result, facets = filter_registry_index(registry_index, {"filetype": ["xlsx"]})
+    assert len(result) > 0
+    assert all([reg[k]["datagetter_metadata"]["file_type"] == "xlsx" for k in result])
+    assert facets["filetype"]["xlsx"] == len(result)
+    # the file type counts don't use the file type filter
+    assert facets["filetype"] == filter_registry_index(registry_index)[1]["filetype"]
+
+    result, facets = filter_registry_index(registry_index, {"filetype": ["xlsx"], "currency": ["GBP"]})
+    assert facets["filetype"]["xlsx"] == len(result)
+    assert facets["currency"]["GBP"] == len(result)
+    assert facets["filetype"] == filter_registry_index(registry_index, {"currency": ["GBP"]})[1]["filetype"]
+    assert facets["currency"] == filter_registry_index(registry_index, {"filetype": ["xlsx"]})[1]["currency"]
+
+    result, facets = filter_registry_index(registry_index, {"currency": ["GBP"], "search": "chari"})
+    assert len(result) > 0
+    for k in result:
+        assert "GBP" in reg[k]["datagetter_aggregates"]["currencies"]
+        assert "chari" in reg[k]["publisher"]["name"].lower()
+
+    result, facets = filter_registry_index(registry_index, {"search": "zzzzzz"})
+    assert result == []
+
+    now = max(registry_index["modified"])
+    result, facets = filter_registry_index(
+        registry_index, {"last_modified": "lastmonth"}, now=now)
+    assert len(result) > 0
+    for k in result:
+        modified = registry_index["modified"][registry_index["modified_ids"].index(k)]
+        assert modified >= now - datetime.timedelta(days=30)
+
+
+def test_download_reg_file():
+    url = 'https://findthatcharity.uk/grants/grants.csv'
+    with requests_mock.Mocker() as m:
+        m.get(url, content=b"a,b\n1,2\n", headers={"ETag": "abc"})
+        filename, headers = download_reg_file(url, chunk_size=2)
+        assert filename.endswith(".csv")
+        with open(filename, "rb") as data:
+            assert data.read() == b"a,b\n1,2\n"
+        os.remove(filename)
+        assert headers["ETag"] == "abc"
+
+        with pytest.raises(ValueError):
+            download_reg_file(url, max_size=4, chunk_size=2)
+
+        m.get(url, status_code=304, request_headers={"If-None-Match": "abc"})
+        filename, headers = download_reg_file(url, validators={"etag": "abc"})
+        assert filename is None
+
+
+def test_get_registry_index(monkeypatch):
+    registry = importlib.import_module("tsg_insights.data.registry")
+
+    class DictCache(dict):
+        def set(self, key, value, ex=None):
+            self[key] = value.encode("utf8")
+
+        def exists(self, key):
+            return key in self
+
+    cache = DictCache()
+    monkeypatch.setattr(registry, "get_cache", lambda: cache)
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(thisdir, "sample_external_apis", "registry.json")) as reg_file:
+        reg = reg_file.read()
+
+    with requests_mock.Mocker() as m:
+        m.get(THREESIXTY_STATUS_JSON, text=reg, headers={"ETag": '"v1"'})
+        index = get_registry_index()
+        assert index["version"] == '"v1"'
+        assert len(index["registry"]) == len(json.loads(reg))
+
+        # the index is only rebuilt when the version of the registry changes
+        assert get_registry_index() is index
+        cache.set(REG_VERSION_KEY, '"v2"')
+        new_index = get_registry_index()
+        assert new_index is not index
+        assert new_index["version"] == '"v2"'
+        assert m.call_count == 1
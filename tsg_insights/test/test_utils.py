@@ -1,3 +1,9 @@
+import importlib
+import json
+
+import numpy as np
+import pandas as pd
+
 from tsg_insights.data.utils import *
 
 def test_list_to_string():
@@ -85,3 +91,59 @@ def test_charity_number_to_org_id():
     ]
     for c in charity_numbers:
         assert charity_number_to_org_id(c[0]) == c[1]
+
+
+def test_to_columns():
+    index = pd.MultiIndex.from_tuples([("A", "X"), ("B", "Y")])
+    series = pd.Series([1.5, None], index=index)
+    assert to_columns(series) == {
+        "index": [("A", "X"), ("B", "Y")],
+        "values": [1.5, None],
+    }
+    assert isinstance(series.index, pd.MultiIndex)  # not changed
+
+    df = pd.DataFrame({
+        "a": [1, 2],
+        "b": ["x", None],
+        "c": pd.to_datetime(["2018-01-01", None]),
+    })
+    result = json.loads(json_dumps({"df": df, "n": np.int64(3)}))
+    assert result == {
+        "df": {
+            "index": [0, 1],
+            "columns": {
+                "a": [1, 2],
+                "b": ["x", None],
+                "c": ["2018-01-01T00:00:00", None],
+            },
+        },
+        "n": 3,
+    }
+
+
+def test_json_dumps_non_finite(monkeypatch):
+    utils = importlib.import_module("tsg_insights.data.utils")
+    obj = {
+        "a": float("nan"),
+        "b": [float("inf"), 1.5],
+        "c": np.float64("-inf"),
+        "d": np.array([1.0, np.nan, np.inf]),
+        "e": pd.Series([np.inf, 2.0]),
+        "f": pd.NaT,
+        "g": [pd.Timestamp("2019-01-01"), pd.NaT],
+    }
+    expected = {
+        "a": None,
+        "b": [None, 1.5],
+        "c": None,
+        "d": [1.0, None, None],
+        "e": {"index": [0, 1], "values": [None, 2.0]},
+        "f": None,
+        "g": ["2019-01-01T00:00:00", None],
+    }
+    assert json.loads(json_dumps(obj)) == expected
+
+    # the same output without orjson
+    output = json_dumps(obj)
+    monkeypatch.setattr(utils, "orjson", None)
+    assert json_dumps(obj) == output
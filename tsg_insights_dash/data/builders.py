@@ -0,0 +1,25 @@
+from .filters import build_filter_index, build_options_index
+from .results import build_aggregate_cube
+from .geo import build_geo_index, build_area_index
+from .table import build_sort_index
+from .state import save_dashboard_snapshot
+from .downloads import save_dataset_downloads
+from tsg_insights.data.process import DATASET_INDEXES, DATASET_HOOKS
+
+
+def register_dataset_builders():
+    # indexes built from the dataframe when it's ingested and stored alongside it
+    DATASET_INDEXES.update({
+        "filters": build_filter_index,
+        "options": build_options_index,
+        "cube": build_aggregate_cube,
+        "geo": build_geo_index,
+        "areas": build_area_index,
+        "sort": build_sort_index,
+    })
+    # the unfiltered dashboard is worked out now, as it's what most visits
+    # show first, and then any downloads that are made in advance
+    DATASET_HOOKS.update({
+        "snapshot": save_dashboard_snapshot,
+        "downloads": save_dataset_downloads,
+    })
@@ -4,15 +4,19 @@ import copy
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.graph_objs as go
+import numpy as np
 import pandas as pd
 
-from tsg_insights.data.utils import list_to_string, pluralize, get_unique_list, format_currency
-from .results import CHARTS
+from tsg_insights.data.utils import list_to_string, pluralize, get_unique_list, format_currency, to_columns
+from .results import CHARTS, with_other_values
+from .geo import DEFAULT_ZOOM, DEFAULT_CENTER, AREA_TYPES
+from .table import TABLE_COLUMNS
 
 DEFAULT_TABLE_FIELDS = ["Title", "Description", "Amount Awarded", 
                         "Award Date", "Recipient Org:0:Name", 
                         "Grant Programme:0:Title"]
 THREESIXTY_COLOURS = ['#9c2061', '#f48320', '#cddc2b', '#53aadd']
+CHOROPLETH_COLOURS = ['#f3d9e6', '#e0a3c2', '#c8679a', '#b03c79', '#9c2061']
 DEFAULT_LAYOUT = {
     'font': {
         'family': 'neusa-next-std-compact, "Source Sans Pro", sans-serif;',
@@ -88,12 +92,12 @@ def message_box(title, contents, error=False):
     ])
 
 def get_bar_data(values, name="Grants", chart_type='bar', colour=0):
-    titles = [i[0] for i in values.iteritems()]
-    titles = [" - ".join(get_unique_list(i)) if isinstance(i, (list, tuple)) else i for i in titles]
+    values = to_columns(values)
+    titles = [" - ".join(get_unique_list(i)) if isinstance(i, (list, tuple)) else i for i in values["index"]]
     bar_data = {
         'x': titles, 
-        'y': [i[1] for i in values.iteritems()], 
-        'text': [i[1] for i in values.iteritems()],
+        'y': values["values"], 
+        'text': values["values"],
         'textposition': 'outside',
         'cliponaxis': False,
         'constraintext': 'none',
@@ -137,21 +141,30 @@ def series_to_list(data):
         for i, count in data.iteritems()
     ])
 
-def funder_chart(df):
+def other_values(chart_id, count, label):
+    # the values grouped under "Other" are only fetched when asked for
+    if not count:
+        return []
+    return [
+        html.Button(
+            'Show the other {:,.0f} {}'.format(count, pluralize(label, count)),
+            id='{}-other-button'.format(chart_id),
+            className='results-page__body__section-note',
+        ),
+        html.Div(id='{}-other'.format(chart_id)),
+    ]
+
+def funder_chart(data):
     chart = CHARTS['funders']
-    data = chart['get_results'](df)
     layout = copy.deepcopy(DEFAULT_LAYOUT)
     chart_type = 'bar'
 
+    if data is None:
+        return
+    other_count = data["other_values"]
+    data = with_other_values(data)
     if len(data) <= 1:
         return
-    elif len(data) > 14:
-        return chart_wrapper(
-            series_to_list(data),
-            chart['title'],
-            subtitle=chart.get("units"),
-            description=chart.get("desc"),
-        )
     elif len(data) > 5:
         layout['yaxis']['visible'] = True
         layout['yaxis']['automargin'] = True
@@ -173,28 +186,21 @@ def funder_chart(df):
         chart['title'], 
         subtitle=chart.get("units"),
         description=chart.get("desc"),
+        children=other_values('funders', other_count, 'funder'),
     )
 
 
-def grant_programme_chart(df):
-
-    if "Grant Programme:0:Title" not in df.columns or len(df["Grant Programme:0:Title"].unique()) <= 1:
-        return
-
+def grant_programme_chart(data):
     chart = CHARTS['grant_programmes']
-    data = chart['get_results'](df)
     layout = copy.deepcopy(DEFAULT_LAYOUT)
     chart_type = 'bar'
 
+    if data is None:
+        return
+    other_count = data["other_values"]
+    data = with_other_values(data)
     if len(data) <= 1:
         return
-    elif len(data) > 14:
-        return chart_wrapper(
-            series_to_list(data),
-            chart['title'],
-            subtitle=chart.get("units"),
-            description=chart.get("desc"),
-        )
     elif len(data) > 5:
         layout['yaxis']['visible'] = True
         layout['yaxis']['automargin'] = True
@@ -214,13 +220,13 @@ def grant_programme_chart(df):
         chart['title'], 
         subtitle=chart.get("units"),
         description=chart.get("desc"),
-        children=[chart_n(data.sum(), 'grant')],
+        children=[chart_n(data.sum(), 'grant')] + other_values(
+            'grant_programmes', other_count, 'grant programme'),
     )
 
 
-def amount_awarded_chart(df):
+def amount_awarded_chart(data):
     chart = CHARTS['amount_awarded']
-    data = chart['get_results'](df)
 
     # if("USD" in data.columns):
     #     data.loc[:, "GBP"] = data["USD"]
@@ -262,9 +268,8 @@ def amount_awarded_chart(df):
         children=[chart_n(data.sum().sum(), 'grant')],
     )
 
-def org_identifier_chart(df):
+def org_identifier_chart(data):
     chart = CHARTS['identifier_scheme']
-    data = chart['get_results'](df)
     return chart_wrapper(
         dcc.Graph(
             id="identifier_scheme_chart",
@@ -280,46 +285,46 @@ def org_identifier_chart(df):
         children=[chart_n(data.sum(), 'grant')],
     )
 
-def awards_over_time_chart(df):
+def awards_over_time_chart(data):
+
+    if data is None:
+        return
 
     # check whether all grants were awarded in the same month
-    if df["Award Date"].max().strftime("%Y-%m") == df["Award Date"].min().strftime("%Y-%m"):
+    if data["first"] == data["last"]:
         return message_box(
             'Award Date',
-            'All grants were awarded in {}.'.format(df["Award Date"].min().strftime("%B %Y")),
+            'All grants were awarded in {}.'.format(
+                pd.Period(data["first"], freq="M").strftime("%B %Y")),
             error=False
         )
 
     chart = CHARTS['award_date']
-    data = chart['get_results'](df)
 
-    xbins_sizes = (
-        ('M1', 'by month'),
-        ('M3', 'by quarter'),
-        ('M12', 'by year')
+    bin_sizes = (
+        ('month', 'by month'),
+        ('quarter', 'by quarter'),
+        ('year', 'by year')
     )
 
-    xbins_size = 'M1'
+    bin_size = 'month'
     if (data['max'] - data['min']) >= 5:
-        xbins_size = 'M12'
+        bin_size = 'year'
     elif (data['max'] - data['min']) >= 1:
-        xbins_size = 'M3'
+        bin_size = 'quarter'
 
+    # the counts for each bin size are calculated on the server, and the
+    # buttons switch between them
     chart_data = [dict(
-        x = data['all'],
-        autobinx = False,
-        autobiny=True,
+        x = data[b[0]].index.tolist(),
+        y = data[b[0]].tolist(),
         marker = dict(
             color = THREESIXTY_COLOURS[1],
         ),
         name = 'date',
-        type = 'histogram',
-        xbins = dict(
-            start='{}-01-01'.format(data['min']),
-            end='{}-12-31'.format(data['max']),
-            size=xbins_size,
-        ),
-    )]
+        type = 'bar',
+        visible = (b[0] == bin_size),
+    ) for b in bin_sizes]
 
     updatemenus = [dict(
         x = 0.1,
@@ -327,15 +332,15 @@ def awards_over_time_chart(df):
         xref = 'paper',
         yref = 'paper',
         yanchor = 'top',
-        active=[b[0] for b in xbins_sizes].index(xbins_size),
+        active=[b[0] for b in bin_sizes].index(bin_size),
         showactive = True,
         buttons = [
             dict(
-                args = ['xbins.size', b[0]],
+                args = [{'visible': [b[0] == c[0] for c in bin_sizes]}],
                 label = b[1],
                 method = 'restyle',
             ) 
-            for b in xbins_sizes
+            for b in bin_sizes
         ]
     )]
 
@@ -343,6 +348,7 @@ def awards_over_time_chart(df):
     layout['updatemenus'] = updatemenus
     layout['yaxis']['visible'] = True
     layout['yaxis']['showline'] = False
+    layout['xaxis']['type'] = 'date'
 
     return chart_wrapper(
         dcc.Graph(
@@ -356,15 +362,14 @@ def awards_over_time_chart(df):
         chart['title'], 
         subtitle=chart.get("units"),
         description=chart.get("desc"),
-        children=[chart_n(len(data['all']), 'grant')],
+        children=[chart_n(data['grants'], 'grant')],
     )
 
 
-def region_and_country_chart(df):
+def region_and_country_chart(data):
     chart = CHARTS['ctry_rgn']
-    data = chart['get_results'](df)
 
-    if not isinstance(data, (pd.DataFrame, pd.Series)) or (df["__geo_ctry"].count() + df["__geo_rgn"].count()) == 0:
+    if not isinstance(data, (pd.DataFrame, pd.Series)) or data.index.tolist() == [("Unknown", "Unknown")]:
         return message_box(
             chart["title"],
             chart.get("missing"),
@@ -396,9 +401,8 @@ def region_and_country_chart(df):
     )
 
 
-def organisation_type_chart(df):
+def organisation_type_chart(data):
     chart = CHARTS['org_type']
-    data = chart['get_results'](df)
     title = chart["title"]
     subtitle = chart.get("units")
     description = html.P('''Organisation type is based on official organisation identifiers,
@@ -457,17 +461,16 @@ def organisation_type_chart(df):
     )
 
 
-def organisation_income_chart(df):
+def organisation_income_chart(data):
     chart = CHARTS["org_income"]
 
-    if "__org_latest_income_bands" not in df.columns or df["__org_latest_income_bands"].count() == 0:
+    if data is None or data.sum() == 0:
         return message_box(
             chart["title"],
             chart.get("missing"),
             error=True
         )
 
-    data = chart['get_results'](df)
     return chart_wrapper(
         dcc.Graph(
             id="organisation_income_chart",
@@ -483,16 +486,15 @@ def organisation_income_chart(df):
         children=[chart_n(data.sum(), 'grant')],
     )
 
-def organisation_age_chart(df):
+def organisation_age_chart(data):
     chart = CHARTS["org_age"]
-    if "__org_age_bands" not in df.columns or df["__org_age_bands"].count()==0:
+    if data is None or data.sum() == 0:
         return message_box(
             chart["title"],
             chart.get("missing"),
             error=True
         )
 
-    data = chart['get_results'](df)
     return chart_wrapper(
         dcc.Graph(
             id="organisation_age_chart",
@@ -508,10 +510,9 @@ def organisation_age_chart(df):
         children=[chart_n(data.sum(), 'grant')],
     )
 
-def imd_chart(df):
+def imd_chart(data):
     # @TODO: expand to include non-English IMD too
     chart = CHARTS["org_age"]
-    data = chart['get_results'](df)
     if not data:
         return message_box(
             chart["title"],
@@ -537,100 +538,173 @@ def imd_chart(df):
         children=[chart_n(data.sum(), 'grant')],
     )
 
-def location_map(df, mapbox_access_token=None, mapbox_style=None):
+def map_layout(mapbox_access_token=None, mapbox_style=None, zoom=DEFAULT_ZOOM, center=DEFAULT_CENTER, layers=[]):
+    return go.Layout(
+        autosize=True,
+        height=800,
+        hovermode='closest',
+        mapbox=dict(
+            accesstoken=mapbox_access_token,
+            bearing=0,
+            center=center,
+            pitch=0,
+            zoom=zoom,
+            style=mapbox_style,
+            layers=layers,
+        ),
+        margin=go.layout.Margin(
+            l=0,
+            r=0,
+            b=0,
+            t=0,
+            pad=0
+        ),
+    )
+
+
+def area_map_figure(data, boundaries, mapbox_access_token=None, mapbox_style=None, zoom=DEFAULT_ZOOM, center=DEFAULT_CENTER):
+    # areas are coloured by the number of grants, with a layer for each colour
+    areas = [
+        (name, grants, boundaries["areas"][boundaries["keys"][str(name)]])
+        for name, grants in data.items()
+        if str(name) in boundaries["keys"]
+    ]
+    grants = np.array([a[1] for a in areas])
+    breaks = np.unique(np.percentile(grants, [20, 40, 60, 80])) if len(areas) else []
+    colour_classes = np.searchsorted(breaks, grants, side='left')
+    # use the darkest colours if there are fewer classes
+    colour_classes += len(CHOROPLETH_COLOURS) - len(breaks) - 1
+
+    layers = []
+    for k, colour in enumerate(CHOROPLETH_COLOURS):
+        features = [
+            {"type": "Feature", "geometry": area[2]["geometry"], "properties": {}}
+            for area, colour_class in zip(areas, colour_classes)
+            if colour_class == k
+        ]
+        if features:
+            layers.append(dict(
+                sourcetype='geojson',
+                source={"type": "FeatureCollection", "features": features},
+                type='fill',
+                color=colour,
+                opacity=0.7,
+            ))
+
+    return {
+        "data": [
+            # invisible markers in the middle of each area show the number of grants
+            go.Scattermapbox(
+                lat=[a[2]["centre"]["lat"] for a in areas],
+                lon=[a[2]["centre"]["lon"] for a in areas],
+                mode='markers',
+                marker=dict(
+                    size=12,
+                    opacity=0,
+                ),
+                text=["{} ({:,.0f} {})".format(a[0], a[1], pluralize("grant", a[1])) for a in areas],
+                hoverinfo='text',
+            )
+        ],
+        "layout": map_layout(mapbox_access_token, mapbox_style, zoom, center, layers),
+    }
+
+
+def location_map_figure(data, mapbox_access_token=None, mapbox_style=None, zoom=DEFAULT_ZOOM, center=DEFAULT_CENTER):
+    geo = data["geo"]
+
+    if data["type"] == "clusters":
+        # grid cells with the number of grants in each
+        text = geo["grants"].map("{:,.0f} grants".format)
+        text[geo["grants"] == 1] = "1 grant"
+        marker = dict(
+            size=(np.sqrt(geo["grants"].values.astype(float)) * 4).clip(6, 40),
+            color=THREESIXTY_COLOURS[0],
+            opacity=0.8,
+        )
+    else:
+        popup = geo[data["popup_col"]].astype(str)
+        text = popup.where(
+            geo["grants"] <= 1,
+            popup + " (" + geo["grants"].astype(str) + " grants)"
+        )
+        marker = dict(
+            size=9,
+            color=THREESIXTY_COLOURS[0]
+        )
+
+    layout = map_layout(mapbox_access_token, mapbox_style, zoom, center)
+
+    return {
+        "data": [
+            go.Scattermapbox(
+                lat=geo["__geo_lat"].values,
+                lon=geo["__geo_long"].values,
+                mode='markers',
+                marker=marker,
+                text=text.values,
+                hoverinfo='text',
+            )
+        ],
+        "layout": layout,
+    }
+
+
+def location_map(data, mapbox_access_token=None, mapbox_style=None, area_types=[]):
 
     if not mapbox_access_token:
         return
 
-    if "__geo_lat" not in df.columns or "__geo_long" not in df.columns:
+    if data is None:
         return
 
-    popup_col = 'Recipient Org:0:Name'
-    if popup_col not in df.columns and 'Recipient Org:0:Identifier' in df.columns:
-        popup_col = 'Recipient Org:0:Identifier'
-
-    try:
-        geo = df[["__geo_lat", "__geo_long", popup_col]].dropna()
-        grant_count = len(geo)
-        geo = geo.groupby(["__geo_lat", "__geo_long", popup_col]).size().rename("grants").reset_index()
-    except KeyError as e:
+    if "error" in data:
         return message_box(
             'Location of UK grant recipients',
             [
                 '''An error occured when attempting to show the map. Error: ''',
-                html.Pre(str(e))
+                html.Pre(data["error"])
             ],
             error=True
         )
 
-    if len(geo) == 0:
+    if data["grant_count"] == 0:
         return message_box(
             'Location of UK grant recipients',
             '''Map cannot be shown. No location data is available.''',
             error=True
         )
-        
-    data = [
-        go.Scattermapbox(
-            lat=geo["__geo_lat"].values,
-            lon=geo["__geo_long"].values,
-            mode='markers',
-            marker=dict(
-                size=9,
-                color=THREESIXTY_COLOURS[0]
-            ),
-            text=geo.apply(
-                lambda row: "{} ({} grants)".format(row[popup_col], row['grants']) if row["grants"] > 1 else row[popup_col],
-                axis=1
-            ).values,
-        )
-    ]
-
-    layout = go.Layout(
-        autosize=True,
-        height=800,
-        hovermode='closest',
-        mapbox=dict(
-            accesstoken=mapbox_access_token,
-            bearing=0,
-            center=dict(
-                lat=54.093409,
-                lon=-2.89479
-            ),
-            pitch=0,
-            zoom=5,
-            style=mapbox_style
-        ),
-        margin=go.layout.Margin(
-            l=0,
-            r=0,
-            b=0,
-            t=0,
-            pad=0
-        ),
-    )
 
     return chart_wrapper(
-        dcc.Graph(
-            id='grant_location_chart',
-            figure={"data": data, "layout": layout},
-            config=DEFAULT_CONFIG
-        ),
+        html.Div([
+            # choose to show the grants on the map or the number in each area
+            dcc.RadioItems(
+                id='map-area-type',
+                options=[{"label": "Grant locations", "value": "points"}] + [
+                    {"label": AREA_TYPES[a]["label"], "value": a} for a in area_types
+                ],
+                value='points',
+                labelStyle={'display': 'inline-block', 'marginRight': '12px'},
+                style={} if area_types else {'display': 'none'},
+            ),
+            dcc.Graph(
+                id='grant_location_chart',
+                figure=location_map_figure(data, mapbox_access_token, mapbox_style),
+                config=DEFAULT_CONFIG
+            ),
+        ]),
         'Location of UK grant recipients',
         description='''Showing the location of **{:,.0f}** grants out of {:,.0f}
         
 This map is based on postcodes found in the grants data.
 If postcodes aren’t present, they are sourced from UK
 charity or company registers. Mapping is UK only.'''.format(
-            grant_count, len(df)
+            data["grant_count"], data["total_grants"]
         ),
-        children=[chart_n(geo["grants"].sum(), 'grant')],
+        children=[chart_n(data["grant_count"], 'grant')],
     )
 
-def get_statistics(df):
-    amount_awarded = df.groupby("Currency").sum()["Amount Awarded"]
-    amount_awarded = [format_currency(amount, currency) for currency, amount in amount_awarded.items()]
-
+def get_statistics_output(statistics):
     return html.Div(
         className='results-page__body__content__spheres',
         children=[
@@ -638,16 +712,16 @@ def get_statistics(df):
                 className='results-page__body__content__sphere',
                 style={'backgroundColor': '#9c1f61'},
                 children=[
-                    html.P(className='', children="{:,.0f}".format(len(df))),
-                    html.H4(className='', children=pluralize("grant", len(df)))
+                    html.P(className='', children="{:,.0f}".format(statistics["grants"])),
+                    html.H4(className='', children=pluralize("grant", statistics["grants"]))
                 ]
             ),
             html.Div(
                 className='results-page__body__content__sphere',
                 style={'backgroundColor': '#f4831f'},
                 children=[
-                    html.P(className='', children="{:,.0f}".format(df["Recipient Org:0:Identifier"].unique().size)),
-                    html.H4(className='', children=pluralize("recipient", df["Recipient Org:0:Identifier"].unique().size))
+                    html.P(className='', children="{:,.0f}".format(statistics["recipients"])),
+                    html.H4(className='', children=pluralize("recipient", statistics["recipients"]))
                 ]
             ),
         ] + [
@@ -658,17 +732,23 @@ def get_statistics(df):
                     html.P(className='', children=i[0]),
                     html.H4(className='', children=i[1])
                 ]
-            ) for i in amount_awarded
+            ) for i in statistics["amount_awarded"]
         ]
     )
 
-def get_funder_output(df, grant_programme=[]):
+def get_funder_output(statistics, funders, grant_programme=[]):
     
     funder_class = ''
-    funder_names = sorted(df["Funding Org:0:Name"].unique().tolist())
+    other_count = funders["other_values"]
+    funders = funders["values"]
+    funder_names = sorted(funders.index.tolist())
+    funder_count = statistics.get("funders", len(funder_names) + other_count)
     subtitle = []
-    if len(funder_names)>5:
-        funders = html.Span("{:,.0f} funders".format(len(funder_names)), className=funder_class)
+    if funder_count>5:
+        funders = html.Span("{:,.0f} funders".format(funder_count), className=funder_class)
+        if other_count:
+            funder_names.append("{:,.0f} {}".format(
+                other_count, pluralize("other", other_count)))
         subtitle = [html.Div(className='mt2 gray f4',
                              children=list_to_string(funder_names))]
     else:
@@ -678,10 +758,7 @@ def get_funder_output(df, grant_programme=[]):
             as_list=True
         )
     
-    years = {
-        "max": df["Award Date"].dt.year.max(),
-        "min": df["Award Date"].dt.year.min(),
-    }
+    years = statistics["award_years"]
     if years["max"] == years["min"]:
         years = [
             " in ",
@@ -708,7 +785,7 @@ def get_funder_output(df, grant_programme=[]):
     return_str = [
         html.H5(
             className='results-page__body__content__grants-made-by',
-            children="{} made by ".format(pluralize("Grant", len(df)))
+            children="{} made by ".format(pluralize("Grant", statistics["grants"]))
         ),
         html.H1(
             className='results-page__body__content__header',
@@ -776,3 +853,38 @@ def get_file_output(metadata):
     ]
 
     
+
+
+def format_table_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return ""
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%d %b %Y")
+    if isinstance(value, (int, float, np.number)):
+        return "{:,.0f}".format(value)
+    return str(value)
+
+
+def grants_table(page):
+    # one page of grants from `get_table_page`
+    if page is None or not page["rows"]:
+        return [html.P(className='results-page__body__section-note', children='No grants found.')]
+
+    grants = page["grants"]
+    return [
+        html.Table(className='results-page__body__table', children=[
+            html.Thead(html.Tr([
+                html.Th(TABLE_COLUMNS[c]) for c in grants.columns
+            ])),
+            html.Tbody([
+                html.Tr([html.Td(format_table_value(v)) for v in row])
+                for row in grants.itertuples(index=False)
+            ]),
+        ]),
+        html.P(className='results-page__body__section-note', children='Showing {:,.0f} to {:,.0f} of {:,.0f} {}.'.format(
+            page["offset"] + 1,
+            page["offset"] + len(grants),
+            page["rows"],
+            pluralize("grant", page["rows"]),
+        )),
+    ]
@@ -0,0 +1,221 @@
+import os
+import logging
+
+from flask import current_app
+import xlsxwriter
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .filters import get_filtered_df
+from tsg_insights.data.cache import get_download_temp_filename, get_download_from_cache, save_download_to_cache, \
+    get_downloads_cache_size
+
+# number of rows written at a time when creating downloads
+DOWNLOAD_CHUNK_SIZE = 1000
+
+DOWNLOAD_EXCLUDE_FIELDS = [
+    'Recipient Org:0:Identifier:Scheme',
+    'Recipient Org:0:Identifier:Clean',
+    '__org_orgid',
+    '__org_charity_number',
+    '__org_company_number',
+    # '__geo_ctry',
+    # '__geo_cty',
+    # '__geo_laua',
+    # '__geo_pcon',
+    # '__geo_rgn',
+    '__geo_imd',
+    '__geo_ru11ind',
+    '__geo_oac11',
+    # '__geo_lat',
+    # '__geo_long',
+]
+
+DOWNLOAD_COLUMN_RENAMES = {
+    "__org_date_registered": "Insights:Recipient Org:Date Registered",
+    "__org_date_removed": "Insights:Recipient Org:Date Removed",
+    "__org_latest_income": "Insights:Recipient Org:Latest Income",
+    "__org_latest_income_bands": "Insights:Recipient Org:Latest Income:Bands",
+    "__org_org_type": "Insights:Recipient Org:Organisation Type",
+    "__org_postcode": "Insights:Recipient Org:Postcode",
+    "__org_age": "Insights:Recipient Org:Age",
+    "__org_age_bands": "Insights:Recipient Org:Age:Bands",
+    "__geo_ctry": "Insights:Geo:Country",
+    "__geo_cty": "Insights:Geo:County",
+    "__geo_laua": "Insights:Geo:Local Authority",
+    "__geo_pcon": "Insights:Geo:Parliamentary Constituency",
+    "__geo_rgn": "Insights:Geo:Region",
+    "__geo_lat": "Insights:Geo:Latitude",
+    "__geo_long": "Insights:Geo:Longitude",
+    "Award Date:Year": "Insights:Award Date:Year",
+    "Award Date:Month": "Insights:Award Date:Month",
+    "Amount Awarded:Bands": "Insights:Amount Awarded:Bands",
+}
+
+
+def get_download_df(fileid, filters):
+    df = get_filtered_df(fileid, **filters)
+    if df is None:
+        return None
+    columns = [c for c in df.columns if c not in DOWNLOAD_EXCLUDE_FIELDS]
+    return df[columns].rename(columns=DOWNLOAD_COLUMN_RENAMES)
+
+
+def generate_csv(df, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # write the CSV a chunk of rows at a time rather than all at once
+    yield df.iloc[0:0].to_csv(index=False)
+    for i in range(0, len(df), chunk_size):
+        yield df.iloc[i:i + chunk_size].to_csv(index=False, header=False)
+
+
+def write_xlsx(df, filename, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # in constant memory mode xlsxwriter flushes each row to disk once it's written
+    workbook = xlsxwriter.Workbook(filename, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd',
+        'strings_to_urls': False,
+    })
+    worksheet = workbook.add_worksheet('grants')
+    worksheet.write_row(0, 0, [str(c) for c in df.columns])
+    for i in range(0, len(df), chunk_size):
+        chunk = df.iloc[i:i + chunk_size]
+        chunk = chunk.astype(object).where(chunk.notnull(), None)
+        for k, row in enumerate(chunk.itertuples(index=False)):
+            worksheet.write_row(i + k + 1, 0, row)
+    workbook.close()
+
+
+def generate_ndjson(df, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # one JSON object for each grant on each line
+    for i in range(0, len(df), chunk_size):
+        yield df.iloc[i:i + chunk_size].to_json(
+            orient="records", lines=True, date_format="iso").rstrip("\n") + "\n"
+
+
+def generate_json(df, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    # a list of grants, produced in the same way as the ndjson
+    yield "["
+    for i in range(0, len(df), chunk_size):
+        records = df.iloc[i:i + chunk_size].to_json(orient="records", date_format="iso")
+        yield ("," if i else "") + records[1:-1]
+    yield "]"
+
+
+def get_arrow_table(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        # columns with mixed types are converted to strings
+        df = df.copy()
+        for c in df.columns:
+            if df[c].dtype == object:
+                df[c] = df[c].where(df[c].isnull(), df[c].astype(str))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_parquet(df, filename):
+    pq.write_table(get_arrow_table(df), filename,
+                   row_group_size=DOWNLOAD_CHUNK_SIZE * 100)
+
+
+def write_arrow(df, filename):
+    table = get_arrow_table(df)
+    with pa.OSFile(filename, "wb") as sink:
+        writer = pa.RecordBatchFileWriter(sink, table.schema)
+        for batch in table.to_batches(DOWNLOAD_CHUNK_SIZE * 100):
+            writer.write_batch(batch)
+        writer.close()
+
+
+def remove_file(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+# formats are either generated in chunks (`generate`) or written to a
+# temporary file which is then sent (`write`)
+DOWNLOAD_FORMATS = {
+    "csv": {
+        "mimetype": "text/csv",
+        "generate": generate_csv,
+    },
+    "xlsx": {
+        "mimetype": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "write": write_xlsx,
+    },
+    "json": {
+        "mimetype": "application/json",
+        "generate": generate_json,
+    },
+    "ndjson": {
+        "mimetype": "application/x-ndjson",
+        "generate": generate_ndjson,
+    },
+    "parquet": {
+        "mimetype": "application/octet-stream",
+        "write": write_parquet,
+        "requires_arrow": True,
+    },
+    "arrow": {
+        "mimetype": "application/vnd.apache.arrow.file",
+        "write": write_arrow,
+        "requires_arrow": True,
+    },
+}
+
+
+def download_format_available(format):
+    if format not in DOWNLOAD_FORMATS:
+        return False
+    return pa is not None or not DOWNLOAD_FORMATS[format].get("requires_arrow")
+
+
+def generate_and_save(chunks, fileid, format, filters):
+    # send each chunk as it's made and save the complete file to the cache
+    # the temporary file is removed if anything fails before it's moved into place
+    temp_filename = get_download_temp_filename()
+    try:
+        with open(temp_filename, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk.encode("utf8"))
+                yield chunk
+        save_download_to_cache(fileid, format, filters, temp_filename)
+    finally:
+        remove_file(temp_filename)
+
+
+def build_download(fileid, format, filters={}, df=None):
+    # create a download file in the cache, returns the filename
+    download_format = DOWNLOAD_FORMATS[format]
+    if df is None:
+        df = get_download_df(fileid, filters)
+        if df is None:
+            return None
+
+    if "generate" in download_format:
+        for chunk in generate_and_save(download_format["generate"](df), fileid, format, filters):
+            pass
+        return get_download_from_cache(fileid, format, filters)
+
+    temp_filename = get_download_temp_filename()
+    try:
+        download_format["write"](df, temp_filename)
+        return save_download_to_cache(fileid, format, filters, temp_filename)
+    finally:
+        remove_file(temp_filename)
+
+
+def save_dataset_downloads(fileid):
+    # create download files for the whole dataset so they're ready to send
+    if not get_downloads_cache_size():
+        return
+    for format in current_app.config.get("DOWNLOADS_PREBUILD") or []:
+        if not download_format_available(format):
+            continue
+        try:
+            build_download(fileid, format)
+        except Exception:
+            logging.exception("Download [{}] for dataframe [{}] failed".format(format, fileid))
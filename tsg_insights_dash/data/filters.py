@@ -1,20 +1,455 @@
-from .results import get_identifier_schemes, AGE_BAND_CHANGES, AWARD_BAND_CHANGES, INCOME_BAND_CHANGES
-from tsg_insights.data.cache import get_from_cache
+import re
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from .results import get_identifier_schemes, build_aggregate_cube, CUBE_ROLLUPS, AGE_BAND_CHANGES, AWARD_BAND_CHANGES, INCOME_BAND_CHANGES
+from tsg_insights.data.cache import get_from_cache, get_derived_from_cache, save_derived_to_cache, \
+    get_results_from_cache, save_results_to_cache, dataset_available
+
+# fields with more values than this are filtered using the category codes
+# rather than keeping a bitmap for every value
+BITMAP_MAX_VALUES = 256
+
+# words used by the text search
+TEXT_TOKEN_REGEX = re.compile(r"\w+")
+
+# number of bits set in each byte, used to count the rows in a bitmap
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# filters with lots of options only send the most common ones to the
+# dashboard, the rest are found by searching
+FILTER_OPTIONS_LIMIT = 50
 
 
 def get_filtered_df(fileid, **filters):
     df = get_from_cache(fileid)
+    if df is None:
+        return df
+
+    index = get_filter_index(fileid, df)
+    rows = get_filtered_rows(index, **filters)
+    if rows is None:
+        return df
+    return df.take(rows)
+
+
+def get_filtered_results(fileid, results, **filters):
+    # `results` is a dict of definitions like those in CHARTS, with a
+    # `get_results` function that takes the filtered dataframe and an optional
+    # `get_cube_results` function that takes the filtered aggregate cube.
+    # Results are cached for each filter state so the dataframe is only
+    # loaded if something hasn't been calculated before
+    if not dataset_available(fileid):
+        return None
+
+    df = None
+    cube = None
+    output = {}
+    for result_id, result_def in results.items():
+        cached = get_results_from_cache(fileid, result_id, filters)
+        if cached is not None:
+            output[result_id] = cached["results"]
+            continue
+
+        if result_def.get("get_cube_results"):
+            if cube is None:
+                cube = get_filtered_cube(fileid, **filters)
+            if cube is not False:
+                output[result_id] = result_def["get_cube_results"](cube)
+                save_results_to_cache(fileid, result_id, filters, output[result_id])
+                continue
+
+        if df is None:
+            df = get_filtered_df(fileid, **filters)
+            if df is None:
+                return None
+        output[result_id] = result_def["get_results"](df)
+        save_results_to_cache(fileid, result_id, filters, output[result_id])
+
+    return output
+
+
+def get_aggregate_cube(fileid):
+    # fetch the aggregate cube for a dataset, creating it if it's not been made
+    # yet or was made before the chart fields were rolled up
+    cube = get_derived_from_cache(fileid, "cube")
+    if cube is None or "{}:values".format(CUBE_ROLLUPS[0]) not in cube.columns:
+        df = get_from_cache(fileid)
+        if df is None:
+            return None
+        cube = build_aggregate_cube(df)
+        save_derived_to_cache(fileid, "cube", cube)
+    return cube
+
+
+def get_filtered_cube(fileid, **filters):
+    # returns False if the filters can't be applied to the cube
+    cube = get_aggregate_cube(fileid)
+    if cube is None:
+        return False
+
+    for filter_id, filter_def in FILTERS.items():
+        try:
+            new_cube = filter_def["apply_filter"](
+                cube,
+                filters.get(filter_id),
+                filter_def
+            )
+        except KeyError:
+            # the field used by the filter isn't part of the cube
+            return False
+        if new_cube is not None:
+            cube = new_cube
+
+    return cube
+
+
+def get_filter_index(fileid, df=None):
+    # fetch the filter index for a dataset, creating it if it's not been made yet
+    index = get_derived_from_cache(fileid, "filters")
+    if index is None or (df is not None and index["rows"] != len(df)):
+        if df is None:
+            df = get_from_cache(fileid)
+            if df is None:
+                return None
+        index = build_filter_index(df)
+        save_derived_to_cache(fileid, "filters", index)
+    return index
+
+
+def build_filter_index(df):
+    index = {
+        "rows": len(df),
+        "filters": {},
+    }
+    for filter_id, filter_def in FILTERS.items():
+        if filter_def.get("build_index"):
+            index["filters"][filter_id] = filter_def["build_index"](df, filter_def)
+    return index
+
+
+def build_field_options(df, filter_def):
+    # the options for a filter (most common first) with a sorted list of
+    # the words in each option, so options can be searched by word prefix
+    if filter_def["field"] not in df.columns:
+        return None
+    options = filter_def["get_values"](df)
+    keys = []
+    positions = []
+    for position, option in enumerate(options):
+        value = str(option["value"]).lower()
+        for word in TEXT_TOKEN_REGEX.finditer(value):
+            keys.append(value[word.start():])
+            positions.append(position)
+    order = np.argsort(np.array(keys, dtype=object), kind="mergesort")
+    return {
+        "options": options,
+        "keys": np.array(keys, dtype=object)[order],
+        "positions": np.array(positions, dtype=np.int32)[order],
+    }
+
+
+def build_options_index(df):
+    return {
+        filter_id: filter_def["build_options"](df, filter_def)
+        for filter_id, filter_def in FILTERS.items()
+        if filter_def.get("build_options")
+    }
+
+
+def get_options_index(fileid, df=None):
+    # fetch the filter options for a dataset, creating them if they've not been made yet
+    index = get_derived_from_cache(fileid, "options")
+    if index is None:
+        df = get_from_cache(fileid) if df is None else df
+        if df is None:
+            return None
+        index = build_options_index(df)
+        save_derived_to_cache(fileid, "options", index)
+    return index
+
+
+def search_filter_options(index, search=None, limit=FILTER_OPTIONS_LIMIT):
+    # the most common options with a word starting with each word searched for
+    if not index:
+        return []
+    positions = None
+    for token in get_text_tokens(search or ""):
+        start = np.searchsorted(index["keys"], token, side="left")
+        end = np.searchsorted(index["keys"], token + "\uffff", side="left")
+        matches = np.unique(index["positions"][start:end])
+        positions = matches if positions is None else np.intersect1d(positions, matches)
+    if positions is None:
+        return index["options"][:limit]
+    return [index["options"][p] for p in positions[:limit]]
+
+
+def get_filter_options(fileid):
+    # the options for each filter, which only change with the dataset. Filters
+    # with lots of options only get the most common ones
+    snapshot = get_derived_from_cache(fileid, "snapshot")
+    if snapshot is not None and snapshot["options"] is not None:
+        return snapshot["options"]
+    cached = get_results_from_cache(fileid, "filter_options", {})
+    if cached is not None:
+        return cached["results"]
+
+    df = get_from_cache(fileid)
+    if df is None:
+        return None
+    index = get_options_index(fileid, df)
+    options = {
+        filter_id: search_filter_options(index[filter_id])
+        if filter_id in index else filter_def["get_values"](df)
+        for filter_id, filter_def in FILTERS.items()
+    }
+    save_results_to_cache(fileid, "filter_options", {}, options)
+    return options
+
+
+def get_filter_mask(index, **filters):
+    # combine the bitmaps for each filter, returns None if nothing is filtered
+    mask = None
+    for filter_id, filter_def in FILTERS.items():
+        if filter_id not in index["filters"]:
+            continue
+        bitmap = filter_def["apply_index"](
+            index["filters"][filter_id],
+            filters.get(filter_id),
+            filter_def
+        )
+        if bitmap is not None:
+            mask = bitmap if mask is None else np.bitwise_and(mask, bitmap)
+    return mask
+
 
+def get_facet_counts(index, **filters):
+    # for each filter, the number of rows with each of its options once all
+    # the other filters have been applied
+    bitmaps = {}
     for filter_id, filter_def in FILTERS.items():
-        new_df = filter_def["apply_filter"](
-            df,
+        if filter_id not in index["filters"]:
+            continue
+        bitmap = filter_def["apply_index"](
+            index["filters"][filter_id],
             filters.get(filter_id),
             filter_def
         )
-        if new_df is not None:
-            df = new_df
+        if bitmap is not None:
+            bitmaps[filter_id] = bitmap
+
+    facets = {}
+    for filter_id, filter_def in FILTERS.items():
+        if not filter_def.get("get_facets") or not index["filters"].get(filter_id):
+            continue
+        mask = None
+        for other_id, bitmap in bitmaps.items():
+            if other_id != filter_id:
+                mask = bitmap if mask is None else np.bitwise_and(mask, bitmap)
+        facets[filter_id] = filter_def["get_facets"](
+            index["filters"][filter_id], mask, index["rows"])
+    return facets
+
+
+def get_filter_counts(fileid, **filters):
+    # facet counts are cached alongside the other results for these filters
+    if not dataset_available(fileid):
+        return None
+    cached = get_results_from_cache(fileid, "facets", filters)
+    if cached is not None:
+        return cached["results"]
+
+    index = get_filter_index(fileid)
+    if index is None:
+        return None
+    facets = get_facet_counts(index, **filters)
+    save_results_to_cache(fileid, "facets", filters, facets)
+    return facets
+
+
+def get_filtered_rows(index, **filters):
+    mask = get_filter_mask(index, **filters)
+    if mask is None:
+        return None
+    return np.flatnonzero(from_bitmap(mask, index["rows"]))
+
+
+def check_filter(filter_id, values):
+    # raises a ValueError if the values can't be used with the filter
+    if filter_id not in FILTERS:
+        raise ValueError("Filter [{}] not recognised".format(filter_id))
+    filter_type = FILTERS[filter_id].get("type")
+    if filter_type == 'text':
+        if not isinstance(values, str):
+            raise ValueError("Filter [{}] should be a string".format(filter_id))
+    elif filter_type == 'rangeslider':
+        if not isinstance(values, list) or len(values) != 2 or \
+                not all([isinstance(v, int) and not isinstance(v, bool) for v in values]):
+            raise ValueError("Filter [{}] should be a list of two numbers".format(filter_id))
+    elif not isinstance(values, list) or not all([isinstance(v, str) for v in values]):
+        raise ValueError("Filter [{}] should be a list of strings".format(filter_id))
+
+
+def to_bitmap(values):
+    return np.packbits(values)
+
+
+def from_bitmap(bitmap, rows):
+    return np.unpackbits(bitmap)[:rows].astype(bool)
+
 
-    return df
+def build_field_index(df, filter_def, field=None):
+    field = field or filter_def["field"]
+    if field not in df.columns:
+        return None
+    codes, values = pd.factorize(df[field])
+    values = list(values)
+    index = {
+        "codes": codes.astype(np.int32),
+        "values": {v: k for k, v in enumerate(values)},
+        "bitmaps": None,
+    }
+    if len(values) <= BITMAP_MAX_VALUES:
+        index["bitmaps"] = [to_bitmap(codes == k) for k in range(len(values))]
+    return index
+
+
+def count_bitmap(bitmap):
+    return int(POPCOUNT[bitmap].sum())
+
+
+def get_field_facets(index, mask, rows):
+    # number of rows with each value of a field, out of the rows in the mask
+    if index["bitmaps"] is not None:
+        if mask is not None:
+            counts = [count_bitmap(np.bitwise_and(b, mask)) for b in index["bitmaps"]]
+        else:
+            counts = [count_bitmap(b) for b in index["bitmaps"]]
+    else:
+        codes = index["codes"] if mask is None else index["codes"][from_bitmap(mask, rows)]
+        counts = np.bincount(codes[codes >= 0], minlength=len(index["values"]))
+    return {str(v): int(counts[k]) for v, k in index["values"].items()}
+
+
+def get_area_facets(index, mask, rows):
+    # number of rows in each country and region, missing values are "Unknown"
+    if not index["countries"] or not index["regions"]:
+        return None
+    countries = list(index["countries"]["values"]) + ["Unknown"]
+    regions = list(index["regions"]["values"]) + ["Unknown"]
+    country_codes = index["countries"]["codes"]
+    region_codes = index["regions"]["codes"]
+    if mask is not None:
+        selected = from_bitmap(mask, rows)
+        country_codes = country_codes[selected]
+        region_codes = region_codes[selected]
+    # missing values have a code of -1, so get the last value
+    pairs = (country_codes % len(countries)).astype(np.int64) * len(regions) + \
+        region_codes % len(regions)
+    counts = np.bincount(pairs, minlength=len(countries) * len(regions))
+    return {
+        "{}##{}".format(countries[pair // len(regions)], regions[pair % len(regions)]): int(counts[pair])
+        for pair in np.flatnonzero(counts)
+    }
+
+
+def get_field_bitmap(index, values):
+    codes = [index["values"][v] for v in values if v in index["values"]]
+    if index["bitmaps"] is not None:
+        bitmap = np.zeros_like(to_bitmap(index["codes"] < 0))
+        for c in codes:
+            bitmap = np.bitwise_or(bitmap, index["bitmaps"][c])
+        return bitmap
+    return to_bitmap(np.isin(index["codes"], codes))
+
+
+def build_area_index(df, filter_def):
+    return {
+        "countries": build_field_index(df, filter_def, "__geo_ctry"),
+        "regions": build_field_index(df, filter_def, "__geo_rgn"),
+    }
+
+
+def build_range_index(df, filter_def):
+    if filter_def["field"] not in df.columns:
+        return None
+    return {
+        "values": df[filter_def["field"]].values,
+    }
+
+
+def get_text_tokens(text):
+    return TEXT_TOKEN_REGEX.findall(str(text).lower())
+
+
+def build_text_index(df, filter_def):
+    # an inverted index from each word to the rows it appears in. Words are
+    # kept in sorted order so words starting with a prefix are next to each other
+    fields = [f for f in filter_def["fields"] if f in df.columns]
+    if not fields:
+        return None
+
+    rows = []
+    tokens = []
+    for field in fields:
+        field_tokens = df[field].fillna("").astype(str).str.lower().str.findall(TEXT_TOKEN_REGEX)
+        rows.append(np.repeat(np.arange(len(df)), field_tokens.str.len().values))
+        tokens.extend(itertools.chain.from_iterable(field_tokens.values))
+    if not tokens:
+        return None
+    rows = np.concatenate(rows)
+
+    codes, words = pd.factorize(np.array(tokens, dtype=object), sort=True)
+    # each word is only recorded once for each row
+    postings = np.unique(codes.astype(np.int64) * len(df) + rows)
+    codes = postings // len(df)
+    return {
+        "words": np.array(words, dtype=object),
+        "offsets": np.searchsorted(codes, np.arange(len(words) + 1)).astype(np.int64),
+        "rows": (postings % len(df)).astype(np.int32),
+        "length": len(df),
+    }
+
+
+def apply_text_filter(df, filter_args, filter_def):
+    # slower version of the text index, using every word as a prefix
+    if not filter_args or df is None:
+        return
+
+    tokens = get_text_tokens(filter_args)
+    if not tokens:
+        return
+
+    text = df[filter_def["fields"][0]].fillna("").astype(str)
+    for field in filter_def["fields"][1:]:
+        if field in df.columns:
+            text = text + " " + df[field].fillna("").astype(str)
+    text = " " + text.str.lower()
+    mask = np.ones(len(df), dtype=bool)
+    for token in tokens:
+        mask &= text.str.contains(r"\W" + re.escape(token)).values
+    return df[mask]
+
+
+def apply_text_index(index, filter_args, filter_def):
+    # every word has to match the start of a word in the grant
+    if not filter_args or not index:
+        return
+
+    tokens = get_text_tokens(filter_args)
+    if not tokens:
+        return
+
+    mask = np.ones(index["length"], dtype=bool)
+    for token in tokens:
+        start = np.searchsorted(index["words"], token, side="left")
+        end = np.searchsorted(index["words"], token + "\uffff", side="left")
+        token_mask = np.zeros(index["length"], dtype=bool)
+        token_mask[index["rows"][index["offsets"][start]:index["offsets"][end]]] = True
+        mask &= token_mask
+    return to_bitmap(mask)
 
 
 def apply_area_filter(df, filter_args, filter_def):
@@ -63,6 +498,46 @@ def apply_range_filter(df, filter_args, filter_def):
         (df[filter_def["field"]] <= filter_args[1])
     ]
 
+
+def apply_area_index(index, filter_args, filter_def):
+
+    if not filter_args or filter_args == ['__all']:
+        return
+
+    if not index["countries"] or not index["regions"]:
+        return
+
+    countries = []
+    regions = []
+    for f in filter_args:
+        if "##" in f:
+            f = f.split('##')
+            countries.append(f[0])
+            regions.append(f[1])
+    if countries and regions:
+        return np.bitwise_and(
+            get_field_bitmap(index["countries"], countries),
+            get_field_bitmap(index["regions"], regions),
+        )
+
+
+def apply_field_index(index, filter_args, filter_def):
+
+    if not filter_args or filter_args == ['__all'] or not index:
+        return
+
+    return get_field_bitmap(index, filter_args)
+
+
+def apply_range_index(index, filter_args, filter_def):
+    if not filter_args or not index:
+        return
+
+    return to_bitmap(
+        (index["values"] >= filter_args[0]) &
+        (index["values"] <= filter_args[1])
+    )
+
 FILTERS = {
     "funders": {
         "label": "Funders",
@@ -76,6 +551,10 @@ FILTERS = {
         ]),
         "field": "Funding Org:0:Name",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
+        "build_options": build_field_options,
     },
     "grant_programmes": {
         "label": "Grant programmes",
@@ -89,17 +568,23 @@ FILTERS = {
         ]),
         "field": "Grant Programme:0:Title",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
+        "build_options": build_field_options,
     },
     "award_dates": {
         "label": "Date awarded",
         "type": "rangeslider",
         "defaults": {"min": 2015, "max": 2018},
         "get_values": (lambda df: {
-            "min": int(df["Award Date"].dt.year.min()),
-            "max": int(df["Award Date"].dt.year.max()),
+            "min": int(df["Award Date:Year"].min()),
+            "max": int(df["Award Date:Year"].max()),
         }),
-        "field": "Award Date",
-        "apply_filter": apply_date_range_filter,
+        "field": "Award Date:Year",
+        "apply_filter": apply_range_filter,
+        "build_index": build_range_index,
+        "apply_index": apply_range_index,
     },
     "area": {
         "label": "Region and country",
@@ -116,6 +601,9 @@ FILTERS = {
             } for value, count in df.fillna({"__geo_ctry": "Unknown", "__geo_rgn": "Unknown"}).groupby(["__geo_ctry", "__geo_rgn"]).size().iteritems()
         ]),
         "apply_filter": apply_area_filter,
+        "build_index": build_area_index,
+        "apply_index": apply_area_index,
+        "get_facets": get_area_facets,
     },
     "orgtype": {
         "label": "Organisation type",
@@ -129,6 +617,9 @@ FILTERS = {
         ]),
         "field": "__org_org_type",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
     },
     "award_amount": {
         "label": "Amount awarded",
@@ -142,6 +633,9 @@ FILTERS = {
         ]),
         "field": "Amount Awarded:Bands",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
     },
     "org_size": {
         "label": "Organisation size",
@@ -155,6 +649,9 @@ FILTERS = {
         ] if df["__org_latest_income_bands"].value_counts().sum() else []),
         "field": "__org_latest_income_bands",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
     },
     "org_age": {
         "label": "Organisation age",
@@ -168,5 +665,18 @@ FILTERS = {
         ] if df["__org_age_bands"].value_counts().sum() else []),
         "field": "__org_age_bands",
         "apply_filter": apply_field_filter,
+        "build_index": build_field_index,
+        "apply_index": apply_field_index,
+        "get_facets": get_field_facets,
+    },
+    "search": {
+        "label": "Search",
+        "type": "text",
+        "defaults": "",
+        "get_values": (lambda df: ""),
+        "fields": ["Title", "Description", "Recipient Org:0:Name"],
+        "apply_filter": apply_text_filter,
+        "build_index": build_text_index,
+        "apply_index": apply_text_index,
     },
 }
@@ -0,0 +1,442 @@
+import os
+import math
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from .filters import get_filter_index, get_filtered_rows, get_filtered_results
+from .results import get_location_data
+from tsg_insights.data.utils import json_dumps
+from tsg_insights.data.cache import get_from_cache, get_derived_from_cache, save_derived_to_cache, \
+    get_results_from_cache, save_results_to_cache, dataset_available
+
+# grants are grouped into grid cells below this zoom level, and shown
+# individually when zoomed in further
+POINTS_ZOOM = 10
+MIN_ZOOM = 3
+
+# number of grid cells across each 256 pixel map tile
+CELLS_PER_TILE = 4
+
+# roughly how many tiles across the map is, used to work out which points
+# are in view
+VIEWPORT_TILES = 6
+
+# zoom level of the grid used to find the grants within a bounding box
+BBOX_INDEX_ZOOM = POINTS_ZOOM - 1
+
+DEFAULT_CENTER = dict(
+    lat=54.093409,
+    lon=-2.89479
+)
+DEFAULT_ZOOM = 5
+
+# areas that grants can be mapped by, with the boundary file for each area
+# found in the BOUNDARIES_FOLDER
+AREA_TYPES = {
+    "rgn": {
+        "label": "Region",
+        "field": "__geo_rgn",
+        "boundaries": "rgn.geojson",
+    },
+    "laua": {
+        "label": "Local authority",
+        "field": "__geo_laua",
+        "boundaries": "laua.geojson",
+    },
+    "pcon": {
+        "label": "Parliamentary constituency",
+        "field": "__geo_pcon",
+        "boundaries": "pcon.geojson",
+    },
+}
+
+# boundaries are simplified for each of these zoom levels
+BOUNDARY_ZOOM_LEVELS = [4, 6, 8, 10]
+
+# boundaries for this process, keyed by (area type, zoom level)
+BOUNDARIES = {}
+
+
+def get_zoom_level(zoom):
+    zoom = DEFAULT_ZOOM if zoom is None else zoom
+    return int(min(max(math.floor(zoom), MIN_ZOOM), POINTS_ZOOM))
+
+
+def get_grid_xy(lat, lon, zoom):
+    # position of each point on the web mercator grid used by the map tiles
+    size = (2 ** zoom) * CELLS_PER_TILE
+    lat = np.radians(np.clip(lat, -85, 85))
+    x = np.clip(np.floor((np.asarray(lon) + 180) / 360 * size), 0, size - 1)
+    y = np.clip(np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * size), 0, size - 1)
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def get_grid_cells(lat, lon, zoom):
+    size = (2 ** zoom) * CELLS_PER_TILE
+    x, y = get_grid_xy(lat, lon, zoom)
+    return x * size + y
+
+
+def build_geo_index(df):
+    if "__geo_lat" not in df.columns or "__geo_long" not in df.columns:
+        return None
+
+    lat = df["__geo_lat"].astype(float).values
+    lon = df["__geo_long"].astype(float).values
+    located = ~(np.isnan(lat) | np.isnan(lon))
+
+    index = {
+        "rows": len(df),
+        "lat": np.nan_to_num(lat),
+        "lon": np.nan_to_num(lon),
+        "located": located,
+        "levels": {},
+    }
+    for zoom in range(MIN_ZOOM, POINTS_ZOOM):
+        # rows without a location are given a code of -1
+        cells = get_grid_cells(index["lat"][located], index["lon"][located], zoom)
+        cell_ids, cell_codes = np.unique(cells, return_inverse=True)
+        codes = np.full(len(df), -1, dtype=np.int32)
+        codes[located] = cell_codes
+        index["levels"][zoom] = {
+            "codes": codes,
+            "cells": len(cell_ids),
+        }
+
+    # located rows sorted by their grid cell, so the rows in each column of
+    # the grid are next to each other
+    cells = get_grid_cells(index["lat"], index["lon"], BBOX_INDEX_ZOOM)
+    cells[~located] = -1
+    index["bbox_order"] = np.argsort(cells, kind="mergesort")[(~located).sum():]
+    index["bbox_cells"] = cells[index["bbox_order"]]
+    return index
+
+
+def get_rows_in_bbox(index, bbox):
+    # rows with a location inside the bounding box (min lon, min lat, max lon, max lat)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    size = (2 ** BBOX_INDEX_ZOOM) * CELLS_PER_TILE
+    min_x, max_y = get_grid_xy(min_lat, min_lon, BBOX_INDEX_ZOOM)
+    max_x, min_y = get_grid_xy(max_lat, max_lon, BBOX_INDEX_ZOOM)
+
+    columns = np.arange(min_x, max_x + 1, dtype=np.int64) * size
+    starts = np.searchsorted(index["bbox_cells"], columns + min_y, side="left")
+    ends = np.searchsorted(index["bbox_cells"], columns + max_y, side="right")
+    if len(columns) == 0:
+        return np.array([], dtype=np.int64)
+    rows = np.sort(np.concatenate([
+        index["bbox_order"][start:end] for start, end in zip(starts, ends)
+    ]))
+
+    # remove the rows in cells on the edge of the box that are outside it
+    lat = index["lat"][rows]
+    lon = index["lon"][rows]
+    return rows[(lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)]
+
+
+def get_geojson_features(lat, lon, properties):
+    # generate a geojson feature for each point. `properties` is a dict of
+    # arrays the same length as lat and lon
+    names = list(properties.keys())
+    for values in zip(lat, lon, *properties.values()):
+        yield json_dumps({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [float(values[1]), float(values[0])],
+            },
+            "properties": dict(zip(names, values[2:])),
+        })
+
+
+def get_geo_index(fileid):
+    # fetch the grid index for a dataset, creating it if it's not been made yet
+    index = get_derived_from_cache(fileid, "geo")
+    if index is None:
+        df = get_from_cache(fileid)
+        if df is None:
+            return None
+        index = build_geo_index(df)
+        save_derived_to_cache(fileid, "geo", index)
+    return index
+
+
+def get_geo_clusters(index, rows, zoom):
+    # count of grants and their average location for each grid cell
+    level = index["levels"][zoom]
+    codes = level["codes"] if rows is None else level["codes"][rows]
+    lat = index["lat"] if rows is None else index["lat"][rows]
+    lon = index["lon"] if rows is None else index["lon"][rows]
+
+    total_grants = len(codes)
+    located = codes >= 0
+    codes = codes[located]
+    grants = np.bincount(codes, minlength=level["cells"])
+    in_use = grants > 0
+    geo = pd.DataFrame({
+        "__geo_lat": np.bincount(codes, weights=lat[located], minlength=level["cells"])[in_use] / grants[in_use],
+        "__geo_long": np.bincount(codes, weights=lon[located], minlength=level["cells"])[in_use] / grants[in_use],
+        "grants": grants[in_use],
+    })
+
+    return {
+        "type": "clusters",
+        "geo": geo,
+        "grant_count": int(located.sum()),
+        "total_grants": total_grants,
+    }
+
+
+def get_viewport_points(data, zoom, center):
+    # only send the points that can be seen on the map
+    if not data or "error" in data:
+        return data
+    center = center or DEFAULT_CENTER
+    half_width = 360.0 / (2 ** zoom) * VIEWPORT_TILES / 2
+    half_height = half_width * max(math.cos(math.radians(center["lat"])), 0.1)
+    geo = data["geo"]
+    geo = geo[
+        (geo["__geo_long"] >= center["lon"] - half_width) &
+        (geo["__geo_long"] <= center["lon"] + half_width) &
+        (geo["__geo_lat"] >= center["lat"] - half_height) &
+        (geo["__geo_lat"] <= center["lat"] + half_height)
+    ]
+    return {**data, "type": "points", "geo": geo}
+
+
+def get_map_data(fileid, zoom=None, center=None, **filters):
+    zoom = get_zoom_level(zoom)
+
+    if zoom >= POINTS_ZOOM:
+        results = get_filtered_results(fileid, {
+            "location": {"get_results": get_location_data},
+        }, **filters)
+        if results is None:
+            return None
+        return get_viewport_points(results["location"], zoom, center)
+
+    if not dataset_available(fileid):
+        return None
+
+    result_id = "map_clusters_{}".format(zoom)
+    cached = get_results_from_cache(fileid, result_id, filters)
+    if cached is not None:
+        return cached["results"]
+
+    index = get_geo_index(fileid)
+    filter_index = get_filter_index(fileid)
+    data = None
+    if index is not None and filter_index is not None:
+        data = get_geo_clusters(index, get_filtered_rows(filter_index, **filters), zoom)
+    save_results_to_cache(fileid, result_id, filters, data)
+    return data
+
+
+def build_area_index(df):
+    # the area each grant is in, for each type of area
+    index = {
+        "rows": len(df),
+        "areas": {},
+    }
+    for area_type, area_def in AREA_TYPES.items():
+        if area_def["field"] not in df.columns:
+            continue
+        codes, names = pd.factorize(df[area_def["field"]])
+        index["areas"][area_type] = {
+            "codes": codes.astype(np.int32),
+            "names": list(names),
+            "grants": np.bincount(codes[codes >= 0], minlength=len(names)),
+        }
+    return index
+
+
+def get_area_index(fileid):
+    # fetch the area index for a dataset, creating it if it's not been made yet
+    index = get_derived_from_cache(fileid, "areas")
+    if index is None:
+        df = get_from_cache(fileid)
+        if df is None:
+            return None
+        index = build_area_index(df)
+        save_derived_to_cache(fileid, "areas", index)
+    return index
+
+
+def get_area_counts(index, area_type, rows=None):
+    # number of grants in each area
+    area = index["areas"].get(area_type)
+    if area is None:
+        return None
+    if rows is None:
+        grants = area["grants"]
+    else:
+        codes = area["codes"][rows]
+        grants = np.bincount(codes[codes >= 0], minlength=len(area["names"]))
+    grants = pd.Series(grants, index=area["names"])
+    return grants[grants > 0]
+
+
+def get_area_data(fileid, area_type, **filters):
+    if not dataset_available(fileid):
+        return None
+
+    result_id = "areas_{}".format(area_type)
+    cached = get_results_from_cache(fileid, result_id, filters)
+    if cached is not None:
+        return cached["results"]
+
+    index = get_area_index(fileid)
+    filter_index = get_filter_index(fileid)
+    data = None
+    if index is not None and filter_index is not None:
+        data = get_area_counts(index, area_type, get_filtered_rows(filter_index, **filters))
+    save_results_to_cache(fileid, result_id, filters, data)
+    return data
+
+
+def get_boundary_zoom(zoom):
+    zoom = get_zoom_level(zoom)
+    levels = [z for z in BOUNDARY_ZOOM_LEVELS if z <= zoom]
+    return levels[-1] if levels else BOUNDARY_ZOOM_LEVELS[0]
+
+
+def get_boundary_keys(properties):
+    # boundary files from the ONS have the area code and name in properties
+    # ending "cd" and "nm" (eg "lad19cd", "lad19nm")
+    keys = []
+    for k, v in properties.items():
+        if k.lower() in ("name", "code", "id") or k.lower().endswith(("cd", "nm")):
+            keys.append(str(v))
+    return keys
+
+
+def simplify_line(points, tolerance):
+    # Ramer-Douglas-Peucker simplification of an array of [lon, lat] points
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        line = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(line[0], line[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(line[0] * offsets[:, 1] - line[1] * offsets[:, 0]) / length
+        furthest = np.argmax(distances)
+        if distances[furthest] > tolerance:
+            furthest += start + 1
+            keep[furthest] = True
+            stack.append((start, furthest))
+            stack.append((furthest, end))
+    return points[keep]
+
+
+def simplify_geometry(geometry, tolerance):
+    # returns None if the geometry is too small to see at this tolerance
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return None
+
+    simplified = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            ring = simplify_line(np.array(ring, dtype=float)[:, :2], tolerance)
+            if len(ring) >= 4:
+                rings.append(np.round(ring, 5).tolist())
+            elif not rings:
+                # the outer ring has disappeared so skip the polygon
+                break
+        if rings:
+            simplified.append(rings)
+
+    if not simplified:
+        return None
+    return {"type": "MultiPolygon", "coordinates": simplified}
+
+
+def get_geometry_centre(geometry):
+    # middle of the bounding box of the largest outer ring
+    ring = max([p[0] for p in geometry["coordinates"]], key=len)
+    ring = np.array(ring)
+    return {
+        "lon": float((ring[:, 0].min() + ring[:, 0].max()) / 2),
+        "lat": float((ring[:, 1].min() + ring[:, 1].max()) / 2),
+    }
+
+
+def get_boundaries_filename(area_type):
+    folder = current_app.config.get("BOUNDARIES_FOLDER")
+    if not folder or area_type not in AREA_TYPES:
+        return None
+    filename = os.path.join(folder, AREA_TYPES[area_type]["boundaries"])
+    if not os.path.exists(filename):
+        return None
+    return filename
+
+
+def get_available_area_types():
+    return [a for a in AREA_TYPES if get_boundaries_filename(a)]
+
+
+def get_boundaries(area_type, zoom=None):
+    # boundaries simplified to about a pixel at this zoom level, with a
+    # lookup from the names and codes of each area. They are saved to the
+    # uploads folder so the simplification is only done once
+    zoom = get_boundary_zoom(zoom)
+    if (area_type, zoom) in BOUNDARIES:
+        return BOUNDARIES[(area_type, zoom)]
+
+    filename = get_boundaries_filename(area_type)
+    if not filename:
+        return None
+
+    cache_filename = os.path.join(
+        current_app.config.get("UPLOADS_FOLDER"),
+        "boundaries-{}-{}.json".format(area_type, zoom)
+    )
+    if os.path.exists(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        with open(cache_filename) as boundaries_file:
+            boundaries = json.load(boundaries_file)
+    else:
+        tolerance = 360.0 / ((2 ** zoom) * 256)
+        with open(filename) as boundaries_file:
+            features = json.load(boundaries_file).get("features", [])
+        boundaries = {"areas": [], "keys": {}}
+        for feature in features:
+            geometry = simplify_geometry(feature.get("geometry") or {"type": None}, tolerance)
+            if geometry is None:
+                continue
+            for key in get_boundary_keys(feature.get("properties") or {}):
+                boundaries["keys"][key] = len(boundaries["areas"])
+            boundaries["areas"].append({
+                "geometry": geometry,
+                "centre": get_geometry_centre(geometry),
+            })
+        # other processes could be reading the file, so it's written to a
+        # temporary file and moved into place
+        temp_filename = "{}.{}.tmp".format(cache_filename, os.getpid())
+        try:
+            with open(temp_filename, "w") as boundaries_file:
+                json.dump(boundaries, boundaries_file)
+            os.replace(temp_filename, cache_filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+        logging.info("Simplified {} boundaries for zoom level {}".format(area_type, zoom))
+
+    BOUNDARIES[(area_type, zoom)] = boundaries
+    return boundaries
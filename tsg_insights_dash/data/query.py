@@ -0,0 +1,179 @@
+import time
+import json
+import hashlib
+
+import pandas as pd
+
+from .filters import get_filter_index, get_filtered_rows, check_filter
+from tsg_insights.data.cache import get_from_cache, get_results_from_cache, save_results_to_cache, \
+    dataset_available
+
+# a query looks like:
+# {
+#     "filters": {"funders": ["Funder A"]},
+#     "groupby": ["Recipient Org:0:Name"],
+#     "aggregate": {"Amount Awarded": ["sum", "median"]},
+#     "sort": "Amount Awarded:sum",
+#     "ascending": false,
+#     "limit": 10
+# }
+# Without `groupby` the query returns individual grants, with the fields
+# given in `columns`. Grouped results always include the number of grants.
+QUERY_AGGREGATIONS = ["count", "sum", "mean", "median", "min", "max", "nunique"]
+# aggregations that only work on numbers
+QUERY_NUMERIC_AGGREGATIONS = ["sum", "mean", "median"]
+QUERY_MAX_ROWS = 1000
+QUERY_TIME_LIMIT = 10
+
+
+def check_string_list(query, key):
+    values = query.get(key) or []
+    if not isinstance(values, list) or not all([isinstance(v, str) for v in values]):
+        raise ValueError("[{}] should be a list of column names".format(key))
+    return values
+
+
+def check_query(query, dtypes=None):
+    # returns a query with the defaults filled in, or raises a ValueError.
+    # If the column types are given the columns and aggregations are checked too
+    if not isinstance(query, dict):
+        raise ValueError("Query must be a JSON object")
+
+    filters = query.get("filters") or {}
+    if not isinstance(filters, dict):
+        raise ValueError("Filters should be a JSON object")
+    for filter_id, values in filters.items():
+        check_filter(filter_id, values)
+
+    groupby = check_string_list(query, "groupby")
+    aggregate = query.get("aggregate") or {}
+    if not isinstance(aggregate, dict):
+        raise ValueError("Aggregate should be a JSON object")
+    for field, aggs in aggregate.items():
+        if not isinstance(aggs, list):
+            raise ValueError("Aggregations for [{}] should be a list".format(field))
+        for agg in aggs:
+            if not isinstance(agg, str) or agg not in QUERY_AGGREGATIONS:
+                raise ValueError("Aggregation [{}] not recognised".format(agg))
+    if aggregate and not groupby:
+        raise ValueError("Aggregations need at least one groupby column")
+
+    columns = check_string_list(query, "columns") if not groupby else []
+    if not groupby and not columns:
+        raise ValueError("Queries without a groupby need at least one column")
+
+    if not isinstance(query.get("sort"), (str, type(None))):
+        raise ValueError("Sort should be a column name")
+
+    limit = query.get("limit", QUERY_MAX_ROWS)
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+        raise ValueError("Limit should be a positive number")
+
+    query = {
+        "filters": filters,
+        "groupby": list(groupby),
+        "aggregate": {field: list(aggs) for field, aggs in aggregate.items()},
+        "columns": list(columns),
+        "sort": query.get("sort"),
+        "ascending": bool(query.get("ascending", False)),
+        "limit": min(limit, QUERY_MAX_ROWS),
+    }
+    if dtypes is not None:
+        check_query_columns(query, dtypes)
+    return query
+
+
+def check_query_columns(query, dtypes):
+    # the columns used by the query have to be in the data, and numeric
+    # aggregations can only be used on numeric columns
+    fields = query["groupby"] + list(query["aggregate"].keys()) + query["columns"]
+    for field in fields:
+        if field not in dtypes:
+            raise ValueError("Column [{}] not found in data".format(field))
+    for field, aggs in query["aggregate"].items():
+        for agg in aggs:
+            if agg in QUERY_NUMERIC_AGGREGATIONS and dtypes[field].kind not in 'biuf':
+                raise ValueError("Aggregation [{}] can't be used with column [{}]".format(agg, field))
+
+
+def sort_query_results(df, sort, ascending, limit):
+    # only the top rows are needed, so use a partial sort
+    if sort is None:
+        return df.iloc[:limit]
+    if sort not in df.columns:
+        raise ValueError("Sort column [{}] not found in results".format(sort))
+    if df[sort].dtype.kind in 'biuf':
+        if ascending:
+            return df.loc[df[sort].nsmallest(limit).index]
+        return df.loc[df[sort].nlargest(limit).index]
+    return df.sort_values(sort, ascending=ascending).iloc[:limit]
+
+
+def run_query(df, query, rows=None, time_limit=QUERY_TIME_LIMIT):
+    check_query_columns(query, df.dtypes)
+    try:
+        return run_checked_query(df, query, rows, time_limit)
+    except (TypeError, KeyError) as error:
+        # pandas can still reject some queries, such as sorting mixed types
+        raise ValueError("Query could not be run: {}".format(error))
+
+
+def run_checked_query(df, query, rows=None, time_limit=QUERY_TIME_LIMIT):
+    start = time.time()
+
+    def check_time():
+        if time.time() - start > time_limit:
+            raise ValueError("Query took longer than {} seconds".format(time_limit))
+
+    # only the columns used by the query are taken from the dataset
+    columns = query["groupby"] + list(query["aggregate"].keys()) + query["columns"]
+    if query["sort"] in df.columns and query["sort"] not in columns:
+        columns.append(query["sort"])
+    columns = list(pd.unique(columns))
+    if rows is not None:
+        df = df[columns].take(rows)
+    else:
+        df = df[columns]
+    check_time()
+
+    if not query["groupby"]:
+        df = df.reset_index(drop=True)
+        result = sort_query_results(df, query["sort"], query["ascending"], query["limit"])
+        return {
+            "rows": len(df),
+            "result": result[query["columns"] or columns].reset_index(drop=True),
+        }
+
+    groups = df.groupby(query["groupby"], observed=True, sort=False)
+    result = pd.DataFrame({"grants": groups.size()})
+    for field, aggs in query["aggregate"].items():
+        for agg in aggs:
+            result["{}:{}".format(field, agg)] = groups[field].agg(agg)
+            check_time()
+    result = sort_query_results(
+        result.reset_index(), query["sort"] or "grants", query["ascending"], query["limit"])
+    return {
+        "rows": len(df),
+        "groups": len(groups),
+        "result": result.reset_index(drop=True),
+    }
+
+
+def get_query_results(fileid, query):
+    # results are cached for each dataset version, using a hash of the query
+    if not dataset_available(fileid):
+        return None
+
+    result_id = "query_{}".format(hashlib.md5(
+        json.dumps(query, sort_keys=True).encode("utf8")).hexdigest())
+    cached = get_results_from_cache(fileid, result_id, query["filters"])
+    if cached is not None:
+        return cached["results"]
+
+    df = get_from_cache(fileid)
+    if df is None:
+        return None
+    rows = get_filtered_rows(get_filter_index(fileid, df), **query["filters"])
+    results = run_query(df, query, rows)
+    save_results_to_cache(fileid, result_id, query["filters"], results)
+    return results
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 from tsg_insights.data.utils import format_currency
@@ -60,6 +61,51 @@ AGE_BAND_CHANGES = {
     "Over 25 years": "Over 25 years"
 }
 
+REGION_ORDER = [
+    ("Scotland", "Scotland"),
+    ("Northern Ireland", "Northern Ireland"),
+    ("Wales", "Wales"),
+    ("England", "North East"),
+    ("England", "North West"),
+    ("England", "Yorkshire and The Humber"),
+    ("England", "West Midlands"),
+    ("England", "East Midlands"),
+    ("England", "East of England"),
+    ("England", "London"),
+    ("England", "South West"),
+    ("England", "South East"),
+    ("Isle of Man", "Isle of Man"),
+    ("Unknown", "Unknown"),
+]
+
+# charts for fields with lots of values show the largest ones, with the rest
+# added together under a single "Other" label
+TOP_VALUES = 14
+OTHER_VALUES = "Other ({:,.0f})"
+
+# fields that the aggregate cube is grouped by, which are the fields used
+# by the dashboard filters
+CUBE_DIMENSIONS = [
+    "Funding Org:0:Name",
+    "Grant Programme:0:Title",
+    "__geo_ctry",
+    "__geo_rgn",
+    "__org_org_type",
+    "Amount Awarded:Bands",
+    "__org_latest_income_bands",
+    "__org_age_bands",
+    "Award Date:Year",
+]
+
+# fields only needed for the charts. Grouping by these as well would give a
+# cell for nearly every grant, so instead each cell keeps a small rollup of
+# the values found in it with their number of grants and amount awarded
+CUBE_ROLLUPS = [
+    "Award Date:Month",
+    "Currency",
+    "__org_identifier_scheme",
+]
+
 def get_imd_data(df):
 
     imd_order = [
@@ -96,6 +142,7 @@ def get_statistics(df):
     return {
         "grants": len(df),
         "recipients": df["Recipient Org:0:Identifier"].unique().size,
+        "funders": df["Funding Org:0:Name"].nunique(),
         "amount_awarded": amount_awarded,
         "award_years": {
             "min": df["Award Date"].dt.year.min(),
@@ -104,34 +151,151 @@ def get_statistics(df):
     }
 
 
-def get_ctry_rgn(df):
+def get_cube_statistics(cube):
+    amount_awarded = get_cube_rollup(cube, "Currency").groupby("Currency")["Amount Awarded"].sum()
+    amount_awarded = [format_currency(amount, currency)
+                      for currency, amount in amount_awarded.items()]
 
-    if "__geo_ctry" not in df.columns or "__geo_rgn" not in df.columns:
+    recipients = cube["__recipients"].values
+    recipients = np.unique(np.concatenate(recipients)).size if len(recipients) else 0
+    award_years = cube["Award Date:Year"].dropna()
+
+    return {
+        "grants": int(cube["Grants"].sum()),
+        "recipients": recipients,
+        "funders": int(cube["Funding Org:0:Name"].nunique()),
+        "amount_awarded": amount_awarded,
+        "award_years": {
+            "min": int(award_years.min()) if len(award_years) else None,
+            "max": int(award_years.max()) if len(award_years) else None,
+        }
+    }
+
+
+def build_aggregate_cube(df):
+    # count of grants, total amount and the recipients for every combination
+    # of values of the CUBE_DIMENSIONS found in the data
+    dimensions = df[[f for f in CUBE_DIMENSIONS if f in df.columns]]
+
+    # missing values get a code of -1 so they're kept as a separate group
+    codes = []
+    values = []
+    for field, series in dimensions.iteritems():
+        if series.dtype.name == "category":
+            codes.append(series.cat.codes.values)
+            values.append(series.cat.categories)
+        else:
+            field_codes, field_values = pd.factorize(series)
+            codes.append(field_codes)
+            values.append(field_values)
+    cells, cell_ids = np.unique(np.column_stack(codes), axis=0, return_inverse=True)
+
+    # recipients are stored as codes, with 0 used for a missing identifier
+    recipient_codes, recipient_values = pd.factorize(df["Recipient Org:0:Identifier"])
+    recipient_base = len(recipient_values) + 1
+    cell_recipients = np.unique(cell_ids.astype(np.int64) * recipient_base + recipient_codes + 1)
+    grants = np.bincount(cell_ids, minlength=len(cells))
+    amounts = df["Amount Awarded"].fillna(0).values
+
+    cube = pd.DataFrame(index=range(len(cells)))
+    for k, (field, series) in enumerate(dimensions.iteritems()):
+        if series.dtype.name == "category":
+            cube.loc[:, field] = pd.Categorical.from_codes(
+                cells[:, k], values[k], ordered=series.cat.ordered)
+        else:
+            cube.loc[:, field] = pd.Series(
+                np.asarray(values[k], dtype=object)).reindex(cells[:, k]).values
+    cube.loc[:, "Grants"] = grants
+    cube.loc[:, "Amount Awarded"] = np.bincount(
+        cell_ids, weights=amounts, minlength=len(cells))
+    cube.loc[:, "__recipients"] = pd.Series(np.split(
+        cell_recipients % recipient_base,
+        np.searchsorted(cell_recipients // recipient_base, range(1, len(cells)))
+    ))
+
+    rollups = {
+        "Award Date:Month": get_award_months(df),
+        "Currency": df["Currency"],
+        "__org_identifier_scheme": get_identifier_schemes(df),
+    }
+    for field in CUBE_ROLLUPS:
+        for column, cell_values in get_cell_rollup(cell_ids, len(cells), rollups[field], amounts).items():
+            cube.loc[:, "{}:{}".format(field, column)] = pd.Series(cell_values)
+    return cube
+
+
+def get_cell_rollup(cell_ids, cell_count, values, amounts):
+    # the values of a field found in each cell of the cube, with the number of
+    # grants and amount awarded for each one. Missing values are left out
+    value_codes, unique_values = pd.factorize(values)
+    found = value_codes >= 0
+    base = max(len(unique_values), 1)
+    keys, key_ids = np.unique(
+        cell_ids[found].astype(np.int64) * base + value_codes[found], return_inverse=True)
+    splits = np.searchsorted(keys // base, range(1, cell_count))
+    return {
+        "values": np.split(np.asarray(unique_values, dtype=object)[keys % base], splits),
+        "grants": np.split(np.bincount(key_ids, minlength=len(keys)), splits),
+        "amount": np.split(np.bincount(
+            key_ids, weights=amounts[found], minlength=len(keys)), splits),
+    }
+
+
+def get_cube_rollup(cube, field, by=None):
+    # one row for each value of a rolled up field in each cell of the cube,
+    # with the value of the `by` dimension for that cell if it's given
+    columns = {
+        field: ("values", object),
+        "Grants": ("grants", np.int64),
+        "Amount Awarded": ("amount", np.float64),
+    }
+    rollup = pd.DataFrame({
+        column: np.concatenate(
+            [np.array([], dtype=dtype)] + list(cube["{}:{}".format(field, suffix)]))
+        for column, (suffix, dtype) in columns.items()
+    }, columns=list(columns.keys()))
+    if by:
+        lengths = [len(v) for v in cube["{}:values".format(field)]]
+        rollup.loc[:, by] = cube[by].take(np.repeat(np.arange(len(cube)), lengths)).values
+    return rollup
+
+
+def get_location_data(df):
+
+    if "__geo_lat" not in df.columns or "__geo_long" not in df.columns:
         return None
 
-    REGION_ORDER = [
-        ("Scotland", "Scotland"),
-        ("Northern Ireland", "Northern Ireland"),
-        ("Wales", "Wales"),
-        ("England", "North East"),
-        ("England", "North West"),
-        ("England", "Yorkshire and The Humber"),
-        ("England", "West Midlands"),
-        ("England", "East Midlands"),
-        ("England", "East of England"),
-        ("England", "London"),
-        ("England", "South West"),
-        ("England", "South East"),
-        ("Isle of Man", "Isle of Man"),
-        ("Unknown", "Unknown"),
-    ]
+    popup_col = 'Recipient Org:0:Name'
+    if popup_col not in df.columns and 'Recipient Org:0:Identifier' in df.columns:
+        popup_col = 'Recipient Org:0:Identifier'
+
+    try:
+        geo = df[["__geo_lat", "__geo_long", popup_col]].dropna()
+        grant_count = len(geo)
+        geo = geo.groupby(["__geo_lat", "__geo_long", popup_col]).size().rename("grants").reset_index()
+    except KeyError as e:
+        return {"error": str(e)}
+
+    return {
+        "type": "points",
+        "geo": geo,
+        "popup_col": popup_col,
+        "grant_count": grant_count,
+        "total_grants": len(df),
+    }
+
+
+def get_ctry_rgn(df, aggregation=None):
+
+    if "__geo_ctry" not in df.columns or "__geo_rgn" not in df.columns:
+        return None
 
     # generate region groupby
     ctry_rgn = df.groupby([
         df["__geo_ctry"].fillna("Unknown").str.strip(),
         # ensure countries where region is null are correctly labelled
         df.loc[:, "__geo_rgn"].fillna(df["__geo_ctry"]).fillna("Unknown").str.strip(),
-    ]).agg({
+    ]).agg(aggregation or {
         "Amount Awarded": "sum",
         "Title": "size"
     }).rename(columns={"Title": "Grants"})
@@ -144,6 +308,123 @@ def get_ctry_rgn(df):
     return ctry_rgn
 
 
+def get_award_months(df):
+    # datasets prepared before the month column was added need it calculating
+    if "Award Date:Month" in df.columns:
+        return df["Award Date:Month"]
+    return df["Award Date"].dt.strftime("%Y-%m")
+
+
+def get_award_date_bins(month_counts):
+    # number of grants by month, quarter and year from a series of counts
+    # indexed by "YYYY-MM" strings. Periods without grants are included
+    month_counts = month_counts[month_counts > 0]
+    if len(month_counts) == 0:
+        return None
+    months = pd.PeriodIndex(month_counts.index.astype(str), freq="M")
+    month_counts = pd.Series(month_counts.values, index=months).groupby(level=0).sum()
+    month_counts = month_counts.reindex(
+        pd.period_range(months.min(), months.max(), freq="M"), fill_value=0)
+
+    bins = {}
+    for bin_size, freq in [("month", "M"), ("quarter", "Q"), ("year", "A")]:
+        counts = month_counts.groupby(month_counts.index.asfreq(freq)).sum()
+        # label each bin with the date it starts on
+        counts.index = counts.index.asfreq("D", how="start").strftime("%Y-%m-%d")
+        bins[bin_size] = counts
+
+    return {
+        "grants": int(month_counts.sum()),
+        "first": str(months.min()),
+        "last": str(months.max()),
+        "min": int(months.min().year),
+        "max": int(months.max().year),
+        **bins
+    }
+
+
+def get_cube_ctry_rgn(cube):
+    return get_ctry_rgn(cube, {
+        "Amount Awarded": "sum",
+        "Grants": "sum",
+    })
+
+
+def get_cube_amount_awarded(cube):
+    rollup = get_cube_rollup(cube, "Currency", by="Amount Awarded:Bands")
+    bands = rollup["Amount Awarded:Bands"].cat.rename_categories(AWARD_BAND_CHANGES)
+    return rollup.groupby([bands, "Currency"], observed=True)["Grants"].sum().unstack(
+        fill_value=0).reindex(bands.cat.categories, fill_value=0)
+
+
+def sort_counts(counts, positions=None):
+    # positions of the counts from largest to smallest, with ties in order of
+    # their labels so the order doesn't depend on how the counts were made
+    if positions is None:
+        positions = np.arange(len(counts))
+    labels = np.array(counts.index.astype(str))[positions]
+    return positions[np.lexsort((labels, -counts.values[positions]))]
+
+
+def get_top_values(counts, top=TOP_VALUES):
+    # the largest `top` counts, plus the number of grants and values in the
+    # rest. A partial sort finds the values that could be in the top, then
+    # only those are put in order
+    if counts is None:
+        return None
+    if len(counts) <= top + 1:
+        return {"values": counts.iloc[sort_counts(counts)], "other": 0, "other_values": 0}
+    cutoff = np.partition(counts.values, len(counts) - top)[len(counts) - top]
+    largest = sort_counts(counts, np.flatnonzero(counts.values >= cutoff))[:top]
+    values = counts.iloc[largest]
+    return {
+        "values": values,
+        "other": int(counts.values.sum() - values.sum()),
+        "other_values": len(counts) - top,
+    }
+
+
+def with_other_values(data):
+    # the largest values with the rest added as a single "Other" value
+    if data["other_values"]:
+        return data["values"].append(pd.Series(
+            [data["other"]], index=[OTHER_VALUES.format(data["other_values"])]))
+    return data["values"]
+
+
+def get_cube_counts(field, band_changes=None, top=None):
+    # number of grants for each value of a field in the aggregate cube
+    def get_cube_counts_func(cube):
+        if field not in cube.columns:
+            return None
+        values = cube[field]
+        if band_changes:
+            values = values.cat.rename_categories(band_changes)
+            return cube["Grants"].groupby(values).sum().reindex(
+                values.cat.categories).fillna(0).astype(int)
+        if top:
+            counts = cube["Grants"].groupby(values, observed=True, sort=False).sum()
+            return get_top_values(counts[counts > 0], top)
+        return cube["Grants"].groupby(values).sum().sort_values(ascending=False)
+    return get_cube_counts_func
+
+
+def get_field_counts(field, band_changes=None, top=None):
+    # value counts for a field, or None if the field isn't in the data
+    def get_field_counts_func(df):
+        if field not in df.columns:
+            return None
+        values = df[field]
+        if band_changes:
+            values = values.cat.rename_categories(band_changes)
+            return values.value_counts().sort_index()
+        if top:
+            counts = values.value_counts(sort=False)
+            return get_top_values(counts[counts > 0], top)
+        return values.value_counts()
+    return get_field_counts_func
+
+
 def get_org_type(df):
     return get_identifier_schemes(df).value_counts().sort_index()
 
@@ -168,12 +449,14 @@ CHARTS = dict(
     funders={
         'title': 'Funders',
         'units': '(number of grants)',
-        'get_results': (lambda df: df["Funding Org:0:Name"].value_counts()),
+        'get_results': get_field_counts("Funding Org:0:Name", top=TOP_VALUES),
+        'get_cube_results': get_cube_counts("Funding Org:0:Name", top=TOP_VALUES),
     },
     grant_programmes={
         'title': 'Grant programmes',
         'units': '(number of grants)',
-        'get_results': (lambda df: df["Grant Programme:0:Title"].value_counts()),
+        'get_results': get_field_counts("Grant Programme:0:Title", top=TOP_VALUES),
+        'get_cube_results': get_cube_counts("Grant Programme:0:Title", top=TOP_VALUES),
     },
     amount_awarded={
         'title': 'Amount awarded',
@@ -183,6 +466,7 @@ CHARTS = dict(
             df["Currency"],
             dropna=False
         ).sort_index()),
+        'get_cube_results': get_cube_amount_awarded,
     },
     identifier_scheme={
         'title': 'Identifier scheme',
@@ -193,11 +477,9 @@ CHARTS = dict(
     award_date={
         'title': 'Award date',
         'units': '(number of grants)',
-        'get_results': (lambda df: {
-            "all": df['Award Date'].dt.strftime("%Y-%m-%d").tolist(),
-            "min": df['Award Date'].dt.year.min(),
-            "max": df['Award Date'].dt.year.max()
-        }),
+        'get_results': (lambda df: get_award_date_bins(get_award_months(df).value_counts())),
+        'get_cube_results': (lambda cube: get_award_date_bins(
+            get_cube_rollup(cube, "Award Date:Month").groupby("Award Date:Month")["Grants"].sum())),
     },
     ctry_rgn={
         'title': 'UK region and country',
@@ -207,6 +489,7 @@ If postcodes aren’t present, they are sourced from UK charity or company regis
         'missing': '''This chart can\'t be shown as there is no information on the country and region of recipients or grants. 
 This can be added by using charity or company numbers, or by including a postcode.''',
         'get_results': get_ctry_rgn,
+        'get_cube_results': get_cube_ctry_rgn,
     },
     org_type={
         'title': 'Recipient type',
@@ -214,6 +497,8 @@ This can be added by using charity or company numbers, or by including a postcod
         'desc': '''Organisation type is only available for recipients with a valid
 organisation identifier.''',
         'get_results': get_org_type,
+        'get_cube_results': (lambda cube: get_cube_rollup(cube, "__org_identifier_scheme").groupby(
+            "__org_identifier_scheme")["Grants"].sum().sort_index()),
     },
     org_income={
         'title': 'Latest income of charity recipients',
@@ -221,7 +506,8 @@ organisation identifier.''',
         'missing': '''This chart can\'t be shown as there are no recipients in the data with 
 organisation income data. Add company or charity numbers to your data to show a chart of
 the income of organisations.''',
-        'get_results': (lambda df: df["__org_latest_income_bands"].cat.rename_categories(INCOME_BAND_CHANGES).value_counts().sort_index()),
+        'get_results': get_field_counts("__org_latest_income_bands", INCOME_BAND_CHANGES),
+        'get_cube_results': get_cube_counts("__org_latest_income_bands", INCOME_BAND_CHANGES),
     },
     org_age={
         'title': 'Age of recipient organisations',
@@ -230,7 +516,8 @@ the income of organisations.''',
         'missing': '''This chart can\'t be shown as there are no recipients in the data with 
 organisation age data. Add company or charity numbers to your data to show a chart of
 the age of organisations.''',
-        'get_results': (lambda df: df["__org_age_bands"].cat.rename_categories(AGE_BAND_CHANGES).value_counts().sort_index()),
+        'get_results': get_field_counts("__org_age_bands", AGE_BAND_CHANGES),
+        'get_cube_results': get_cube_counts("__org_age_bands", AGE_BAND_CHANGES),
     },
     imd={
         'title': 'Index of multiple deprivation',
@@ -0,0 +1,128 @@
+import logging
+
+from .filters import FILTERS, get_filtered_results, get_filter_counts, get_filter_options
+from .results import CHARTS, get_statistics, get_cube_statistics
+from .geo import get_map_data, DEFAULT_ZOOM
+from tsg_insights.data.cache import get_state_token, get_state_from_cache, save_state_to_cache, \
+    get_filters_hash, get_derived_from_cache, save_derived_to_cache
+
+# results used by the dashboard, cached for each set of filters
+DASHBOARD_RESULTS = {
+    "statistics": {
+        "get_results": get_statistics,
+        "get_cube_results": get_cube_statistics,
+    },
+    **{
+        chart_id: CHARTS[chart_id]
+        for chart_id in ["funders", "amount_awarded", "grant_programmes", "award_date",
+                         "org_type", "ctry_rgn", "org_age", "org_income"]
+    }
+}
+
+
+def get_missing_fields(fileid):
+    # fields that would let more of the data be linked, based on all the grants
+    results = get_filtered_results(fileid, {
+        "ctry_rgn": DASHBOARD_RESULTS["ctry_rgn"],
+        "org_type": DASHBOARD_RESULTS["org_type"],
+    })
+
+    if results is None:
+        return None
+
+    missing = []
+    ctry_rgn = results["ctry_rgn"]
+    if ctry_rgn is None or ctry_rgn.index.tolist() == [("Unknown", "Unknown")]:
+        missing.append(["postcodes or other geo data",
+                        "https://postcodes.findthatcharity.uk/"])
+
+    org_type = results["org_type"]
+    if "Identifier not recognised" in org_type.index and len(org_type.index)==1:
+        missing.append(["external organisation identifiers, like charity numbers",
+                        'http://standard.threesixtygiving.org/en/latest/identifiers/#id2'])
+    return missing
+
+
+def get_safe_filter_options(fileid):
+    # the filter options can't be made for datasets with unexpected values in
+    # some fields, in which case the dashboard works without them
+    try:
+        return get_filter_options(fileid)
+    except (KeyError, ValueError):
+        logging.exception("Filter options for dataframe [{}] failed".format(fileid))
+        return None
+
+
+def remove_default_filters(fileid, filters):
+    # sliders set to every value don't filter anything, so they're removed to
+    # let the state be shared with the unfiltered dashboard
+    options = get_safe_filter_options(fileid) if fileid else None
+    if not options:
+        return filters
+
+    filters = dict(filters)
+    for filter_id, filter_def in FILTERS.items():
+        value = filters.get(filter_id)
+        if filter_def.get("type") != 'rangeslider' or not value:
+            continue
+        if list(value) == [options[filter_id]["min"], options[filter_id]["max"]]:
+            filters[filter_id] = None
+    return filters
+
+
+def is_unfiltered(filters):
+    return get_filters_hash(filters) == get_filters_hash({})
+
+
+def build_dashboard_state(fileid, filters):
+    results = get_filtered_results(fileid, DASHBOARD_RESULTS, **filters)
+    state = {"results": results}
+    if results is not None:
+        state.update({
+            "facets": get_filter_counts(fileid, **filters),
+            "map": get_map_data(fileid, DEFAULT_ZOOM, **filters),
+            "missing": get_missing_fields(fileid),
+        })
+    return state
+
+
+def get_dashboard_state(fileid, filters):
+    # everything the dashboard shows for a dataset and set of filters, worked
+    # out once and saved under a token the other callbacks use to read it.
+    # The unfiltered state comes from the snapshot made when the dataset was saved
+    if not fileid:
+        return None, {"results": None}
+    token = get_state_token(fileid, filters)
+    if is_unfiltered(filters):
+        snapshot = get_derived_from_cache(fileid, "snapshot")
+        if snapshot is not None:
+            return token, snapshot["state"]
+
+    state = get_state_from_cache(fileid, token)
+    if state is not None:
+        return token, state
+
+    state = build_dashboard_state(fileid, filters)
+    if state["results"] is not None:
+        save_state_to_cache(fileid, token, state)
+    return token, state
+
+
+def load_dashboard_state(data):
+    # the state saved for the token, or worked out again if it has expired
+    data = data or {}
+    fileid = data.get("fileid")
+    filters = data.get("filters") or {}
+    if data.get("token") and not is_unfiltered(filters):
+        state = get_state_from_cache(fileid, data.get("token"))
+        if state is not None:
+            return state
+    return get_dashboard_state(fileid, filters)[1]
+
+
+def save_dashboard_snapshot(fileid):
+    # the unfiltered dashboard and filter options, kept with the dataset so
+    # the first view of it only needs one cache read
+    options = get_safe_filter_options(fileid)
+    state = build_dashboard_state(fileid, {})
+    save_derived_to_cache(fileid, "snapshot", {"options": options, "state": state})
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+from .filters import get_filter_index, get_filtered_rows
+from tsg_insights.data.cache import get_from_cache, get_derived_from_cache, save_derived_to_cache, \
+    dataset_available
+
+# columns shown in the grants table, all of which can be used to sort it
+TABLE_COLUMNS = {
+    "Title": "Title",
+    "Recipient Org:0:Name": "Recipient",
+    "Funding Org:0:Name": "Funder",
+    "Grant Programme:0:Title": "Programme",
+    "Amount Awarded": "Amount",
+    "Award Date": "Award date",
+}
+TABLE_PAGE_SIZE = 20
+TABLE_MAX_LIMIT = 1000
+
+
+def get_sort_order(values):
+    # rows in order of the values, with missing values at the end
+    try:
+        codes, uniques = pd.factorize(values, sort=True)
+    except TypeError:
+        # columns with mixed types are sorted as strings
+        codes, uniques = pd.factorize(values.where(values.isnull(), values.astype(str)), sort=True)
+    missing = codes < 0
+    codes[missing] = len(uniques)
+    return {
+        "order": np.argsort(codes, kind="mergesort").astype(np.int32),
+        "missing": int(missing.sum()),
+    }
+
+
+def build_sort_index(df):
+    # the sorted order of the rows for each table column, so pages can be
+    # taken from it without sorting the dataframe each time
+    return {
+        "rows": len(df),
+        "columns": {
+            field: get_sort_order(df[field])
+            for field in TABLE_COLUMNS
+            if field in df.columns
+        },
+    }
+
+
+def get_sort_index(fileid, df=None):
+    # fetch the sort index for a dataset, creating it if it's not been made yet
+    index = get_derived_from_cache(fileid, "sort")
+    if index is None:
+        df = get_from_cache(fileid) if df is None else df
+        if df is None:
+            return None
+        index = build_sort_index(df)
+        save_derived_to_cache(fileid, "sort", index)
+    return index
+
+
+def get_sorted_rows(index, rows=None, sort=None, ascending=True):
+    # filtered rows in the order given by a column in the sort index
+    sort_order = index["columns"].get(sort)
+    if sort_order is None:
+        if rows is None:
+            return np.arange(index["rows"])
+        return rows
+
+    order = sort_order["order"]
+    if not ascending:
+        # missing values are kept at the end
+        present = len(order) - sort_order["missing"]
+        order = np.concatenate([order[:present][::-1], order[present:]])
+    if rows is not None:
+        mask = np.zeros(index["rows"], dtype=bool)
+        mask[rows] = True
+        order = order[mask[order]]
+    return order
+
+
+def get_table_page(fileid, sort=None, ascending=True, offset=0, limit=TABLE_PAGE_SIZE, **filters):
+    if not dataset_available(fileid):
+        return None
+    df = get_from_cache(fileid)
+    if df is None:
+        return None
+
+    rows = get_filtered_rows(get_filter_index(fileid, df), **filters)
+    order = get_sorted_rows(get_sort_index(fileid, df), rows, sort, ascending)
+    # the page returned is the one actually used, after limiting it to the rows
+    offset = min(max(offset, 0), len(order))
+    limit = min(max(limit, 1), TABLE_MAX_LIMIT)
+    columns = [c for c in TABLE_COLUMNS if c in df.columns]
+    return {
+        "rows": len(order),
+        "offset": offset,
+        "limit": limit,
+        "grants": df[columns].take(order[offset:offset + limit]),
+    }
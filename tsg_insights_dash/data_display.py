@@ -2,6 +2,7 @@ import logging
 import re
 import json
 
+import pandas as pd
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
@@ -11,9 +12,27 @@ from flask import url_for, render_template
 from app import app
 from tsg_insights.data.cache import get_from_cache, get_cache, get_metadata_from_cache
 from .data.charts import *
-from .data.filters import FILTERS, get_filtered_df
+from .data.filters import FILTERS, get_filtered_df, get_filtered_results, get_options_index, \
+    search_filter_options
+from .data.results import get_field_counts, get_cube_counts
+from .data.state import DASHBOARD_RESULTS, get_dashboard_state, load_dashboard_state, \
+    remove_default_filters, get_safe_filter_options
+from .data.table import get_table_page, TABLE_COLUMNS, TABLE_PAGE_SIZE
+from .data.geo import get_map_data, get_area_data, get_boundaries, get_available_area_types, \
+    DEFAULT_ZOOM, DEFAULT_CENTER
 from tsg_insights_components import InsightChecklist, InsightDropdown, InsightFoldable
 
+# every value of the fields where charts group the smaller values under
+# "Other", only calculated when they're asked for
+OTHER_RESULTS = {
+    chart_id: {
+        "get_results": get_field_counts(field),
+        "get_cube_results": get_cube_counts(field),
+    }
+    for chart_id, field in [("funders", "Funding Org:0:Name"),
+                            ("grant_programmes", "Grant Programme:0:Title")]
+}
+
 def footer(server):
     with server.app_context():
         return InnerHTML(render_template('footer.html.j2', footer_class="light"))
@@ -33,12 +52,34 @@ def filter_html(filter_id, filter_def):
         )
 
     if filter_def.get("type") == 'multidropdown':
-        return InsightChecklist(
+        checklist = InsightChecklist(
             id=filter_id,
             ulClassName="results-page__menu__checkbox",
             options=filter_def["defaults"],
             value=[filter_def["defaults"][0]["value"]]
         )
+        if filter_def.get("build_options"):
+            # filters with lots of options can be searched
+            return html.Div([
+                dcc.Input(
+                    id='{}-search'.format(filter_id),
+                    type='text',
+                    value='',
+                    placeholder='Search {}'.format(filter_def.get("label", "").lower()),
+                    className="results-page__menu__input",
+                ),
+                checklist,
+            ])
+        return checklist
+
+    if filter_def.get("type") == 'text':
+        return dcc.Input(
+            id=filter_id,
+            type='text',
+            value=filter_def["defaults"],
+            placeholder='Recipient, title or description',
+            className="results-page__menu__input",
+        )
 
     if filter_def.get("type") == 'dropdown':
         return InsightDropdown(
@@ -118,12 +159,38 @@ layout = html.Div(id="dashboard-container", className='results-page', children=[
                     ]),
                 ]),
                 dcc.Store(id='award-dates', data={f: FILTERS[f]["defaults"] for f in FILTERS}),
+                dcc.Store(id='dashboard-state'),
             ]),
         ]),
 
         html.Div(className="results-page__body", children=[
             html.Section(className='results-page__body__content',
                          id="dashboard-output"),
+            html.Section(className='results-page__body__content', id="grants-table-section", children=[
+                html.H2(className='results-page__body__section-title', children='Grants'),
+                html.Div(className='cf', children=[
+                    dcc.Dropdown(
+                        id='grants-table-sort',
+                        options=[{"label": "Sort by {}".format(label.lower()), "value": field}
+                                 for field, label in TABLE_COLUMNS.items()],
+                        value='Amount Awarded',
+                        clearable=False,
+                    ),
+                    dcc.RadioItems(
+                        id='grants-table-order',
+                        options=[
+                            {"label": "Highest first", "value": "desc"},
+                            {"label": "Lowest first", "value": "asc"},
+                        ],
+                        value='desc',
+                        labelStyle={'display': 'inline-block', 'marginRight': '12px'},
+                    ),
+                ]),
+                html.Div(id='grants-table'),
+                html.Button('Previous', id='grants-table-prev', n_clicks_timestamp=0),
+                html.Button('Next', id='grants-table-next', n_clicks_timestamp=0),
+                dcc.Store(id='grants-table-page', data={"page": 0, "prev": 0, "next": 0}),
+            ]),
             html.Section(
                 className='results-page__body__whats-next',
                 id="whats-next",
@@ -134,19 +201,28 @@ layout = html.Div(id="dashboard-container", className='results-page', children=[
     ]),
 ])
 
-@app.callback(Output('dashboard-output', 'children'),
+@app.callback(Output('dashboard-state', 'data'),
               [Input('output-data-id', 'data')] + [
                   Input('df-change-{}'.format(f), 'value')
                   for f in FILTERS
               ])
-def dashboard_output(fileid, *args):
-    filter_args = dict(zip(FILTERS.keys(), args))
-    df = get_filtered_df(fileid, **filter_args)
-    logging.debug("dashboard_output", fileid, df is None)
+def dashboard_state(fileid, *args):
+    filter_args = remove_default_filters(fileid, dict(zip(FILTERS.keys(), args)))
+    token, state = get_dashboard_state(fileid, filter_args)
+    return {"fileid": fileid, "filters": filter_args, "token": token}
+
+@app.callback(Output('dashboard-output', 'children'),
+              [Input('dashboard-state', 'data')])
+def dashboard_output(state_data):
+    fileid = (state_data or {}).get("fileid")
+    filter_args = (state_data or {}).get("filters") or {}
+    state = load_dashboard_state(state_data)
+    results = state["results"]
+    logging.debug("dashboard_output", fileid, results is None)
 
     metadata = get_metadata_from_cache(fileid)
 
-    if df is None:
+    if results is None:
         return [
             html.H1(
                 html.Span("Dataset not found",
@@ -161,68 +237,163 @@ def dashboard_output(fileid, *args):
             ], className="results-page__body__section-description"),
         ]
 
-    if len(df) == 0:
+    if results["statistics"]["grants"] == 0:
         return html.Div('No grants meet criteria')
 
     outputs = []
     
-    outputs.extend(get_funder_output(df, filter_args.get("grant_programmes")))
-    outputs.append(get_statistics(df))
+    outputs.extend(get_funder_output(
+        results["statistics"], results["funders"], filter_args.get("grant_programmes")))
+    outputs.append(get_statistics_output(results["statistics"]))
     outputs.extend(get_file_output(metadata))
 
     charts = []
     
-    charts.append(funder_chart(df))
-    charts.append(amount_awarded_chart(df))
-    charts.append(grant_programme_chart(df))
-    charts.append(awards_over_time_chart(df))
-    charts.append(organisation_type_chart(df))
-    # charts.append(org_identifier_chart(df))
-    charts.append(region_and_country_chart(df))
+    charts.append(funder_chart(results["funders"]))
+    charts.append(amount_awarded_chart(results["amount_awarded"]))
+    charts.append(grant_programme_chart(results["grant_programmes"]))
+    charts.append(awards_over_time_chart(results["award_date"]))
+    charts.append(organisation_type_chart(results["org_type"]))
+    # charts.append(org_identifier_chart(results["identifier_scheme"]))
+    charts.append(region_and_country_chart(results["ctry_rgn"]))
     charts.append(location_map(
-        df,
+        state["map"],
         app.server.config.get("MAPBOX_ACCESS_TOKEN"),
-        app.server.config.get("MAPBOX_STYLE")
+        app.server.config.get("MAPBOX_STYLE"),
+        get_available_area_types(),
     ))
-    charts.append(organisation_age_chart(df))
-    charts.append(organisation_income_chart(df))
-    # charts.append(imd_chart(df))
+    charts.append(organisation_age_chart(results["org_age"]))
+    charts.append(organisation_income_chart(results["org_income"]))
+    # charts.append(imd_chart(results["imd"]))
 
     outputs.extend(charts)
 
     return outputs
 
+@app.callback(Output('grant_location_chart', 'figure'),
+              [Input('grant_location_chart', 'relayoutData'),
+               Input('map-area-type', 'value')],
+              [State('dashboard-state', 'data')])
+def location_map_zoom(relayout_data, area_type, state_data):
+    # fetch grid cells or points for the current zoom level of the map,
+    # or the number of grants in each area
+    relayout_data = relayout_data or {}
+    zoom = relayout_data.get("mapbox.zoom", DEFAULT_ZOOM)
+    center = relayout_data.get("mapbox.center", DEFAULT_CENTER)
+    fileid = (state_data or {}).get("fileid")
+    filter_args = (state_data or {}).get("filters") or {}
+
+    if area_type and area_type != 'points':
+        boundaries = get_boundaries(area_type, zoom)
+        data = get_area_data(fileid, area_type, **filter_args)
+        if boundaries is not None and data is not None:
+            return area_map_figure(
+                data,
+                boundaries,
+                app.server.config.get("MAPBOX_ACCESS_TOKEN"),
+                app.server.config.get("MAPBOX_STYLE"),
+                zoom=zoom,
+                center=center,
+            )
+
+    data = get_map_data(fileid, zoom, center, **filter_args)
+    if not data or "error" in data:
+        data = {"type": "clusters", "geo": pd.DataFrame(columns=["__geo_lat", "__geo_long", "grants"])}
+    return location_map_figure(
+        data,
+        app.server.config.get("MAPBOX_ACCESS_TOKEN"),
+        app.server.config.get("MAPBOX_STYLE"),
+        zoom=zoom,
+        center=center,
+    )
+
+def other_values_output(chart_id):
+    def other_values_func(n_clicks, state_data):
+        if not n_clicks:
+            return []
+        fileid = (state_data or {}).get("fileid")
+        filter_args = (state_data or {}).get("filters") or {}
+        results = get_filtered_results(fileid, {
+            chart_id: DASHBOARD_RESULTS[chart_id],
+            "{}_all".format(chart_id): OTHER_RESULTS[chart_id],
+        }, **filter_args)
+        if results is None or results[chart_id] is None:
+            return []
+        top = results[chart_id]["values"]
+        values = results["{}_all".format(chart_id)]
+        return series_to_list(values[(values > 0) & ~values.index.isin(top.index)])
+    return other_values_func
+
+for chart_id in OTHER_RESULTS:
+    app.callback(Output('{}-other'.format(chart_id), 'children'),
+                 [Input('{}-other-button'.format(chart_id), 'n_clicks')],
+                 [State('dashboard-state', 'data')])(other_values_output(chart_id))
+
+@app.callback(Output('grants-table-page', 'data'),
+              [Input('grants-table-prev', 'n_clicks_timestamp'),
+               Input('grants-table-next', 'n_clicks_timestamp'),
+               Input('grants-table-sort', 'value'),
+               Input('grants-table-order', 'value'),
+               Input('dashboard-state', 'data')],
+              [State('grants-table-page', 'data')])
+def grants_table_page(prev_clicked, next_clicked, sort, order, state_data, page):
+    # work out which button was clicked from the timestamps. Any other
+    # change goes back to the first page
+    page = page or {"page": 0, "prev": 0, "next": 0}
+    prev_clicked = prev_clicked or 0
+    next_clicked = next_clicked or 0
+    if prev_clicked > page["prev"]:
+        page_number = max(page["page"] - 1, 0)
+    elif next_clicked > page["next"]:
+        # don't go past the last page
+        results = load_dashboard_state(state_data)["results"]
+        total = results["statistics"]["grants"] if results is not None else 0
+        page_number = min(page["page"] + 1, max(total - 1, 0) // TABLE_PAGE_SIZE)
+    else:
+        page_number = 0
+    return {"page": page_number, "prev": prev_clicked, "next": next_clicked}
+
+@app.callback(Output('grants-table', 'children'),
+              [Input('grants-table-page', 'data')],
+              [State('grants-table-sort', 'value'),
+               State('grants-table-order', 'value'),
+               State('dashboard-state', 'data')])
+def grants_table_output(page, sort, order, state_data):
+    fileid = (state_data or {}).get("fileid")
+    filter_args = (state_data or {}).get("filters") or {}
+    table_args = dict(sort=sort, ascending=(order == 'asc'), limit=TABLE_PAGE_SIZE)
+    offset = (page or {}).get("page", 0) * TABLE_PAGE_SIZE
+    return grants_table(get_table_page(fileid, offset=offset, **table_args, **filter_args))
+
+def get_download_href(fileid, format, filter_args):
+    # include the current filters in the download link
+    filter_args = {
+        k: v for k, v in filter_args.items()
+        if v and v != ['__all']
+    }
+    return url_for('data.download_file', fileid=fileid, format=format, **filter_args)
+
 @app.callback(Output('file-download-csv', 'href'),
-              [Input('output-data-id', 'data')])
-def file_download_csv_href(fileid):
-    return url_for('data.download_file', fileid=fileid, format='csv')
+              [Input('dashboard-state', 'data')])
+def file_download_csv_href(state_data):
+    state_data = state_data or {}
+    return get_download_href(state_data.get("fileid"), 'csv', state_data.get("filters") or {})
 
 @app.callback(Output('file-download-excel', 'href'),
-              [Input('output-data-id', 'data')])
-def file_download_excel_href(fileid):
-    return url_for('data.download_file', fileid=fileid, format='xlsx')
+              [Input('dashboard-state', 'data')])
+def file_download_excel_href(state_data):
+    state_data = state_data or {}
+    return get_download_href(state_data.get("fileid"), 'xlsx', state_data.get("filters") or {})
 
 
 @app.callback(Output('whats-next', 'children'),
-              [Input('dashboard-output', 'children')],
-              [State('output-data-id', 'data')])
-def what_next_missing_fields(_, fileid):
-    df = get_filtered_df(fileid)
+              [Input('dashboard-state', 'data')])
+def what_next_missing_fields(state_data):
+    missing = load_dashboard_state(state_data).get("missing")
 
-    if df is None:
+    if missing is None:
         return []
 
-    missing = []
-    if (df["__geo_ctry"].count() + df["__geo_rgn"].count()) == 0:
-        missing.append(["postcodes or other geo data",
-                        "https://postcodes.findthatcharity.uk/"])
-
-    org_type = CHARTS['org_type']['get_results'](df)
-    if "Identifier not recognised" in org_type.index and len(org_type.index)==1:
-        missing.append(["external organisation identifiers, like charity numbers",
-                        'http://standard.threesixtygiving.org/en/latest/identifiers/#id2'])
-
-
     if not missing:
         missing = [
             html.P([
@@ -317,28 +488,54 @@ def what_next_missing_fields(_, fileid):
 @app.callback(Output('award-dates', 'data'),
               [Input('output-data-id', 'data')])
 def award_dates_change(fileid):
-    df = get_from_cache(fileid)
-    logging.debug("award_dates_change", fileid, df is None)
-    if df is None:
-        return {f: FILTERS[f]["defaults"] for f in FILTERS}
-
-    try:
-        return {f: FILTERS[f]["get_values"](df) for f in FILTERS}
-    except Exception as e:
+    # the options are cached, so the dataframe is only loaded the first time
+    options = get_safe_filter_options(fileid)
+    logging.debug("award_dates_change", fileid, options is None)
+    if options is None:
         return {f: FILTERS[f]["defaults"] for f in FILTERS}
+    return options
 
 # ================
 # Functions that return a function to be used in callbacks
 # ================
 
 
+def set_option_counts(options, counts):
+    # replace the number of grants shown in each option label
+    if not counts:
+        return options
+    return [
+        dict(o, label='{} ({})'.format(
+            re.sub(r' \([0-9,]+\)$', "", o['label']), counts.get(str(o['value']), 0)))
+        for o in options
+    ]
+
 def dropdown_filter(filter_id, filter_def):
-    def dropdown_filter_func(value):
+    def dropdown_filter_func(value, state_data):
         logging.debug("dropdown", filter_id, filter_def, value)
         value = value if value else {filter_id: filter_def["defaults"]}
-        return value[filter_id]
+        facets = load_dashboard_state(state_data).get("facets") or {}
+        return set_option_counts(value[filter_id], facets.get(filter_id))
     return dropdown_filter_func
 
+def dropdown_filter_search(filter_id, filter_def):
+    def dropdown_filter_search_func(value, state_data, search, selected, existing_options):
+        fileid = (state_data or {}).get("fileid")
+        facets = load_dashboard_state(state_data).get("facets") or {}
+        if search:
+            options = get_options_index(fileid) or {}
+            found = search_filter_options(options.get(filter_id), search)
+        else:
+            value = value if value else {filter_id: filter_def["defaults"]}
+            found = value[filter_id]
+        # keep the options that are already selected
+        found_values = [o["value"] for o in found]
+        return set_option_counts([
+            o for o in (existing_options or [])
+            if o["value"] in (selected or []) and o["value"] not in found_values
+        ] + found, facets.get(filter_id))
+    return dropdown_filter_search_func
+
 def dropdown_filter_value(filter_id, filter_def):
     def dropdown_filter_set_default_value(value, n_clicks, existing_value):
         logging.debug("dropdown", n_clicks)
@@ -402,8 +599,17 @@ def slider_hide(filter_id, filter_def):
         return existing_style
     return slider_hide_func
 
+def text_filter_value(filter_id, filter_def):
+    def text_filter_set_default_value(value, n_clicks):
+        return filter_def["defaults"]
+    return text_filter_set_default_value
+
 def set_dropdown_value(filter_id, filter_def):
     def set_dropdown_value_fund(value, options, existingvaluedef):
+        if filter_def.get("type")=="text":
+            existingvaluedef['value'] = '"{}"'.format(value) if value else "Any"
+            return existingvaluedef
+
         if filter_def.get("type")=="rangeslider":
             if value[0] == value[1]:
                 existingvaluedef['value'] = str(value[0])
@@ -439,12 +645,36 @@ for filter_id, filter_def in FILTERS.items():
 
     if filter_def.get("type") in ['dropdown', 'multidropdown']:
 
-        # callback adding the filter itself
-        app.callback(
-            Output('df-change-{}'.format(filter_id), 'options'),
-            [Input('award-dates', 'data')])(
-                dropdown_filter(filter_id, filter_def)
-            )
+        if filter_def.get("build_options"):
+
+            # callback adding the filter itself, with options matching the search
+            app.callback(
+                Output('df-change-{}'.format(filter_id), 'options'),
+                [Input('award-dates', 'data'),
+                 Input('dashboard-state', 'data'),
+                 Input('df-change-{}-search'.format(filter_id), 'value')],
+                [State('df-change-{}'.format(filter_id), 'value'),
+                 State('df-change-{}'.format(filter_id), 'options')])(
+                    dropdown_filter_search(filter_id, filter_def)
+                )
+
+            # callback clearing the search when a new file is loaded or the filters are reset
+            app.callback(
+                Output('df-change-{}-search'.format(filter_id), 'value'),
+                [Input('award-dates', 'data'),
+                 Input('df-reset-filters', 'n_clicks')])(
+                    lambda *args: ''
+                )
+
+        else:
+
+            # callback adding the filter itself
+            app.callback(
+                Output('df-change-{}'.format(filter_id), 'options'),
+                [Input('award-dates', 'data'),
+                 Input('dashboard-state', 'data')])(
+                    dropdown_filter(filter_id, filter_def)
+                )
 
         # callback setting the default value of the filter (nothing selected)
         app.callback(
@@ -462,6 +692,15 @@ for filter_id, filter_def in FILTERS.items():
                 filter_dropdown_hide(filter_id, filter_def)
             )
 
+    elif filter_def.get("type") in ['text']:
+
+        # callback clearing the text when a new file is loaded or the filters are reset
+        app.callback(Output('df-change-{}'.format(filter_id), 'value'),
+                     [Input('award-dates', 'data'),
+                      Input('df-reset-filters', 'n_clicks')])(
+                        text_filter_value(filter_id, filter_def)
+                    )
+
     elif filter_def.get("type") in ['rangeslider']:
 
         # callback setting the minimum value of a slider
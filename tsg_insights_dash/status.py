@@ -15,7 +15,7 @@ import babel.numbers
 import humanize
 
 from app import app
-from tsg_insights.data.registry import get_registry_by_publisher, get_registry
+from tsg_insights.data.registry import get_registry_by_publisher, get_registry_index, filter_registry_index
 from charts import pluralize, format_currency, message_box
 
 FILE_TYPES = {
@@ -65,63 +65,76 @@ layout = html.Div(id="status-container", className='', children=[
     ]),
 ])
 
+STATUS_FILTER_IDS = {
+    "search": 'status-search',
+    "licence": 'status-licence',
+    "last_modified": 'status-last-modified',
+    "currency": 'status-currency',
+    "filetype": 'status-file-type',
+}
+STATUS_FILTER_INPUTS = [Input(v, 'value') for v in STATUS_FILTER_IDS.values()]
+
+
+def get_status_filters(search, licence, last_modified, currency, filetype):
+    return {
+        "search": search,
+        "licence": licence,
+        "last_modified": last_modified,
+        "currency": currency,
+        "filetype": filetype
+    }
+
+
+# the other filters are inputs to each facet's options, so each option shows
+# how many files would match if it was chosen. A facet's counts don't depend
+# on its own value, so changing it doesn't update its options
+def get_facet_inputs(facet):
+    return [Input(v, 'value') for k, v in STATUS_FILTER_IDS.items() if k != facet]
+
+
+def get_status_facet(index, facet, *filters):
+    filter_names = [k for k in STATUS_FILTER_IDS if k != facet]
+    return filter_registry_index(index, dict(zip(filter_names, filters)))[1][facet]
+
+
 @app.callback(Output('status-licence', 'options'),
-              [Input('status-container', 'children')])
-def get_status_options(_):
-    reg = get_registry()
-    licenses = {}
-    for r in reg:
-        if r.get('license') and r.get('license') in licenses:
-            continue
-        licenses[r.get('license')] = r.get('license_name')
+              get_facet_inputs("licence"))
+def get_status_options(*filters):
+    index = get_registry_index()
+    facets = get_status_facet(index, "licence", *filters)
     return [{
-        "label": v,
+        "label": "{} ({})".format(index["licence_names"].get(k), facets.get(k, 0)),
         "value": k
-    } for k, v in licenses.items()]
+    } for k in index["licence"]]
 
 @app.callback(Output('status-currency', 'options'),
-              [Input('status-container', 'children')])
-def get_currency_options(_):
-    reg = get_registry()
-    currencies = []
-    for r in reg:
-        for c in r.get("datagetter_aggregates", {}).get('currencies', {}):
-            if c not in currencies:
-                currencies.append(c)
-    
+              get_facet_inputs("currency"))
+def get_currency_options(*filters):
+    index = get_registry_index()
+    facets = get_status_facet(index, "currency", *filters)
     return [{
-        "label": "{} [{}]".format(babel.numbers.get_currency_name(c), c),
+        "label": "{} [{}] ({})".format(babel.numbers.get_currency_name(c), c, facets.get(c, 0)),
         "value": c
-    } for c in currencies]
+    } for c in index["currency"]]
 
 @app.callback(Output('status-file-type', 'options'),
-              [Input('status-container', 'children')])
-def get_filetype_options(_):
-    reg = get_registry()
-    filetypes = {}
-    for r in reg:
-        filetype = r.get('datagetter_metadata', {}).get("file_type")
-        filetypes[filetype] = FILE_TYPES.get(filetype, (filetype, filetype))
+              get_facet_inputs("filetype"))
+def get_filetype_options(*filters):
+    index = get_registry_index()
+    facets = get_status_facet(index, "filetype", *filters)
+    filetypes = {
+        k: FILE_TYPES.get(k, (k, k)) for k in index["filetype"]
+    }
     return [{
-        "label": "{} ({})".format(v[0], v[1]),
+        "label": "{} ({}) ({})".format(v[0], v[1], facets.get(k, 0)),
         "value": k
     } for k, v in filetypes.items()]
 
 
 @app.callback(Output('status-rows', 'children'),
-              [Input('status-search', 'value'),
-               Input('status-licence', 'value'),
-               Input('status-last-modified', 'value'),
-               Input('status-currency', 'value'),
-               Input('status-file-type', 'value')])
-def update_status_container(search, licence, last_modified, currency, filetype):
-    reg = get_registry_by_publisher(filters={
-        "search": search,
-        "licence": licence,
-        "last_modified": last_modified,
-        "currency": currency,
-        "filetype": filetype
-    })
+              STATUS_FILTER_INPUTS)
+def update_status_container(*filters):
+    reg = get_registry_by_publisher(filters=get_status_filters(*filters))
 
     file_count = sum([len(pub_reg) for pub, pub_reg in reg.items()])
     rows = [
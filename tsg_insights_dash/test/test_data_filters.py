@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+from tsg_insights_dash.data.filters import *
+
+
+def get_test_df():
+    return pd.DataFrame({
+        "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder C", None, "Funder B", "Funder A"],
+        "Grant Programme:0:Title": ["P1", "P2", "P1", None, "P3", "P3", "P1"],
+        "__geo_ctry": ["England", "England", "England", None, "Scotland", "Northern Ireland", None],
+        "__geo_rgn": ["South East", "South West", "South West", None, "Scotland", None, None],
+        "Award Date:Year": [2015, 2016, 2017, 2017, 2018, 2019, 2015],
+        "Amount Awarded": [300, 150, 200, 400, 500, 600, 0],
+        "Title": ["Youth club", "Community garden", "Youth music", None, "Garden tools", "Sports", "Youth-led gardening"],
+        "Recipient Org:0:Name": ["Charity X", "Charity Y", "Charity X", "Trust Z", None, "Charity Y", "Gardens Trust"],
+    })
+
+
+def test_bitmap():
+    values = pd.Series([True, False, True, True, False, False, False, False, True]).values
+    bitmap = to_bitmap(values)
+    assert len(bitmap) == 2
+    assert (from_bitmap(bitmap, len(values)) == values).all()
+
+
+def test_filter_index():
+    df = get_test_df()
+    index = build_filter_index(df)
+    assert index["rows"] == len(df)
+    assert get_filtered_rows(index) is None
+
+    filters = [
+        {"funders": ["Funder A"]},
+        {"funders": ["Funder A", "Funder B"], "grant_programmes": ["P1"]},
+        {"funders": ["__all"], "grant_programmes": ["P3"]},
+        {"area": ["England##South West"]},
+        {"award_dates": [2016, 2017]},
+        {"funders": ["Funder Z"]},
+        {"search": "youth"},
+        {"search": "GARDEN"},
+        {"search": "garden trust", "funders": ["Funder A"]},
+        {"search": "charity y"},
+        {"search": "zzz"},
+        {"search": "  "},
+    ]
+    for f in filters:
+        expected = df
+        for filter_id, filter_def in FILTERS.items():
+            new_df = filter_def["apply_filter"](expected, f.get(filter_id), filter_def)
+            if new_df is not None:
+                expected = new_df
+        rows = get_filtered_rows(index, **f)
+        if rows is None:
+            rows = np.arange(len(df))
+        assert list(df.take(rows).index) == list(expected.index)
+
+
+def test_filter_index_high_cardinality(monkeypatch):
+    monkeypatch.setattr("tsg_insights_dash.data.filters.BITMAP_MAX_VALUES", 2)
+    df = get_test_df()
+    index = build_filter_index(df)
+    assert index["filters"]["funders"]["bitmaps"] is None
+    assert index["filters"]["award_dates"] is not None
+    rows = get_filtered_rows(index, funders=["Funder B", "Funder C"])
+    assert list(rows) == [2, 3, 5]
+
+
+def test_text_index():
+    df = get_test_df()
+    index = build_text_index(df, FILTERS["search"])
+    assert list(index["words"]) == sorted(index["words"])
+    assert len(index["offsets"]) == len(index["words"]) + 1
+
+    rows = from_bitmap(apply_text_index(index, "yo", FILTERS["search"]), len(df))
+    assert list(np.flatnonzero(rows)) == [0, 2, 6]
+    assert apply_text_index(index, "", FILTERS["search"]) is None
+
+
+def test_filter_options():
+    df = get_test_df()
+    df.loc[:, "Funding Org:0:Name"] = ["Big Lottery Fund", "Big Lottery Fund", "Arts Council",
+                                       "Lottery Trust", None, "Arts Council", "Big Lottery Fund"]
+    index = build_options_index(df)
+    assert set(index.keys()) == {"funders", "grant_programmes"}
+
+    options = index["funders"]
+    assert list(options["keys"]) == sorted(options["keys"])
+    assert search_filter_options(options) == FILTERS["funders"]["get_values"](df)
+    assert search_filter_options(options, limit=1) == [
+        {"label": "Big Lottery Fund (3)", "value": "Big Lottery Fund"}]
+
+    # words match anywhere in the option, most common first
+    found = [o["value"] for o in search_filter_options(options, "lott")]
+    assert found == ["Big Lottery Fund", "Lottery Trust"]
+    found = [o["value"] for o in search_filter_options(options, "LOTTERY tr")]
+    assert found == ["Lottery Trust"]
+    assert search_filter_options(options, "council fund") == []
+    assert search_filter_options(None, "fund") == []
+
+
+def test_facet_counts():
+    df = get_test_df()
+    index = build_filter_index(df)
+
+    facets = get_facet_counts(index)
+    assert facets["funders"] == {"Funder A": 3, "Funder B": 2, "Funder C": 1}
+    assert facets["area"]["England##South West"] == 2
+    assert facets["area"]["Unknown##Unknown"] == 2
+    assert facets["area"]["Northern Ireland##Unknown"] == 1
+
+    # each filter's counts ignore its own selection but use the others
+    facets = get_facet_counts(index, funders=["Funder A"], grant_programmes=["P1"])
+    assert facets["funders"] == {"Funder A": 2, "Funder B": 1, "Funder C": 0}
+    assert facets["grant_programmes"] == {"P1": 2, "P2": 1, "P3": 0}
+    expected = df[df["Funding Org:0:Name"].isin(["Funder A"]) &
+                  df["Grant Programme:0:Title"].isin(["P1"])]
+    assert sum(facets["area"].values()) == len(expected)
+
+
+def test_facet_counts_high_cardinality(monkeypatch):
+    monkeypatch.setattr("tsg_insights_dash.data.filters.BITMAP_MAX_VALUES", 2)
+    df = get_test_df()
+    index = build_filter_index(df)
+    facets = get_facet_counts(index, grant_programmes=["P3"])
+    assert facets["funders"] == {"Funder A": 0, "Funder B": 1, "Funder C": 0}
@@ -0,0 +1,126 @@
+import os
+import json
+import tempfile
+import importlib
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+
+from tsg_insights_dash.data.geo import *
+
+
+def get_test_df():
+    return pd.DataFrame({
+        "__geo_lat": [51.5074, 51.5080, 55.9533, None, 51.5072],
+        "__geo_long": [-0.1278, -0.1270, -3.1883, None, -0.1276],
+        "Recipient Org:0:Name": ["A", "B", "C", "D", "A"],
+        "Recipient Org:0:Identifier": ["1", "2", "3", "4", "1"],
+    })
+
+
+def test_zoom_level():
+    assert get_zoom_level(None) == DEFAULT_ZOOM
+    assert get_zoom_level(5.7) == 5
+    assert get_zoom_level(0) == MIN_ZOOM
+    assert get_zoom_level(16) == POINTS_ZOOM
+
+
+def test_geo_index():
+    df = get_test_df()
+    index = build_geo_index(df)
+    assert index["rows"] == len(df)
+    assert index["levels"][MIN_ZOOM]["codes"][3] == -1
+
+    # London and Edinburgh are in separate cells
+    clusters = get_geo_clusters(index, None, 5)
+    assert clusters["grant_count"] == 4
+    assert clusters["total_grants"] == 5
+    assert sorted(clusters["geo"]["grants"].tolist()) == [1, 3]
+
+    clusters = get_geo_clusters(index, np.array([0, 2, 3]), 5)
+    assert clusters["grant_count"] == 2
+    assert clusters["total_grants"] == 3
+    london = clusters["geo"][clusters["geo"]["grants"] == 1]
+    assert len(london) == 2
+
+    assert build_geo_index(df[["Recipient Org:0:Name"]]) is None
+
+
+def test_viewport_points():
+    df = get_test_df()
+    data = {
+        "type": "points",
+        "geo": df.dropna().assign(grants=1),
+        "popup_col": "Recipient Org:0:Name",
+    }
+    points = get_viewport_points(data, 10, {"lat": 51.5074, "lon": -0.1278})
+    assert len(points["geo"]) == 3
+
+
+def test_rows_in_bbox():
+    df = get_test_df()
+    index = build_geo_index(df)
+    rows = get_rows_in_bbox(index, [-0.2, 51.4, 0, 51.6])
+    assert rows.tolist() == [0, 1, 4]
+    rows = get_rows_in_bbox(index, [-4, 51.4, 0, 56])
+    assert rows.tolist() == [0, 1, 2, 4]
+    rows = get_rows_in_bbox(index, [-0.1274, 51.4, 0, 51.6])
+    assert rows.tolist() == [1]
+    assert get_rows_in_bbox(index, [10, 10, 11, 11]).tolist() == []
+
+
+def test_geojson_features():
+    features = list(get_geojson_features(
+        np.array([51.5]), np.array([-0.1]), {"grants": np.array([3]), "name": ["A"]}))
+    assert len(features) == 1
+    assert json.loads(features[0])["geometry"]["coordinates"] == [-0.1, 51.5]
+    assert json.loads(features[0])["properties"] == {"grants": 3, "name": "A"}
+
+
+def test_area_index():
+    df = get_test_df()
+    df["__geo_rgn"] = ["London", "London", "Scotland", None, "London"]
+    index = build_area_index(df)
+    assert "laua" not in index["areas"]
+    counts = get_area_counts(index, "rgn")
+    assert counts["London"] == 3
+    assert counts["Scotland"] == 1
+
+    counts = get_area_counts(index, "rgn", np.array([2, 3]))
+    assert counts.to_dict() == {"Scotland": 1}
+    assert get_area_counts(index, "laua") is None
+
+
+def test_simplify_geometry():
+    line = np.array([[0, 0], [1, 0.001], [2, 0], [2, 2], [0, 2], [0, 0]], dtype=float)
+    simplified = simplify_line(line, 0.01)
+    assert len(simplified) == 5
+    assert simplified[1].tolist() == [2, 0]
+
+    geometry = {"type": "Polygon", "coordinates": [line.tolist()]}
+    assert simplify_geometry(geometry, 0.01)["type"] == "MultiPolygon"
+    assert simplify_geometry(geometry, 10) is None
+    assert get_geometry_centre(simplify_geometry(geometry, 0.01)) == {"lon": 1.0, "lat": 1.0}
+
+
+def test_boundaries_cache(monkeypatch):
+    boundaries_folder = tempfile.mkdtemp()
+    uploads_folder = tempfile.mkdtemp()
+    with open(os.path.join(boundaries_folder, "rgn.geojson"), "w") as f:
+        json.dump({"features": [{
+            "properties": {"rgn19cd": "E12000001", "rgn19nm": "North East"},
+            "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]},
+        }]}, f)
+
+    app = Flask(__name__)
+    app.config.update(BOUNDARIES_FOLDER=boundaries_folder, UPLOADS_FOLDER=uploads_folder)
+    monkeypatch.setattr(importlib.import_module("tsg_insights_dash.data.geo"), "BOUNDARIES", {})
+    with app.app_context():
+        boundaries = get_boundaries("rgn", 6)
+        assert boundaries["keys"]["North East"] == 0
+
+    # the simplified boundaries are saved without leaving temporary files
+    assert os.listdir(uploads_folder) == ["boundaries-rgn-6.json"]
+    with open(os.path.join(uploads_folder, "boundaries-rgn-6.json")) as f:
+        assert json.load(f) == boundaries
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tsg_insights_dash.data.query import check_query, run_query
+
+
+def get_test_df():
+    return pd.DataFrame({
+        "Funding Org:0:Name": ["A", "A", "B", "B", "B"],
+        "Recipient Org:0:Name": ["X", "Y", "X", "Z", "X"],
+        "Amount Awarded": [100, 200, 300, 400, 500],
+    })
+
+
+def test_check_query():
+    query = check_query({"groupby": ["Funding Org:0:Name"], "limit": 100000})
+    assert query["limit"] == 1000
+    assert query["aggregate"] == {}
+    assert query["ascending"] is False
+
+    with pytest.raises(ValueError):
+        check_query({"filters": {"unknown": ["A"]}})
+    with pytest.raises(ValueError):
+        check_query({"groupby": ["a"], "aggregate": {"Amount Awarded": ["std"]}})
+    with pytest.raises(ValueError):
+        check_query({"aggregate": {"Amount Awarded": ["sum"]}})
+    with pytest.raises(ValueError):
+        check_query({"groupby": ["Funding Org:0:Name"], "limit": True})
+    with pytest.raises(ValueError):
+        check_query({"columns": []})
+
+    # the types of each part of the query are checked
+    for bad_query in [
+        {"groupby": 5},
+        {"groupby": "Funding Org:0:Name"},
+        {"columns": 3},
+        {"columns": ["Title", 1]},
+        {"groupby": ["a"], "aggregate": [1]},
+        {"groupby": ["a"], "aggregate": {"Amount Awarded": [["sum"]]}},
+        {"groupby": ["a"], "filters": ["x"]},
+        {"groupby": ["a"], "filters": {"funders": "Funder A"}},
+        {"groupby": ["a"], "filters": {"award_dates": ["a", "b"]}},
+        {"groupby": ["a"], "filters": {"award_dates": [2015]}},
+        {"groupby": ["a"], "filters": {"award_dates": [2015, 2016, 2017]}},
+        {"groupby": ["a"], "filters": {"search": ["youth"]}},
+        {"groupby": ["a"], "sort": ["grants"]},
+    ]:
+        with pytest.raises(ValueError):
+            check_query(bad_query)
+    query = check_query({"groupby": ["a"], "filters": {"award_dates": [2015, 2017], "search": "youth"}})
+    assert query["filters"] == {"award_dates": [2015, 2017], "search": "youth"}
+
+    # aggregations are checked against the column types
+    dtypes = get_test_df().dtypes
+    with pytest.raises(ValueError):
+        check_query({"groupby": ["Funding Org:0:Name"],
+                     "aggregate": {"Recipient Org:0:Name": ["sum"]}}, dtypes)
+    query = check_query({"groupby": ["Funding Org:0:Name"],
+                         "aggregate": {"Recipient Org:0:Name": ["nunique"]}}, dtypes)
+    assert query["aggregate"] == {"Recipient Org:0:Name": ["nunique"]}
+
+
+def test_run_query():
+    df = get_test_df()
+    results = run_query(df, check_query({
+        "groupby": ["Recipient Org:0:Name"],
+        "aggregate": {"Amount Awarded": ["sum", "median"]},
+        "sort": "Amount Awarded:sum",
+        "limit": 2,
+    }))
+    assert results["groups"] == 3
+    assert results["result"]["Recipient Org:0:Name"].tolist() == ["X", "Z"]
+    assert results["result"]["Amount Awarded:sum"].tolist() == [900, 400]
+    assert results["result"]["grants"].tolist() == [3, 1]
+
+    # only the filtered rows are used
+    results = run_query(df, check_query({"groupby": ["Funding Org:0:Name"]}), rows=np.array([0, 1, 2]))
+    assert results["rows"] == 3
+    assert results["result"].set_index("Funding Org:0:Name")["grants"].to_dict() == {"A": 2, "B": 1}
+
+    # individual grants
+    results = run_query(df, check_query({
+        "columns": ["Recipient Org:0:Name"],
+        "sort": "Amount Awarded",
+        "ascending": True,
+        "limit": 2,
+    }))
+    assert results["result"].to_dict("list") == {"Recipient Org:0:Name": ["X", "Y"]}
+
+    with pytest.raises(ValueError):
+        run_query(df, check_query({"groupby": ["Unknown"]}))
+
+    # errors from pandas are turned into a ValueError
+    df.loc[:, "Mixed"] = ["X", 1, "Y", 2.5, None]
+    with pytest.raises(ValueError):
+        run_query(df, check_query({"columns": ["Mixed"], "sort": "Mixed"}))
+    with pytest.raises(ValueError):
+        run_query(df, check_query({"groupby": ["Funding Org:0:Name"], "aggregate": {"Mixed": ["mean"]}}))
@@ -35,3 +35,108 @@ def test_get_ctry_rgn():
     # check sort order
     assert ctry_rgn.iloc[0].name == ("Scotland", "Scotland")
     assert ctry_rgn.iloc[-2].name == ("England", "South East")
+
+
+def test_aggregate_cube():
+    df = pd.DataFrame({
+        "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder B", "Funder A", "Funder C"],
+        "Grant Programme:0:Title": ["P1", "P2", "P1", "P1", "P1", "P3"],
+        "__geo_ctry": ["England", "England", "England", None, "Scotland", "Wales"],
+        "__geo_rgn": ["South East", "South West", "South West", None, "Scotland", None],
+        "Award Date": pd.to_datetime(["2017-01-01", "2017-06-01", "2018-01-01", "2018-02-01", "2019-01-01", "2019-01-01"]),
+        "Award Date:Year": [2017, 2017, 2018, 2018, 2019, 2019],
+        "Currency": ["GBP", "GBP", "GBP", "USD", "GBP", "GBP"],
+        "Recipient Org:0:Identifier": ["GB-CHC-1", "GB-CHC-1", "GB-COH-2", "360G-X", "GB-CHC-1", "GB-CHC-3"],
+        "Title": ["A", "B", "C", "D", "E", "F"],
+        "Amount Awarded": [300, 1500, 200, 40000, 500, 10],
+    })
+    df.loc[:, "Amount Awarded:Bands"] = pd.cut(
+        df["Amount Awarded"],
+        bins=[-1, 500, 1000, 2000, 5000, 10000, 100000, 1000000, float("inf")],
+        labels=list(AWARD_BAND_CHANGES.keys()),
+    )
+
+    cube = build_aggregate_cube(df)
+    assert len(cube) == 6
+    assert cube["Grants"].sum() == len(df)
+    assert cube["Amount Awarded"].sum() == df["Amount Awarded"].sum()
+    assert "Award Date:Month" not in cube.columns
+    assert "Currency" not in cube.columns
+
+    for subset in [df, df[df["Funding Org:0:Name"] == "Funder A"]]:
+        subcube = cube[cube["Funding Org:0:Name"].isin(subset["Funding Org:0:Name"].unique())]
+        assert get_cube_statistics(subcube) == get_statistics(subset)
+        for chart_id in ["funders", "grant_programmes"]:
+            expected = CHARTS[chart_id]["get_results"](subset)
+            result = CHARTS[chart_id]["get_cube_results"](subcube)
+            assert result["values"].to_dict() == expected["values"].to_dict()
+            assert result["other"] == expected["other"]
+        expected = CHARTS["org_type"]["get_results"](subset)
+        result = CHARTS["org_type"]["get_cube_results"](subcube)
+        assert result.to_dict() == expected.to_dict()
+        expected = CHARTS["ctry_rgn"]["get_results"](subset)
+        result = CHARTS["ctry_rgn"]["get_cube_results"](subcube)
+        assert result.index.tolist() == expected.index.tolist()
+        assert result["Grants"].tolist() == expected["Grants"].tolist()
+        expected = CHARTS["amount_awarded"]["get_results"](subset)
+        result = CHARTS["amount_awarded"]["get_cube_results"](subcube)
+        assert result.values.tolist() == expected.values.tolist()
+        expected = CHARTS["award_date"]["get_results"](subset)
+        result = CHARTS["award_date"]["get_cube_results"](subcube)
+        assert result["month"].to_dict() == expected["month"].to_dict()
+
+
+def test_award_date_bins():
+    df = pd.DataFrame({
+        "Award Date": pd.to_datetime(["2017-01-01", "2017-01-20", "2017-05-01", "2018-11-30"]),
+    })
+    bins = CHARTS["award_date"]["get_results"](df)
+    assert bins["grants"] == 4
+    assert bins["first"] == "2017-01"
+    assert bins["last"] == "2018-11"
+    assert bins["min"] == 2017
+    assert bins["max"] == 2018
+    assert len(bins["month"]) == 23
+    assert bins["month"]["2017-01-01"] == 2
+    assert bins["month"]["2017-02-01"] == 0
+    assert bins["quarter"].tolist() == [2, 1, 0, 0, 0, 0, 0, 1]
+    assert bins["quarter"].index[1] == "2017-04-01"
+    assert bins["year"].to_dict() == {"2017-01-01": 3, "2018-01-01": 1}
+
+    cube_bins = get_award_date_bins(pd.Series([2, 1, 1], index=["2017-01", "2017-05", "2018-11"]))
+    assert cube_bins["year"].to_dict() == bins["year"].to_dict()
+    assert cube_bins["month"].to_dict() == bins["month"].to_dict()
+
+
+def test_top_values():
+    counts = pd.Series(range(1, 31), index=["P{}".format(i) for i in range(1, 31)])
+
+    top = get_top_values(counts, 5)
+    assert top["values"].index.tolist() == ["P30", "P29", "P28", "P27", "P26"]
+    assert top["other"] == counts.iloc[:25].sum()
+    assert top["other_values"] == 25
+    assert with_other_values(top).index.tolist()[-1] == "Other (25)"
+    assert with_other_values(top).sum() == counts.sum()
+
+    # small series are only sorted
+    top = get_top_values(counts.iloc[:6], 5)
+    assert top["values"].index.tolist() == ["P6", "P5", "P4", "P3", "P2", "P1"]
+    assert top["other_values"] == 0
+    assert with_other_values(top).index.tolist() == top["values"].index.tolist()
+
+    # ties at the cutoff are broken by the label, whatever order they come in
+    counts = pd.Series([5, 3, 3, 3, 1, 1], index=["A", "D", "C", "B", "E", "F"])
+    for order in [counts, counts[::-1], counts.sample(frac=1, random_state=1)]:
+        top = get_top_values(order, 3)
+        assert top["values"].index.tolist() == ["A", "B", "C"]
+        assert top["other"] == 5
+
+    df = pd.DataFrame({"Grant Programme:0:Title": counts.index.repeat(counts.values)})
+    top = CHARTS["grant_programmes"]["get_results"](df)
+    assert top["values"].index.tolist() == ["A", "B", "C", "D", "E", "F"]
+
+    # labels that look like the "Other" bucket are left alone
+    counts = pd.Series([2, 1], index=["P1", "Other (3)"])
+    top = get_top_values(counts, 5)
+    assert top["other_values"] == 0
+    assert with_other_values(top).index.tolist() == ["P1", "Other (3)"]
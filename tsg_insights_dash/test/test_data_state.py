@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import tsg_insights_dash.data.filters as filters
+import tsg_insights_dash.data.geo as geo
+import tsg_insights_dash.data.state as state
+from tsg_insights.data.cache import get_filters_hash
+from tsg_insights_dash.data.results import CHARTS, get_statistics, AGE_BAND_CHANGES, AWARD_BAND_CHANGES
+from tsg_insights_dash.data.state import get_dashboard_state, load_dashboard_state, remove_default_filters, \
+    save_dashboard_snapshot
+
+
+def get_test_df():
+    df = pd.DataFrame({
+        "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder B", "Funder A", "Funder C"],
+        "Grant Programme:0:Title": ["P1", "P2", "P1", "P1", "P1", "P3"],
+        "Title": ["Youth club", "Garden", "Youth music", "Tools", "Sports", "Arts"],
+        "__geo_ctry": ["England", "England", "England", None, "Scotland", "Wales"],
+        "__geo_rgn": ["South East", "South West", "South West", None, "Scotland", None],
+        "__geo_lat": [51.5, 50.7, 50.8, np.nan, 55.9, 52.4],
+        "__geo_long": [-0.1, -3.5, -3.4, np.nan, -3.2, -4.0],
+        "Award Date": pd.to_datetime(["2017-01-01", "2017-06-01", "2018-01-01",
+                                      "2018-02-01", "2019-01-01", "2019-01-01"]),
+        "Currency": ["GBP", "GBP", "GBP", "USD", "GBP", "GBP"],
+        "Recipient Org:0:Identifier": ["GB-CHC-1", "GB-CHC-1", "GB-COH-2", "360G-X", "GB-CHC-1", "GB-CHC-3"],
+        "Recipient Org:0:Name": ["Charity X", "Charity X", "Company Y", "Group Z", "Charity X", "Trust W"],
+        "Amount Awarded": [300, 1500, 200, 40000, 500, 10],
+        "__org_org_type": ["Registered Charity", "Registered Charity", "Registered Company", None,
+                           "Registered Charity", "Registered Charity"],
+    })
+    df.loc[:, "__org_latest_income_bands"] = pd.Categorical(
+        ["Under £10k", "Under £10k", None, None, "Under £10k", "£10k - £100k"],
+        categories=["Under £10k", "£10k - £100k", "£100k - £1m", "£1m - £10m", "Over £10m"])
+    df.loc[:, "__org_age_bands"] = pd.Categorical(
+        ["5-10 years", "5-10 years", "Under 1 year", None, "5-10 years", "Over 25 years"],
+        categories=list(AGE_BAND_CHANGES.keys()))
+    df.loc[:, "Award Date:Year"] = df["Award Date"].dt.year
+    df.loc[:, "Amount Awarded:Bands"] = pd.cut(
+        df["Amount Awarded"],
+        bins=[-1, 500, 1000, 2000, 5000, 10000, 100000, 1000000, float("inf")],
+        labels=list(AWARD_BAND_CHANGES.keys()),
+    )
+    return df
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    # the redis cache is replaced by dicts
+    df = get_test_df()
+    store = {"derived": {}, "results": {}, "state": {}}
+
+    def get_results_from_cache(fileid, result_id, filters):
+        key = (fileid, result_id, get_filters_hash(filters))
+        if key in store["results"]:
+            return {"results": store["results"][key]}
+
+    def save_results_to_cache(fileid, result_id, filters, results):
+        store["results"][(fileid, result_id, get_filters_hash(filters))] = results
+
+    cache_functions = {
+        "dataset_available": lambda fileid: fileid == "test",
+        "get_from_cache": lambda fileid: df if fileid == "test" else None,
+        "get_derived_from_cache": lambda fileid, name: store["derived"].get((fileid, name)),
+        "save_derived_to_cache": lambda fileid, name, obj: store["derived"].update({(fileid, name): obj}),
+        "get_results_from_cache": get_results_from_cache,
+        "save_results_to_cache": save_results_to_cache,
+        "get_state_token": lambda fileid, filters=None: get_filters_hash(filters),
+        "get_state_from_cache": lambda fileid, token: store["state"].get((fileid, token)),
+        "save_state_to_cache": lambda fileid, token, state: store["state"].update({(fileid, token): state}),
+    }
+    for module in [filters, geo, state]:
+        for name, func in cache_functions.items():
+            if hasattr(module, name):
+                monkeypatch.setattr(module, name, func)
+    store["df"] = df
+    return store
+
+
+def test_dashboard_state(cache):
+    df = cache["df"]
+    subset = df[df["Funding Org:0:Name"] == "Funder A"]
+    token, dashboard = get_dashboard_state("test", {"funders": ["Funder A"]})
+    assert cache["state"][("test", token)] is dashboard
+
+    # the state has the same results as each chart would for these filters
+    results = dashboard["results"]
+    assert results["statistics"] == get_statistics(subset)
+    for chart_id in ["funders", "grant_programmes"]:
+        expected = CHARTS[chart_id]["get_results"](subset)
+        assert results[chart_id]["values"].to_dict() == expected["values"].to_dict()
+    assert results["org_type"].to_dict() == CHARTS["org_type"]["get_results"](subset).to_dict()
+    assert results["award_date"]["month"].to_dict() == \
+        CHARTS["award_date"]["get_results"](subset)["month"].to_dict()
+    assert dashboard["facets"] == filters.get_filter_counts("test", funders=["Funder A"])
+
+    # the saved state is used for the same filters, however they're given
+    assert get_dashboard_state("test", {"funders": ["Funder A"], "area": []})[1] is dashboard
+    assert load_dashboard_state({"fileid": "test", "filters": {"funders": ["Funder A"]},
+                                 "token": token}) is dashboard
+
+    # expired state is worked out again
+    cache["state"].clear()
+    reloaded = load_dashboard_state({"fileid": "test", "filters": {"funders": ["Funder A"]},
+                                     "token": token})
+    assert reloaded["results"]["statistics"] == results["statistics"]
+
+    assert get_dashboard_state(None, {}) == (None, {"results": None})
+    assert load_dashboard_state(None) == {"results": None}
+
+
+def test_remove_default_filters(cache):
+    options = filters.get_filter_options("test")
+    all_years = [options["award_dates"]["min"], options["award_dates"]["max"]]
+    assert remove_default_filters("test", {"award_dates": all_years, "funders": ["Funder A"]}) == \
+        {"award_dates": None, "funders": ["Funder A"]}
+    assert remove_default_filters("test", {"award_dates": [all_years[0], all_years[0]]}) == \
+        {"award_dates": [all_years[0], all_years[0]]}
+    # filters are left alone if there aren't any options for the dataset
+    assert remove_default_filters("missing", {"award_dates": [2000, 2001]}) == \
+        {"award_dates": [2000, 2001]}
+
+
+def test_filter_options_errors(cache, monkeypatch):
+    def failing_options(error):
+        def get_filter_options(fileid):
+            raise error("failed")
+        return get_filter_options
+
+    # options that can't be made for the dataset are left out
+    monkeypatch.setattr(state, "get_filter_options", failing_options(KeyError))
+    assert remove_default_filters("test", {"award_dates": [2000, 2001]}) == \
+        {"award_dates": [2000, 2001]}
+    save_dashboard_snapshot("test")
+    assert cache["derived"][("test", "snapshot")]["options"] is None
+
+    # but other errors aren't hidden
+    monkeypatch.setattr(state, "get_filter_options", failing_options(RuntimeError))
+    with pytest.raises(RuntimeError):
+        remove_default_filters("test", {"award_dates": [2000, 2001]})
+
+
+def test_dashboard_snapshot(cache):
+    save_dashboard_snapshot("test")
+    snapshot = cache["derived"][("test", "snapshot")]
+    assert snapshot["state"]["results"]["statistics"]["grants"] == len(cache["df"])
+    assert filters.get_filter_options("test") is snapshot["options"]
+
+    # the unfiltered dashboard comes from the snapshot, including sliders
+    # that cover every value
+    options = snapshot["options"]
+    all_years = [options["award_dates"]["min"], options["award_dates"]["max"]]
+    assert get_dashboard_state("test", {})[1] is snapshot["state"]
+    assert get_dashboard_state(
+        "test", remove_default_filters("test", {"award_dates": all_years}))[1] is snapshot["state"]
+    assert cache["state"] == {}
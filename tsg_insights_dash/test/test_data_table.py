@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+import tsg_insights_dash.data.table as table
+from tsg_insights_dash.data.table import build_sort_index, get_sorted_rows, get_table_page, TABLE_MAX_LIMIT
+
+
+def get_test_df():
+    return pd.DataFrame({
+        "Title": ["b", "a", None, "c"],
+        "Amount Awarded": [300, 100, 400, np.nan],
+        "Award Date": pd.to_datetime(["2018-02-01", "2018-01-01", None, "2018-03-01"]),
+    })
+
+
+def test_sort_index():
+    df = get_test_df()
+    index = build_sort_index(df)
+    assert set(index["columns"].keys()) == {"Title", "Amount Awarded", "Award Date"}
+
+    assert get_sorted_rows(index, sort="Amount Awarded").tolist() == [1, 0, 2, 3]
+    # missing values stay at the end when the order is reversed
+    assert get_sorted_rows(index, sort="Amount Awarded", ascending=False).tolist() == [2, 0, 1, 3]
+    assert get_sorted_rows(index, sort="Title").tolist() == [1, 0, 3, 2]
+    assert get_sorted_rows(index, sort="Award Date", ascending=False).tolist() == [3, 0, 1, 2]
+
+    # only the filtered rows are returned, in sorted order
+    rows = np.array([0, 2, 3])
+    assert get_sorted_rows(index, rows, sort="Amount Awarded").tolist() == [0, 2, 3]
+    assert get_sorted_rows(index, rows, sort="Title", ascending=False).tolist() == [3, 0, 2]
+    assert get_sorted_rows(index, rows).tolist() == [0, 2, 3]
+    assert get_sorted_rows(index).tolist() == [0, 1, 2, 3]
+
+
+def test_table_page_limits(monkeypatch):
+    df = get_test_df()
+    monkeypatch.setattr(table, "dataset_available", lambda fileid: True)
+    monkeypatch.setattr(table, "get_from_cache", lambda fileid: df)
+    monkeypatch.setattr(table, "get_filter_index", lambda fileid, df: None)
+    monkeypatch.setattr(table, "get_filtered_rows", lambda index, **filters: None)
+    monkeypatch.setattr(table, "get_sort_index", lambda fileid, df: build_sort_index(df))
+
+    page = get_table_page("test", sort="Amount Awarded", offset=1, limit=2)
+    assert (page["offset"], page["limit"]) == (1, 2)
+    assert page["grants"].index.tolist() == [0, 2]
+
+    # the offset and limit returned are the ones used for the page
+    page = get_table_page("test", offset=-5, limit=0)
+    assert (page["offset"], page["limit"]) == (0, 1)
+    assert page["grants"].index.tolist() == [0]
+    page = get_table_page("test", offset=10, limit=TABLE_MAX_LIMIT + 1)
+    assert (page["offset"], page["limit"]) == (4, TABLE_MAX_LIMIT)
+    assert len(page["grants"]) == 0
@@ -0,0 +1,147 @@
+import os
+import json
+import importlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+import openpyxl
+import pytest
+
+from tsg_insights import create_app
+from tsg_insights.data.cache import get_downloads_folder
+from tsg_insights_dash.data.downloads import generate_csv, generate_json, generate_ndjson, \
+    write_xlsx, write_parquet, generate_and_save, build_download, DOWNLOAD_FORMATS
+
+
+def get_test_df():
+    return pd.DataFrame({
+        "Identifier": ["360G-1", "360G-2", "360G-3"],
+        "Amount Awarded": [100, 250.5, np.nan],
+        "Award Date": pd.to_datetime(["2018-01-01", None, "2018-03-01"]),
+    }, columns=["Identifier", "Amount Awarded", "Award Date"])
+
+
+def test_generate_csv():
+    df = get_test_df()
+    chunks = list(generate_csv(df, chunk_size=2))
+    assert len(chunks) == 3
+    assert "".join(chunks) == df.to_csv(index=False)
+
+
+def test_write_xlsx():
+    df = get_test_df()
+    handle, filename = tempfile.mkstemp(suffix=".xlsx")
+    os.close(handle)
+    write_xlsx(df, filename, chunk_size=2)
+    rows = list(openpyxl.load_workbook(filename).active.values)
+    os.remove(filename)
+    assert rows[0] == ("Identifier", "Amount Awarded", "Award Date")
+    assert len(rows) == 4
+    assert rows[2][1] == 250.5
+    assert rows[2][2] is None
+    assert rows[3][1] is None
+
+
+def test_generate_json():
+    df = get_test_df()
+    lines = "".join(generate_ndjson(df, chunk_size=2)).splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[1])["Amount Awarded"] == 250.5
+
+    records = json.loads("".join(generate_json(df, chunk_size=2)))
+    assert [r["Identifier"] for r in records] == ["360G-1", "360G-2", "360G-3"]
+    assert records[2]["Amount Awarded"] is None
+
+
+def test_write_parquet():
+    df = get_test_df()
+    df["Mixed"] = [1, "a", None]
+    handle, filename = tempfile.mkstemp(suffix=".parquet")
+    os.close(handle)
+    write_parquet(df, filename)
+    result = pd.read_parquet(filename)
+    os.remove(filename)
+    assert list(result.columns) == list(df.columns)
+    assert result["Mixed"].tolist() == ["1", "a", None]
+
+
+def test_failed_download_removed(monkeypatch):
+    app = create_app({
+        "UPLOADS_FOLDER": tempfile.mkdtemp(),
+        "REQUESTS_CACHE_ON": False,
+    })
+
+    def failing_chunks():
+        yield "Identifier\n"
+        raise ValueError("failed")
+
+    def failing_writer(df, filename):
+        with open(filename, "wb") as f:
+            f.write(b"x")
+        raise ValueError("failed")
+
+    with app.app_context():
+        folder = get_downloads_folder()
+        with pytest.raises(ValueError):
+            list(generate_and_save(failing_chunks(), "test", "csv", {}))
+        assert os.listdir(folder) == []
+
+        # a download that stops part way through
+        chunks = generate_and_save(generate_csv(get_test_df(), chunk_size=1), "test", "csv", {})
+        next(chunks)
+        chunks.close()
+        assert os.listdir(folder) == []
+
+        monkeypatch.setitem(DOWNLOAD_FORMATS, "xlsx", dict(DOWNLOAD_FORMATS["xlsx"], write=failing_writer))
+        with pytest.raises(ValueError):
+            build_download("test", "xlsx", {}, get_test_df())
+        assert os.listdir(folder) == []
+
+
+def test_fetch_file(monkeypatch):
+    data_bp = importlib.import_module("tsg_insights.blueprints.data")
+    requested = []
+
+    def get_filtered_results(fileid, results, **filters):
+        requested.append((sorted(results.keys()), filters))
+        return {result_id: 1 for result_id in results}
+
+    monkeypatch.setattr(data_bp, "dataset_available", lambda fileid: fileid == "test")
+    monkeypatch.setattr(data_bp, "get_dataset_version", lambda fileid: 1)
+    monkeypatch.setattr(data_bp, "get_filtered_results", get_filtered_results)
+    client = create_app({
+        "UPLOADS_FOLDER": tempfile.mkdtemp(),
+        "REQUESTS_CACHE_ON": False,
+    }).test_client()
+
+    # only the charts asked for are worked out
+    response = client.get("/data/test?charts=funders,statistics&funders=Funder+A")
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == {"funders": 1, "statistics": 1}
+    assert requested == [(["funders", "statistics"], {"funders": ["Funder A"]})]
+    assert client.get("/data/test?charts=funders,unknown").status_code == 400
+    assert client.get("/data/missing?charts=funders").status_code == 404
+
+    # range filters need two numbers
+    assert client.get("/data/test?award_dates=2015").status_code == 400
+    assert client.get("/data/test?award_dates=a&award_dates=b").status_code == 400
+    assert client.get("/data/test?award_dates=2015&award_dates=2016&award_dates=2017").status_code == 400
+    assert len(requested) == 1
+
+    # results that haven't changed aren't worked out again
+    etag = response.headers["ETag"]
+    response = client.get("/data/test?charts=statistics,funders&funders=Funder+A",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert len(requested) == 1
+
+    # a different dataset version, set of filters or charts gives a new etag
+    response = client.get("/data/test?charts=funders", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    monkeypatch.setattr(data_bp, "get_dataset_version", lambda fileid: 2)
+    response = client.get("/data/test?charts=funders,statistics&funders=Funder+A",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200